@@ -0,0 +1,155 @@
+# coding: utf-8
+
+"""索引查询性能测试
+
+在临时SQLite数据库中生成大量模拟数据, 先去掉迁移增加的索引测试
+    各高频查询的耗时, 再执行迁移后重新测试, 并打印迁移后的查询计划
+
+    python benchmarks/bench_indexes.py [消息数]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from my_app import db, migrations  # noqa: E402
+
+
+APPS = 50
+USERS = 100000
+MEDIA_TYPES = ['image', 'voice', 'video', 'thumb']
+NOW = int(time.time())
+# 素材行数, 由load按消息数确定
+MEDIA_ROWS = 0
+
+QUERIES = [
+    ('token.wechat_id',
+     'SELECT * FROM token WHERE wechat_id = :wechat_id',
+     lambda: {'wechat_id': 'gh_%d' % random.randrange(APPS)}),
+    ('media.media_id',
+     'SELECT * FROM media WHERE media_id = :media_id',
+     lambda: {'media_id': 'media_%d' % random.randrange(MEDIA_ROWS)}),
+    ('media.app_type',
+     'SELECT * FROM media WHERE app_id = :app_id AND media_type = :type '
+     'ORDER BY id LIMIT 20',
+     lambda: {'app_id': 'app_%d' % random.randrange(APPS),
+              'type': random.choice(MEDIA_TYPES)}),
+    ('media.unexpired',
+     'SELECT id, media_id, locale_url FROM media WHERE app_id = :app_id '
+     'AND created_at > :since',
+     lambda: {'app_id': 'app_%d' % random.randrange(APPS),
+              'since': NOW - 3 * 86400}),
+    ('msg.from_user',
+     'SELECT * FROM msg WHERE from_username = :user '
+     'ORDER BY create_time DESC LIMIT 20',
+     lambda: {'user': 'o_%d' % random.randrange(USERS)}),
+    ('msg.to_range',
+     'SELECT COUNT(*) FROM msg WHERE to_username = :user '
+     'AND create_time BETWEEN :start AND :end',
+     lambda: {'user': 'gh_%d' % random.randrange(APPS),
+              'start': NOW - 86400, 'end': NOW}),
+]
+
+
+def load(engine, msg_rows):
+    """生成模拟数据, 约每5条消息有1个素材"""
+    global MEDIA_ROWS
+    MEDIA_ROWS = msg_rows // 5
+    rnd = random.Random(0)
+    year = 365 * 86400
+    with engine.begin() as conn:
+        conn.execute(db.metadata.tables['token'].insert(), [
+            {'app_id': 'app_%d' % i, 'wechat_id': 'gh_%d' % i}
+            for i in range(APPS)])
+        conn.execute(db.metadata.tables['media'].insert(), [
+            {'media_id': 'media_%d' % i,
+             'app_id': 'app_%d' % rnd.randrange(APPS),
+             'media_type': rnd.choice(MEDIA_TYPES),
+             'created_at': NOW - rnd.randrange(year)}
+            for i in range(MEDIA_ROWS)])
+        batch = 100000
+        for start in range(0, msg_rows, batch):
+            rows = []
+            for i in range(start, min(start + batch, msg_rows)):
+                app = rnd.randrange(APPS)
+                user = 'o_%d' % rnd.randrange(USERS)
+                inbound = i % 2 == 0
+                rows.append({
+                    'from_username': user if inbound else 'gh_%d' % app,
+                    'to_username': 'gh_%d' % app if inbound else user,
+                    'msg_type': 'text',
+                    'create_time': NOW - rnd.randrange(year),
+                    'content': 'message %d' % i})
+            conn.execute(db.metadata.tables['msg'].insert(), rows)
+
+
+def drop_indexes(engine):
+    """去掉模型中定义的所有索引, 回到原先只有主键和唯一约束的结构"""
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn)
+        conn.execute('DELETE FROM schema_version')
+
+
+def measure(engine, number):
+    results = {}
+    with engine.connect() as conn:
+        for name, sql, params in QUERIES:
+            statement = sa.text(sql)
+            timer = timeit.Timer(
+                lambda: conn.execute(statement, **params()).fetchall())
+            results[name] = min(timer.repeat(number=number, repeat=5)) \
+                / number
+    return results
+
+
+def main():
+    msg_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    engine = sa.create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    migrations.upgrade(engine)
+    drop_indexes(engine)
+
+    started = time.time()
+    load(engine, msg_rows)
+    with engine.begin() as conn:
+        conn.execute('ANALYZE')
+    print('loaded %d msg, %d media in %.1fs' % (
+        msg_rows, MEDIA_ROWS, time.time() - started))
+
+    before = measure(engine, 5)
+    started = time.time()
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        conn.execute('ANALYZE')
+    print('migrated in %.1fs' % (time.time() - started))
+    after = measure(engine, 200)
+
+    print('%-16s %12s %12s %10s' % ('query', 'before(ms)', 'after(ms)',
+                                    'speedup'))
+    for name, sql, params in QUERIES:
+        print('%-16s %12.3f %12.3f %9.0fx' % (
+            name, before[name] * 1e3, after[name] * 1e3,
+            before[name] / after[name]))
+
+    print('')
+    with engine.connect() as conn:
+        for name, sql, params in QUERIES:
+            plan = conn.execute(sa.text('EXPLAIN QUERY PLAN ' + sql),
+                                **params()).fetchall()
+            print('%-16s %s' % (name, '; '.join(row[-1] for row in plan)))
+
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# coding: utf-8
+
+"""接收消息解析性能测试
+
+对比原先ElementTree建树后逐字段find的解析方式与receive.parse_xml,
+    覆盖所有支持的消息及事件类型
+
+    python benchmarks/bench_receive.py [次数]
+"""
+
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from my_app.main import receive  # noqa: E402
+
+
+HEAD = '<xml><ToUserName><![CDATA[gh_123456789abc]]></ToUserName>' \
+    '<FromUserName><![CDATA[oA1b2C3d4E5f6G7h8I9j0KlmnOpq]]></FromUserName>' \
+    '<CreateTime>1512345678</CreateTime>'
+
+SAMPLES = {
+    'text': '<MsgType><![CDATA[text]]></MsgType>'
+            '<Content><![CDATA[你好, 这是一条测试消息]]></Content>'
+            '<MsgId>6493861473298317314</MsgId>',
+    'image': '<MsgType><![CDATA[image]]></MsgType>'
+             '<PicUrl><![CDATA[http://mmbiz.qpic.cn/mmbiz_jpg/x/0]]></PicUrl>'
+             '<MediaId><![CDATA[m_ZbV0kyHBPbT1jwrnNlKfr]]></MediaId>'
+             '<MsgId>6493861473298317315</MsgId>',
+    'voice': '<MsgType><![CDATA[voice]]></MsgType>'
+             '<MediaId><![CDATA[m_ZbV0kyHBPbT1jwrnNlKfr]]></MediaId>'
+             '<Format><![CDATA[amr]]></Format>'
+             '<Recognition><![CDATA[腾讯微信团队]]></Recognition>'
+             '<MsgId>6493861473298317316</MsgId>',
+    'video': '<MsgType><![CDATA[video]]></MsgType>'
+             '<MediaId><![CDATA[m_ZbV0kyHBPbT1jwrnNlKfr]]></MediaId>'
+             '<ThumbMediaId><![CDATA[t_HbVxkyHBPbT1]]></ThumbMediaId>'
+             '<MsgId>6493861473298317317</MsgId>',
+    'location': '<MsgType><![CDATA[location]]></MsgType>'
+                '<Location_X>23.134521</Location_X>'
+                '<Location_Y>113.358803</Location_Y><Scale>20</Scale>'
+                '<Label><![CDATA[位置信息]]></Label>'
+                '<MsgId>6493861473298317318</MsgId>',
+    'link': '<MsgType><![CDATA[link]]></MsgType>'
+            '<Title><![CDATA[公众平台官网链接]]></Title>'
+            '<Description><![CDATA[公众平台官网链接]]></Description>'
+            '<Url><![CDATA[https://mp.weixin.qq.com]]></Url>'
+            '<MsgId>6493861473298317319</MsgId>',
+    'subscribe': '<MsgType><![CDATA[event]]></MsgType>'
+                 '<Event><![CDATA[subscribe]]></Event>',
+    'scan': '<MsgType><![CDATA[event]]></MsgType>'
+            '<Event><![CDATA[SCAN]]></Event>'
+            '<EventKey><![CDATA[123123]]></EventKey>'
+            '<Ticket><![CDATA[TICKET]]></Ticket>',
+    'LOCATION': '<MsgType><![CDATA[event]]></MsgType>'
+                '<Event><![CDATA[LOCATION]]></Event>'
+                '<Latitude>23.137466</Latitude>'
+                '<Longitude>113.352425</Longitude>'
+                '<Precision>119.385040</Precision>',
+    'CLICK': '<MsgType><![CDATA[event]]></MsgType>'
+             '<Event><![CDATA[CLICK]]></Event>'
+             '<EventKey><![CDATA[news3]]></EventKey>',
+}
+
+# 原先各消息类在__init__中find的字段
+LEGACY_FIELDS = {
+    'text': ['Content'],
+    'image': ['PicUrl', 'MediaId'],
+    'voice': ['MediaId', 'Format', 'Recognition'],
+    'video': ['MediaId', 'ThumbMediaId'],
+    'location': ['Location_X', 'Location_Y', 'Scale', 'Label'],
+    'link': ['Title', 'Description', 'Url'],
+    'subscribe': ['Event'],
+    'scan': ['Event', 'EventKey', 'Ticket'],
+    'LOCATION': ['Event', 'Latitude', 'Longitude', 'Precision'],
+    'CLICK': ['Event', 'EventKey'],
+}
+
+
+class LegacyMsg(object):
+    pass
+
+
+def legacy_parse(data, names):
+    """原先的解析方式: 建树, find消息类型, 再逐字段find"""
+    xml_data = ET.fromstring(data)
+    xml_data.find('MsgType').text
+    msg = LegacyMsg()
+    for name in ('ToUserName', 'FromUserName', 'CreateTime', 'MsgType'):
+        setattr(msg, name, xml_data.find(name).text)
+    msg_id = xml_data.find('MsgId')
+    msg.MsgId = msg_id.text if msg_id is not None else ''
+    for name in names:
+        element = xml_data.find(name)
+        setattr(msg, name, element.text if element is not None else '')
+    return msg
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('%-10s %12s %12s %8s' % ('type', 'legacy(us)', 'parse(us)', 'speedup'))
+    total_legacy = total_new = 0
+    for name, body in SAMPLES.items():
+        data = (HEAD + body + '</xml>').encode('utf-8')
+        names = LEGACY_FIELDS[name]
+        legacy = min(timeit.repeat(lambda: legacy_parse(data, names),
+                                   number=number, repeat=5))
+        new = min(timeit.repeat(lambda: receive.parse_xml(data),
+                                number=number, repeat=5))
+        total_legacy += legacy
+        total_new += new
+        print('%-10s %12.2f %12.2f %7.2fx' % (
+            name, legacy / number * 1e6, new / number * 1e6, legacy / new))
+    print('%-10s %12.2f %12.2f %7.2fx' % (
+        'all', total_legacy / number * 1e6, total_new / number * 1e6,
+        total_legacy / total_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+"""回复消息序列化性能测试
+
+对比原先反射__dict__构建ElementTree再tostring的方式与Msg.send()
+    使用的预编译模板
+
+    python benchmarks/bench_reply.py [次数]
+"""
+
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as et
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from my_app.main import reply  # noqa: E402
+
+
+def legacy_to_element(obj, root='xml'):
+    """原先的to_element, 只把unicode换成了str"""
+    e = et.Element(root)
+    for k in obj.__dict__:
+        if isinstance(getattr(obj, k), (str, int)):
+            if getattr(obj, k) != '':
+                sub_e = et.Element(k)
+                sub_e.text = str(getattr(obj, k))
+                e.append(sub_e)
+        elif isinstance(getattr(obj, k), type([])):
+            e_l = et.Element(k)
+            list_obj = getattr(obj, k)
+            for i in list_obj:
+                e_l.append(legacy_to_element(i, i.__class__.__name__))
+            e.append(e_l)
+        else:
+            e.append(legacy_to_element(getattr(obj, k), k))
+    return e
+
+
+def legacy_send(obj):
+    return et.tostring(legacy_to_element(obj), encoding='utf-8')
+
+
+def samples():
+    head = dict(ToUserName='oA1b2C3d4E5f6G7h8I9j0KlmnOpq',
+                FromUserName='gh_123456789abc')
+    article = reply.item('系统安装配置', '系统安装与配置, windows, linux',
+                         'https://img3.doubanio.com/view/photo/l/p1.webp',
+                         'http://wangmiao.site')
+    return [
+        ('text', reply.TextMsg('这是一条text消息', **head)),
+        ('image', reply.ImageMsg(reply.Image('m_ZbV0kyHBPbT1jwrn'), **head)),
+        ('voice', reply.VoiceMsg(reply.Voice('m_ZbV0kyHBPbT1jwrn'), **head)),
+        ('video', reply.VideoMsg(
+            reply.Video('m_ZbV0kyHBPbT1jwrn', 'test', 'just test'), **head)),
+        ('music', reply.MusicMsg(reply.Music(
+            'Nothing on yo', 'Beautiful girls all over the world',
+            'http://example.com/a.mp3', 'http://example.com/b.mp3',
+            '6QHtH_ihEVEblVDXdtDJZmG'), **head)),
+        ('news', reply.NewsMsg([article] * 3, **head)),
+    ]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('%-8s %12s %12s %8s' % ('type', 'legacy(us)', 'send(us)', 'speedup'))
+    total_legacy = total_new = 0
+    for name, msg in samples():
+        legacy = min(timeit.repeat(lambda: legacy_send(msg),
+                                   number=number, repeat=5))
+        new = min(timeit.repeat(msg.send, number=number, repeat=5))
+        total_legacy += legacy
+        total_new += new
+        print('%-8s %12.2f %12.2f %7.2fx' % (
+            name, legacy / number * 1e6, new / number * 1e6, legacy / new))
+    print('%-8s %12.2f %12.2f %7.2fx' % (
+        'all', total_legacy / number * 1e6, total_new / number * 1e6,
+        total_legacy / total_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,94 @@ def make_shell_context():
 manager = Manager(app)
 manager.add_command('shell', Shell(make_context=make_shell_context))
 
+
+@manager.command
+def upload_media(app_id, path, media_type='image'):
+    """批量上传目录下的所有文件为临时素材"""
+    from my_app.main import tools
+
+    files = [(name, os.path.join(path, name))
+             for name in sorted(os.listdir(path))
+             if os.path.isfile(os.path.join(path, name))]
+
+    def progress(done, total):
+        print('%d/%d' % (done, total))
+
+    result = tools.upload_media(app_id, files, media_type, progress)
+    for filename, error in result['failed']:
+        print('failed: %s %s' % (filename, error))
+    print('uploaded %d, failed %d' % (len(result['uploaded']),
+                                      len(result['failed'])))
+
+
+@manager.command
+def archive():
+    """归档过期的消息记录"""
+    from my_app.main.archive import archiver
+
+    count = archiver.archive()
+    if count is None:
+        print('another process is archiving')
+    else:
+        print('archived %d messages' % count)
+
+
+@manager.command
+def scan_messages(app_id, start, end):
+    """输出公众号在[start, end)日期内的消息, 包括已归档的, 日期如2018-01-01"""
+    import json
+    import time
+    from my_app.main.archive import archiver
+
+    start = int(time.mktime(time.strptime(start, '%Y-%m-%d')))
+    end = int(time.mktime(time.strptime(end, '%Y-%m-%d')))
+    for record in archiver.scan(app_id, start, end):
+        print(json.dumps(record, ensure_ascii=False))
+
+
+@manager.command
+def rebuild_rollups(app_id):
+    """从消息记录重新生成公众号的按小时消息数汇总"""
+    from my_app.main import rollup
+
+    print('%d rollup rows' % rollup.rebuild(app_id))
+
+
+@manager.command
+def rebuild_search():
+    """用数据库中的消息重新生成全文索引"""
+    from my_app.main.search import search_index
+
+    print('indexed %d messages' % search_index.rebuild())
+
+
+@manager.command
+def sync_users(app_id, full=False):
+    """同步公众号的订阅用户, 中断后再次执行从中断处继续"""
+    from my_app.main import users
+
+    def progress(state):
+        print('%d/%d listed, %d fetched' % (state.listed, state.total or 0,
+                                           state.fetched))
+
+    state = users.sync_users(app_id, full, progress)
+    print('synced %d users of %d' % (state.fetched, state.total or 0))
+
+
+@manager.command
+def run_broadcasts():
+    """发送未完成的群发任务, 直到全部发送或失败"""
+    import time
+    from my_app.main.broadcast import broadcaster
+
+    while True:
+        waiting = broadcaster.dispatch()
+        if not waiting:
+            break
+        print('%d chunks waiting' % waiting)
+        time.sleep(broadcaster.interval)
+    print('all broadcasts finished')
+
 # @manager.command
 # def test():
 #     """运行单元测试"""
@@ -5,6 +5,7 @@
 因此采用工厂函数的方式, 在运行时在初始化app
 """
 
+import os
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -36,8 +37,47 @@ def create_app(config_name):
     app.register_blueprint(wechat, url_prefix='/wechat')
     app.register_blueprint(blog)
 
-    # 初始化数据库
+    # 初始化缓存及后台任务
+    from my_app.main.cache import token_cache, reply_cache
+    from my_app.main.token_store import token_store
+    from my_app.main.writer import msg_writer
+    from my_app.main.refresher import token_refresher
+    from my_app.main.deadline import reply_runner
+    from my_app.main.content import content_warmer
+    from my_app.main.rules import rule_engine
+    from my_app.main.client import client
+    from my_app.main.storage import media_store
+    from my_app.main.archive import archiver, archive_worker
+    from my_app.main.rollup import msg_rollup
+    from my_app.main.seen import seen_users
+    from my_app.main.audience import tag_index
+    from my_app.main.broadcast import broadcaster
+    token_cache.init_app(app)
+    reply_cache.init_app(app)
+    token_store.init_app(app)
+    msg_writer.init_app(app)
+    token_refresher.init_app(app)
+    reply_runner.init_app(app)
+    content_warmer.init_app(app)
+    rule_engine.init_app(app)
+    client.init_app(app)
+    media_store.init_app(app)
+    archiver.init_app(app)
+    archive_worker.init_app(app)
+    msg_rollup.init_app(app)
+    seen_users.init_app(app)
+    tag_index.init_app(app)
+    broadcaster.init_app(app)
+
+    # 初始化数据库, 并把已有数据库迁移到最新版本, 创建全文索引.
+    # 多个worker进程同时启动时由迁移锁保证只有一个执行建表和迁移
+    from my_app import migrations
+    from my_app.main.search import search_index
     with app.app_context():
-        db.create_all()
+        with migrations.upgrade_lock(
+                db.engine, os.path.join(app.instance_path, 'schema.lock')):
+            db.create_all()
+            migrations.upgrade(db.engine)
+            search_index.init_app(app)
 
     return app
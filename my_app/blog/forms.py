@@ -2,7 +2,8 @@
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, \
-     BooleanField, SubmitField, FileField, SelectField, ValidationError
+     BooleanField, SubmitField, FileField, SelectField, TextAreaField, \
+     ValidationError
 from wtforms.validators import Required, Email, Length, EqualTo
 
 from my_app.models import Account
@@ -56,4 +57,28 @@ class AddMediaForm(FlaskForm):
     media_type = SelectField('选择素材类型',
         choices=[('image', '图片'), ('voice', '语音'), ('video', '视频'),
         ('thumb', '缩略图')])
-    submit = SubmitField('提交')
\ No newline at end of file
+    submit = SubmitField('提交')
+
+
+class AddRuleForm(FlaskForm):
+    """
+    添加自动回复规则表单
+    """
+    keyword = StringField('关键词', validators=[Required(), Length(1, 255)])
+    match_type = SelectField('匹配方式',
+        choices=[('exact', '全文匹配'), ('prefix', '前缀匹配'),
+        ('contains', '包含匹配')])
+    content = StringField('回复内容', validators=[Required(), Length(1, 255)])
+    submit = SubmitField('添加')
+
+
+class BroadcastForm(FlaskForm):
+    """
+    群发消息表单, 素材的选项由视图按公众号设置
+    """
+    audience_type = SelectField('受众类型',
+        choices=[('tag', '标签表达式'), ('openids', 'openid列表')])
+    audience = TextAreaField('受众', validators=[Required()])
+    media = SelectField('素材', coerce=int)
+    content = TextAreaField('文本内容', validators=[Length(0, 2000)])
+    submit = SubmitField('群发')
@@ -1,6 +1,8 @@
 # coding: utf-8
 
+import datetime as dt
 import os
+import time
 
 from flask import request, Blueprint, render_template, redirect, flash, \
     url_for, current_app
@@ -10,10 +12,17 @@ from werkzeug import secure_filename
 import requests
 
 from my_app.blog.forms import LoginForm, RegisterForm, AddWechatForm, \
-    AddMediaForm
-from my_app.models import Account, Token, Media
+    AddMediaForm, AddRuleForm, BroadcastForm
+from my_app.models import Account, Token, Media, Rule, Broadcast
 from my_app import db
 import my_app.main.tools as tools
+from my_app.main.cache import token_cache
+from my_app.main.rules import rule_engine
+from my_app.main import rollup
+from my_app.main.search import search_index
+from my_app.main.audience import tag_index
+from my_app.main import broadcast as mass
+from my_app.main.client import client
 
 
 blog = Blueprint('blog', __name__)
@@ -140,6 +149,7 @@ def add_wechat():
 
         db.session.add(t)
         db.session.commit()
+        token_cache.invalidate(app_id=app_id, wechat_id=wechat_id)
 
         flash('添加公众号成功!', 'success')
         return redirect(url_for('blog.index'))
@@ -170,19 +180,21 @@ def add_media(app_id):
     form = AddMediaForm(request.form)
     if form.validate_on_submit():
         media_type = request.form.get('media_type')
-        media_file = request.files['media_file']
+        media_files = [(f.filename, f.stream)
+                       for f in request.files.getlist('media_file')
+                       if f.filename]
 
         try:
-            res = tools.upload_media(app_id, media_file, media_type)
-        except KeyError as e:
-            print('keyerror')
-            flash(res.text, 'danger')
+            result = tools.upload_media(app_id, media_files, media_type)
         except Exception as e:
             flash(str(e), 'danger')
         else:
-            flash(unicode(media_file.filename) + '上传成功', 'success')
-        finally:
-            return redirect(url_for('blog.add_media', app_id=app_id))
+            for filename, error in result['failed']:
+                flash(filename + '上传失败: ' + error, 'danger')
+            if result['uploaded']:
+                flash('%d个文件上传成功' % len(result['uploaded']),
+                      'success')
+        return redirect(url_for('blog.add_media', app_id=app_id))
 
     if form.errors:
         flash(form.errors, 'danger')
@@ -201,23 +213,194 @@ def is_allowed(filename, file_type):
 
 @blog.route('/show_media/<app_id>')
 def show_media(app_id):
-    image = Media.query.filter_by(app_id=app_id, media_type='image').all()
-    voice = Media.query.filter_by(app_id=app_id, media_type='voice').all()
-    video = Media.query.filter_by(app_id=app_id, media_type='video').all()
-    thumb = Media.query.filter_by(app_id=app_id, media_type='thumb').all()
-    return render_template('blog/show-media.html',
-                           image=image, voice=voice, video=video,
-                           thumb=thumb, app_id=app_id)
+    """
+    分类型分页显示公众号的素材,
+    地址参数<类型>_after为该类型上一页最后一个素材的id
+    """
+    cursors = {}
+    for media_type in tools.MEDIA_TYPES:
+        after = request.args.get(media_type + '_after', 0, type=int)
+        if after:
+            cursors[media_type] = after
+    active = request.args.get('type', 'image')
+    pages = tools.media_page(app_id, cursors,
+                             current_app.config['MEDIA_PAGE_SIZE'])
+
+    # 翻页链接保留其他类型的当前页
+    args = dict((t + '_after', after) for t, after in cursors.items())
+    for media_type, page in pages.items():
+        page['first_url'] = page['next_url'] = None
+        if media_type in cursors:
+            first = dict(args)
+            del first[media_type + '_after']
+            page['first_url'] = url_for('blog.show_media', app_id=app_id,
+                                        type=media_type, **first)
+        if page['next'] is not None:
+            next_args = dict(args)
+            next_args[media_type + '_after'] = page['next']
+            page['next_url'] = url_for('blog.show_media', app_id=app_id,
+                                       type=media_type, **next_args)
+
+    return render_template('blog/show-media.html', pages=pages,
+                           active=active, app_id=app_id)
 
 
 @blog.route('/get_media/<app_id>')
 def get_media(app_id):
     media_id = request.args.get('media_id')
-    response = tools.download_media(app_id, media_id)
+    inline = request.args.get('inline') == '1'
+    response = tools.download_media(app_id, media_id,
+                                    as_attachment=not inline)
     return response
 
 
 @blog.route('/update_media/<app_id>')
 def update_media(app_id):
-    tools.update_media(app_id)
+    result = tools.update_media(app_id)
+    flash('共%d个未到期素材, 本地已有%d个, 下载%d个, 失败%d个' % (
+        result['total'], result['skipped'], result['downloaded'],
+        len(result['failed'])), 'danger' if result['failed'] else 'success')
     return redirect(url_for('blog.show_media', app_id=app_id))
+
+
+@blog.route('/rules/<app_id>', methods=['GET', 'POST'])
+@login_required
+def rules(app_id):
+    """
+    自动回复规则视图, 列出并添加公众号的关键词回复规则
+    """
+    form = AddRuleForm(request.form)
+    if form.validate_on_submit():
+        rule = Rule()
+        rule.keyword = form.keyword.data
+        rule.match_type = form.match_type.data
+        rule.content = form.content.data
+        rule.app_id = app_id
+
+        db.session.add(rule)
+        db.session.commit()
+        rule_engine.invalidate(app_id)
+
+        flash('添加规则成功!', 'success')
+        return redirect(url_for('blog.rules', app_id=app_id))
+
+    if form.errors:
+        flash(form.errors, 'danger')
+
+    rule_list = Rule.query.filter_by(app_id=app_id).order_by(Rule.id).all()
+    return render_template('blog/rules.html', app_id=app_id, form=form,
+                           rule_list=rule_list)
+
+
+@blog.route('/rules/<app_id>/delete/<int:rule_id>', methods=['POST'])
+@login_required
+def delete_rule(app_id, rule_id):
+    Rule.query.filter_by(app_id=app_id, id=rule_id).delete()
+    db.session.commit()
+    rule_engine.invalidate(app_id)
+    return redirect(url_for('blog.rules', app_id=app_id))
+
+
+@blog.route('/stats/<app_id>')
+@login_required
+def stats(app_id):
+    """
+    消息统计视图, 显示最近days天每小时的接收消息数及各类型的消息数
+    """
+    days = request.args.get('days', 30, type=int)
+    today = dt.date.today()
+    start = int(time.mktime((today - dt.timedelta(days=days - 1))
+                            .timetuple()))
+    end = int(time.mktime((today + dt.timedelta(days=1)).timetuple()))
+
+    hours = rollup.hourly_counts(app_id, start, end)
+    # 按天分行, 每行24个小时
+    rows = []
+    for hour, count in hours:
+        day = dt.date.fromtimestamp(hour)
+        if not rows or rows[-1][0] != day:
+            rows.append((day, []))
+        rows[-1][1].append(count)
+
+    return render_template('blog/stats.html', app_id=app_id, days=days,
+                           rows=rows, total=sum(c for h, c in hours),
+                           types=rollup.type_counts(app_id, start, end))
+
+
+
+@blog.route('/client-stats')
+@login_required
+def client_stats():
+    """
+    微信接口调用统计视图, 显示处理本次请求的进程中每个接口的请求次数,
+        失败次数及平均和最长耗时
+    """
+    stats = sorted(client.stats().items())
+    return render_template('blog/client_stats.html', stats=stats,
+                           pid=os.getpid())
+
+@blog.route('/search/<app_id>')
+@login_required
+def search(app_id):
+    """
+    消息搜索视图, 按相关度分页显示包含搜索词的消息
+    """
+    q = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    hits, has_next = search_index.search(
+        app_id, q, page, current_app.config['SEARCH_PAGE_SIZE'])
+    return render_template('blog/search.html', app_id=app_id, q=q,
+                           page=page, hits=hits, has_next=has_next)
+
+
+@blog.route('/audience/<app_id>')
+@login_required
+def audience(app_id):
+    """
+    受众筛选视图, 按标签表达式统计用户数并预览部分openid
+    """
+    q = request.args.get('q', '')
+    count, openids = None, []
+    if q:
+        try:
+            count = tag_index.count(app_id, q)
+            openids = tag_index.openids(
+                app_id, q, current_app.config['AUDIENCE_PREVIEW_SIZE'])
+        except ValueError as e:
+            flash('标签表达式有误: %s' % e, 'warning')
+    return render_template('blog/audience.html', app_id=app_id, q=q,
+                           count=count, openids=openids)
+
+
+@blog.route('/broadcast/<app_id>', methods=['GET', 'POST'])
+@login_required
+def broadcast(app_id):
+    """
+    群发消息视图, 创建群发任务并列出最近任务的发送进度, 发送在后台进行
+    """
+    form = BroadcastForm(request.form)
+    medias = Media.query.filter(
+        Media.app_id == app_id, Media.media_type.in_(mass.MSG_TYPES)
+    ).order_by(Media.id.desc()).limit(100)
+    form.media.choices = [(0, '文本消息')] + [
+        (m.id, '%s: %s' % (m.media_type, m.title or m.media_id))
+        for m in medias]
+    if form.validate_on_submit():
+        media = Media.query.get(form.media.data) if form.media.data else None
+        try:
+            mass.create_broadcast(app_id, form.audience_type.data,
+                                  form.audience.data, form.content.data,
+                                  media)
+        except ValueError as e:
+            flash('创建群发任务失败: %s' % e, 'danger')
+        else:
+            flash('群发任务已创建, 将在后台发送', 'success')
+            return redirect(url_for('blog.broadcast', app_id=app_id))
+
+    if form.errors:
+        flash(form.errors, 'danger')
+
+    broadcasts = Broadcast.query.filter_by(app_id=app_id) \
+        .order_by(Broadcast.id.desc()).limit(20).all()
+    return render_template('blog/broadcast.html', app_id=app_id, form=form,
+                           broadcasts=broadcasts)
@@ -3,6 +3,9 @@
 import os
 
 base_dir = os.path.join(os.path.dirname(__file__))
+# 运行时生成的文件放在包外的instance目录, 与Flask默认的instance_path一致
+instance_dir = os.path.join(os.path.dirname(os.path.abspath(base_dir)),
+                            'instance')
 
 
 class Config(object):
@@ -37,6 +40,18 @@ class Config(object):
     UPDATE_NEWS_URL = \
         'https://api.weixin.qq.com/cgi-bin/material/update_news'
 
+    # 客服消息地址
+    CUSTOM_SEND_URL = 'https://api.weixin.qq.com/cgi-bin/message/custom/send'
+
+    # 群发消息地址
+    MASS_SEND_URL = 'https://api.weixin.qq.com/cgi-bin/message/mass/send'
+
+    # 用户管理地址
+    USER_GET_URL = 'https://api.weixin.qq.com/cgi-bin/user/get'
+    USER_BATCHGET_URL = \
+        'https://api.weixin.qq.com/cgi-bin/user/info/batchget'
+    TAG_GET_URL = 'https://api.weixin.qq.com/cgi-bin/tags/get'
+
     # 菜单管理地址
     CREATE_MENU = ' https://api.weixin.qq.com/cgi-bin/menu/create'
     GET_MENU = 'https://api.weixin.qq.com/cgi-bin/menu/get'
@@ -45,10 +60,109 @@ class Config(object):
     # 文件上传配置
     UPLOAD_FOLDER = os.path.join(os.path.dirname(
         __file__), 'static/uploads').replace('\\', '/')
+    # 上传和下载中的临时文件目录, 不能在static目录下, 否则可以被公开访问.
+    # 应与UPLOAD_FOLDER在同一文件系统, 完成后原子地移入
+    MEDIA_TMP_FOLDER = os.environ.get(
+        'MEDIA_TMP_FOLDER', os.path.join(instance_dir, 'media_tmp'))
     ALLOWED_IMAGE = set(['png', 'jpg', 'jpeg', 'gif'])
+    # 素材页每种类型每页显示的素材数
+    MEDIA_PAGE_SIZE = 20
+    # 批量更新临时素材的并发下载数
+    MEDIA_SYNC_WORKERS = 4
+    # 批量上传临时素材的并发上传数
+    MEDIA_UPLOAD_WORKERS = 4
+    # 素材下载分块字节数及中断后的续传次数
+    MEDIA_CHUNK_SIZE = 65536
+    MEDIA_DOWNLOAD_RETRIES = 2
+    # 素材文件发送方式, 为空时由应用发送, sendfile使用X-Sendfile,
+    # accel使用nginx的X-Accel-Redirect, 对应的internal location为
+    # MEDIA_ACCEL_PREFIX, 指向UPLOAD_FOLDER
+    MEDIA_SERVE_MODE = os.environ.get('MEDIA_SERVE_MODE', '')
+    MEDIA_ACCEL_PREFIX = '/protected/uploads/'
+    MEDIA_CACHE_TIMEOUT = 86400
     # 设置sqlalchemy一些参数
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
+    # 微信接口HTTP客户端, 超时秒数及连接池大小
+    HTTP_CONNECT_TIMEOUT = 3.05
+    HTTP_READ_TIMEOUT = 30
+    HTTP_POOL_CONNECTIONS = 4
+    HTTP_POOL_MAXSIZE = 16
+    HTTP_MAX_RETRIES = 2
+    # 公众号信息缓存有效秒数
+    TOKEN_CACHE_TTL = 300
+    # access_token后台提前刷新, 在过期前TOKEN_REFRESH_AHEAD秒内刷新,
+    # 另加不超过TOKEN_REFRESH_JITTER秒的随机提前量
+    TOKEN_REFRESHER = os.environ.get('TOKEN_REFRESHER') == '1'
+    TOKEN_REFRESH_AHEAD = 600
+    TOKEN_REFRESH_JITTER = 120
+    TOKEN_REFRESH_INTERVAL = 30
+    # 多进程共享的access_token存储文件, 设为空字符串则不启用
+    TOKEN_STORE_PATH = os.environ.get(
+        'TOKEN_STORE_PATH', os.path.join(instance_dir, 'token_store.db'))
+    # 微信重试推送排重, 缓存每条消息的回复, 重试请求最多等待
+    # REPLY_WAIT_TIMEOUT秒获取正在处理的回复
+    REPLY_CACHE_SIZE = 10000
+    REPLY_CACHE_TTL = 60
+    REPLY_WAIT_TIMEOUT = 4.5
+    # 被动回复时限秒数, 超时后改用客服消息发送, 为空则不限时
+    REPLY_DEADLINE = float(os.environ.get('REPLY_DEADLINE') or 0) or None
+    REPLY_WORKERS = 8
+    # 第三方内容后台预热
+    CONTENT_WARMER = os.environ.get('CONTENT_WARMER') == '1'
+    CONTENT_WARM_INTERVAL = 60
+    # 自动回复规则缓存秒数, 其他进程修改的规则最多在这个时间后生效
+    RULE_CACHE_TTL = 60
+    # 消息记录批量写入, 打开后消息先进入内存缓冲, 由后台线程批量写库
+    MSG_WRITE_BEHIND = os.environ.get('MSG_WRITE_BEHIND') == '1'
+    MSG_BATCH_SIZE = 200
+    MSG_FLUSH_INTERVAL = 1.0
+    # 接收消息按小时汇总计数, 打开MSG_ROLLUP后每隔ROLLUP_FLUSH_INTERVAL秒
+    # 写入数据库, 之前的消息用manager.py rebuild_rollups补上
+    MSG_ROLLUP = os.environ.get('MSG_ROLLUP') == '1'
+    ROLLUP_FLUSH_INTERVAL = 10
+    # 消息搜索每页结果数
+    SEARCH_PAGE_SIZE = 20
+    # 订阅用户同步, 资料超过USER_SYNC_STALE_DAYS天的用户重新获取,
+    # 批量获取用户资料的并发数及每秒调用次数
+    USER_SYNC_STALE_DAYS = 7
+    USER_SYNC_WORKERS = 4
+    USER_SYNC_RATE = 20
+    # 用户标签位图索引有效秒数, 其他进程修改的标签最多在这个时间后生效
+    TAG_INDEX_TTL = 300
+    # 受众预览最多显示的openid数
+    AUDIENCE_PREVIEW_SIZE = 100
+    # 群发任务, 打开BROADCASTER后由后台线程发送, 否则用manager.py
+    # run_broadcasts发送. 每批最多BROADCAST_CHUNK_SIZE个用户, 每个公众号
+    # 每秒最多调用BROADCAST_RATE次群发接口, 失败的批次等待
+    # BROADCAST_RETRY_DELAY秒后重试, 每次重试等待时间加倍
+    BROADCASTER = os.environ.get('BROADCASTER') == '1'
+    BROADCAST_INTERVAL = 5
+    BROADCAST_CHUNK_SIZE = 10000
+    BROADCAST_RATE = 1
+    BROADCAST_MAX_ATTEMPTS = 5
+    BROADCAST_RETRY_DELAY = 30
+    # 发送中的批次超过这个秒数未完成, 视为进程中断, 重新发送
+    BROADCAST_CLAIM_TIMEOUT = 600
+    # 新用户发现, 打开SEEN_USERS后按公众号用布隆过滤器记录已知的openid,
+    # 接收消息时发现的新openid由后台线程批量创建用户并获取资料.
+    # 过滤器保存在SEEN_FOLDER, 启动时加载并补上之后新增的用户
+    SEEN_USERS = os.environ.get('SEEN_USERS') == '1'
+    SEEN_FOLDER = os.environ.get('SEEN_FOLDER') or \
+        os.path.join(base_dir, 'seen')
+    SEEN_ERROR_RATE = 0.001
+    SEEN_MIN_CAPACITY = 100000
+    SEEN_INTERVAL = 5
+    SEEN_BATCH_SIZE = 500
+    SEEN_SAVE_INTERVAL = 300
+    # 消息记录归档, 早于ARCHIVE_AFTER_DAYS天的消息按公众号和月份压缩
+    # 归档到ARCHIVE_FOLDER, 打开MSG_ARCHIVER后由后台线程定期归档
+    MSG_ARCHIVER = os.environ.get('MSG_ARCHIVER') == '1'
+    ARCHIVE_FOLDER = os.environ.get('ARCHIVE_FOLDER') or \
+        os.path.join(base_dir, 'archive')
+    ARCHIVE_AFTER_DAYS = 90
+    ARCHIVE_BATCH_SIZE = 5000
+    ARCHIVE_INTERVAL = 3600
     # LOG_PATH = os.path.join(base_dir, 'log.log').replace('\\', '/')
     # # 配置email使正常发送
     # MAIL_SERVER = 'smtp.126.com'
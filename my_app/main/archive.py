@@ -0,0 +1,347 @@
+# coding: utf-8
+
+"""消息记录归档模块
+
+归档中的消息按公众号和月份分区, 创建时间早于ARCHIVE_AFTER_DAYS天的
+    消息写入ARCHIVE_FOLDER/<公众号原始id>/<年-月>.jsonl.gz归档段, 然后
+    从数据库中删除消息及其事件和地理位置记录. 数据库中的msg表本身不分区,
+    只保留未归档的消息, 按id顺序分批归档和删除.
+    消息引用的素材完整写入归档, 删除消息后不再被其他消息或群发任务
+    引用的素材连同图文条目一起删除, 素材的本地文件保留.
+    归档段只追加, 每批写入一个新的gzip member, 已写入的数据不会再改动.
+    写入中断时末尾的member可能不完整, 读取时跳过
+"""
+
+import collections
+import contextlib
+import datetime as dt
+import gzip
+import json
+import os
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # windows下没有fcntl, 不能防止多个进程同时归档
+    fcntl = None
+
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+
+from my_app import db
+from my_app.models import Msg, Event, Location, Media, Item, Token, \
+    Broadcast
+from .background import Worker
+from .cache import token_cache
+
+
+# 无法确定所属公众号的消息的归档目录
+UNKNOWN_ACCOUNT = '_unknown'
+# 读取归档段时每次读取的字节数
+READ_SIZE = 65536
+
+
+def to_record(m, account, items=None):
+    """把消息记录转换为可以json序列化的字典
+
+    Args:
+        m (Msg): 消息记录
+        account (str): 消息所属公众号的原始id
+        items (dict, optional): 图文素材id到条目字典列表的映射
+
+    Returns:
+        dict: 消息的各个字段, 事件, 地理位置和素材展开为子字典,
+            图文素材的条目在items中时一并写入
+    """
+    record = _columns(m)
+    record['account'] = account
+    for name in ('event_id', 'location_id', 'media_id'):
+        del record[name]
+    if m.event is not None:
+        record['event'] = _columns(m.event)
+    if m.location is not None:
+        record['location'] = _columns(m.location)
+    if m.media is not None:
+        record['media'] = _columns(m.media)
+        if items and m.media.id in items:
+            record['media']['items'] = items[m.media.id]
+    return record
+
+
+def _news_items(media_ids):
+    """图文素材id到条目字典列表的映射"""
+    items = collections.defaultdict(list)
+    if media_ids:
+        for item in Item.query.filter(Item.article_id.in_(media_ids)) \
+                .order_by(Item.id):
+            record = _columns(item)
+            del record['article_id']
+            items[item.article_id].append(record)
+    return items
+
+
+def _columns(obj):
+    return dict((c.name, getattr(obj, c.name))
+                for c in obj.__table__.columns)
+
+
+class Archiver(object):
+    """消息记录归档
+
+    Attributes:
+        folder (str): 归档目录
+        after_days (int): 归档多少天之前的消息
+        batch_size (int): 每批归档的消息数
+    """
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.after_days = 90
+        self.batch_size = 5000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['ARCHIVE_FOLDER']
+        self.after_days = app.config['ARCHIVE_AFTER_DAYS']
+        self.batch_size = app.config['ARCHIVE_BATCH_SIZE']
+
+    def segment_path(self, account, month):
+        return os.path.join(self.folder, account, month + '.jsonl.gz')
+
+    def archive(self, before=None):
+        """归档before之前创建的消息, 需在应用上下文中调用
+
+        其他进程正在归档时直接返回
+
+        Args:
+            before (int, optional): 时间戳, 默认为ARCHIVE_AFTER_DAYS天前
+
+        Returns:
+            int: 归档的消息数, 其他进程正在归档时返回None
+        """
+        if before is None:
+            before = int(time.time()) - self.after_days * 86400
+        with self._lock() as locked:
+            if not locked:
+                return None
+            accounts = set(row[0] for row in
+                           db.session.query(Token.wechat_id))
+            total = 0
+            while True:
+                count = self._archive_batch(before, accounts)
+                total += count
+                if count < self.batch_size:
+                    return total
+
+    def _archive_batch(self, before, accounts):
+        msgs = Msg.query.options(
+            joinedload(Msg.event), joinedload(Msg.location),
+            joinedload(Msg.media)
+        ).filter(Msg.create_time < before) \
+            .order_by(Msg.id).limit(self.batch_size).all()
+        if not msgs:
+            return 0
+
+        media_ids = set(m.media_id for m in msgs if m.media_id is not None)
+        items = _news_items([m.media.id for m in msgs if m.media is not None
+                             and m.media.media_type == 'news'])
+        segments = collections.defaultdict(list)
+        for m in msgs:
+            if m.to_username in accounts:
+                account = m.to_username
+            elif m.from_username in accounts:
+                account = m.from_username
+            else:
+                account = UNKNOWN_ACCOUNT
+            month = time.strftime('%Y-%m', time.localtime(m.create_time))
+            segments[(account, month)].append(to_record(m, account, items))
+
+        # 先写入归档并落盘, 再删除数据库记录. 两者之间中断时下次会重复
+        # 归档同一批消息, 读取时按id去重
+        for (account, month), records in segments.items():
+            path = self.segment_path(account, month)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = ''.join(json.dumps(r, ensure_ascii=False) + '\n'
+                           for r in records).encode('utf-8')
+            with open(path, 'ab') as f:
+                f.write(gzip.compress(data))
+                f.flush()
+                os.fsync(f.fileno())
+
+        ids = [m.id for m in msgs]
+        event_ids = [m.event_id for m in msgs if m.event_id is not None]
+        location_ids = [m.location_id for m in msgs
+                        if m.location_id is not None]
+        db.session.expunge_all()
+        Msg.query.filter(Msg.id.in_(ids)).delete(synchronize_session=False)
+        if event_ids:
+            Event.query.filter(Event.id.in_(event_ids)) \
+                .delete(synchronize_session=False)
+        if location_ids:
+            Location.query.filter(Location.id.in_(location_ids)) \
+                .delete(synchronize_session=False)
+        if media_ids:
+            orphans = list(media_ids - _referenced_media(media_ids))
+            if orphans:
+                Item.query.filter(Item.article_id.in_(orphans)) \
+                    .delete(synchronize_session=False)
+                Media.query.filter(Media.id.in_(orphans)) \
+                    .delete(synchronize_session=False)
+        db.session.commit()
+        return len(msgs)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """多个进程同时只有一个在归档, 获得锁时返回True"""
+        os.makedirs(self.folder, exist_ok=True)
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.folder, '.lock'), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def scan(self, app_id, start, end):
+        """按时间顺序读取公众号在[start, end)时间内的所有消息
+
+        先读取归档段, 再读取数据库中尚未归档的消息, 需在应用上下文中调用
+
+        Args:
+            app_id (str): 公众号app_id
+            start (int): 开始时间戳
+            end (int): 结束时间戳
+
+        Returns:
+            generator: to_record格式的消息字典
+        """
+        t = token_cache.get(app_id=app_id)
+        if t is None:
+            return
+        seen = set()
+        for month in _months(start, end):
+            path = self.segment_path(t.wechat_id, month)
+            if not os.path.exists(path):
+                continue
+            records = []
+            for r in read_segment(path):
+                if start <= r['create_time'] < end and r['id'] not in seen:
+                    seen.add(r['id'])
+                    records.append(r)
+            records.sort(key=lambda r: (r['create_time'], r['id']))
+            for r in records:
+                yield r
+
+        query = Msg.query.options(
+            joinedload(Msg.event), joinedload(Msg.location),
+            joinedload(Msg.media)
+        ).filter(
+            or_(Msg.to_username == t.wechat_id,
+                Msg.from_username == t.wechat_id),
+            Msg.create_time >= start, Msg.create_time < end
+        ).order_by(Msg.create_time, Msg.id)
+        for m in query.yield_per(self.batch_size):
+            if m.id not in seen:
+                yield to_record(m, t.wechat_id)
+
+
+def read_segment(path):
+    """逐个gzip member读取归档段中的记录
+
+    归档写入中断时最后一个member可能不完整, 读到不完整或损坏的member时
+        停止, 只返回之前完整的member中的记录. 这些消息仍在数据库中,
+        下次归档时会重新写入
+
+    Args:
+        path (str): 归档段路径
+
+    Returns:
+        generator: to_record格式的消息字典
+    """
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return
+    with f:
+        d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        out = []
+        data = b''
+        while True:
+            if not data:
+                try:
+                    data = f.read(READ_SIZE)
+                except (IOError, OSError):
+                    return
+                if not data:
+                    return
+            try:
+                out.append(d.decompress(data))
+            except zlib.error:
+                return
+            if not d.eof:
+                data = b''
+                continue
+            for line in b''.join(out).decode('utf-8').splitlines():
+                yield json.loads(line)
+            data = d.unused_data
+            d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            out = []
+
+
+def _referenced_media(media_ids):
+    """仍被数据库中的消息或群发任务引用的素材id"""
+    media_ids = list(media_ids)
+    referenced = set()
+    for column in (Msg.media_id, Broadcast.media_id):
+        referenced.update(pk for pk, in db.session.query(column)
+                          .filter(column.in_(media_ids)).distinct())
+    return referenced
+
+
+def _months(start, end):
+    """[start, end)时间内的所有月份, 如2018-01"""
+    first = dt.date.fromtimestamp(start).replace(day=1)
+    last = dt.date.fromtimestamp(max(start, end - 1))
+    months = []
+    while first <= last:
+        months.append(first.strftime('%Y-%m'))
+        first = (first + dt.timedelta(days=32)).replace(day=1)
+    return months
+
+
+archiver = Archiver()
+
+
+class ArchiveWorker(Worker):
+    """消息记录定期归档线程
+
+    每隔ARCHIVE_INTERVAL秒归档一次过期的消息
+
+    Attributes:
+        enabled (bool): 是否启用定期归档
+    """
+
+    def __init__(self, app=None):
+        super(ArchiveWorker, self).__init__(app)
+        self.enabled = False
+
+    def init_app(self, app):
+        super(ArchiveWorker, self).init_app(app)
+        self.enabled = app.config['MSG_ARCHIVER']
+        self.interval = app.config['ARCHIVE_INTERVAL']
+        if self.enabled:
+            app.before_first_request(self.start)
+
+    def run_once(self):
+        archiver.archive()
+
+
+archive_worker = ArchiveWorker()
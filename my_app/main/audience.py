@@ -0,0 +1,475 @@
+# coding: utf-8
+
+"""用户标签位图索引
+
+每个公众号在内存中为每个标签保存一个位图, 第i位表示id为i的用户有这个
+    标签, 另有一个位图记录公众号的全部用户. 位图按65536位分块, 只保存
+    非空的块, 块内用python整数做位运算. 按标签组合筛选用户时只做位图的
+    与或非运算, 不必多次连接tags表
+"""
+
+import re
+import threading
+import time
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+
+from my_app import db
+from my_app.models import User, Tag, tags
+
+
+# 每块的位数
+CHUNK_BITS = 1 << 16
+# 按id查找openid时每次查询的id数
+LOOKUP_SIZE = 1000
+
+
+class Bitmap(object):
+    """分块压缩的位图
+
+    Attributes:
+        chunks (dict): 块号到块内位的映射, 空块不保存
+    """
+
+    __slots__ = ('chunks',)
+
+    def __init__(self):
+        self.chunks = {}
+
+    @classmethod
+    def from_ids(cls, ids):
+        """从id序列生成位图, 先在bytearray中置位, 每块只转换一次整数"""
+        buffers = {}
+        for i in ids:
+            key, bit = divmod(i, CHUNK_BITS)
+            buf = buffers.get(key)
+            if buf is None:
+                buf = buffers[key] = bytearray(CHUNK_BITS // 8)
+            buf[bit >> 3] |= 1 << (bit & 7)
+        bitmap = cls()
+        for key, buf in buffers.items():
+            bitmap.chunks[key] = int.from_bytes(buf, 'little')
+        return bitmap
+
+    def add(self, i):
+        key, bit = divmod(i, CHUNK_BITS)
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << bit)
+
+    def discard(self, i):
+        key, bit = divmod(i, CHUNK_BITS)
+        chunk = self.chunks.get(key, 0) & ~(1 << bit)
+        if chunk:
+            self.chunks[key] = chunk
+        else:
+            self.chunks.pop(key, None)
+
+    def __contains__(self, i):
+        key, bit = divmod(i, CHUNK_BITS)
+        return bool(self.chunks.get(key, 0) >> bit & 1)
+
+    def __and__(self, other):
+        result = Bitmap()
+        for key, chunk in self.chunks.items():
+            chunk &= other.chunks.get(key, 0)
+            if chunk:
+                result.chunks[key] = chunk
+        return result
+
+    def __or__(self, other):
+        result = Bitmap()
+        result.chunks = dict(self.chunks)
+        for key, chunk in other.chunks.items():
+            result.chunks[key] = result.chunks.get(key, 0) | chunk
+        return result
+
+    def __sub__(self, other):
+        result = Bitmap()
+        for key, chunk in self.chunks.items():
+            chunk &= ~other.chunks.get(key, 0)
+            if chunk:
+                result.chunks[key] = chunk
+        return result
+
+    def __len__(self):
+        return sum(bin(chunk).count('1') for chunk in self.chunks.values())
+
+    def __iter__(self):
+        """按从小到大的顺序返回所有为1的位"""
+        for key in sorted(self.chunks):
+            data = self.chunks[key].to_bytes(CHUNK_BITS // 8, 'little')
+            base = key * CHUNK_BITS
+            for pos, byte in enumerate(data):
+                if not byte:
+                    continue
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield base + pos * 8 + bit
+
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+_TAG_ID = re.compile(r'#(\d+)$')
+
+
+def tokenize(expr):
+    """把标签表达式拆分为(类型, 值)列表, 类型为(, ), op, tag, tagid
+
+    #加数字为微信的标签id, 值为整数, 其余的词及双引号括起的都是标签名
+    """
+    result = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        m = _TOKEN.match(expr, pos)
+        if m is None:
+            raise ValueError('invalid expression at %d: %s' % (pos, expr))
+        pos = m.end()
+        lparen, rparen, quoted, word = m.groups()
+        if lparen:
+            result.append(('(', lparen))
+        elif rparen:
+            result.append((')', rparen))
+        elif quoted is not None:
+            result.append(('tag', re.sub(r'\\(.)', r'\1', quoted)))
+        elif word.upper() in ('AND', 'OR', 'NOT'):
+            result.append(('op', word.upper()))
+        elif _TAG_ID.match(word):
+            result.append(('tagid', int(word[1:])))
+        else:
+            result.append(('tag', word))
+    return result
+
+
+def parse(expr):
+    """解析标签表达式
+
+    支持AND, OR, NOT和括号, 优先级NOT > AND > OR, 标签可以是标签名或
+        #加微信的标签id, 含空格的标签名用双引号括起, 如
+        "VIP 用户" AND (北京 OR 上海) AND NOT #101
+
+    Args:
+        expr (str): 标签表达式
+
+    Returns:
+        tuple: 语法树, 节点为('tag', 标签名), ('tagid', 微信标签id),
+            ('not', 节点), ('and', 左节点, 右节点), ('or', 左节点, 右节点)
+    """
+    tokens = tokenize(expr)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def take():
+        token = peek()
+        pos[0] += 1
+        return token
+
+    def parse_or():
+        node = parse_and()
+        while peek() == ('op', 'OR'):
+            take()
+            node = ('or', node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() == ('op', 'AND'):
+            take()
+            node = ('and', node, parse_not())
+        return node
+
+    def parse_not():
+        if peek() == ('op', 'NOT'):
+            take()
+            return ('not', parse_not())
+        kind, value = take()
+        if kind == '(':
+            node = parse_or()
+            if take()[0] != ')':
+                raise ValueError('missing ) in %s' % expr)
+            return node
+        if kind in ('tag', 'tagid'):
+            return (kind, value)
+        raise ValueError('unexpected %s in %s' % (value, expr))
+
+    node = parse_or()
+    if pos[0] != len(tokens):
+        raise ValueError('unexpected %s in %s' % (peek()[1], expr))
+    return node
+
+
+class AppIndex(object):
+    """一个公众号的用户及标签位图
+
+    Attributes:
+        built_at (float): 生成时间戳
+        max_user_id (int): 已检查过的最大用户id, 包括其他公众号的用户
+        tags (dict): Tag.id到位图的映射
+        users (Bitmap): 公众号的全部用户
+    """
+
+    def __init__(self):
+        self.users = Bitmap()
+        self.tags = {}
+        self.max_user_id = 0
+        self.built_at = time.time()
+
+    def tag(self, tag_id):
+        bitmap = self.tags.get(tag_id)
+        if bitmap is None:
+            bitmap = self.tags[tag_id] = Bitmap()
+        return bitmap
+
+
+class TagIndex(object):
+    """按公众号缓存的标签位图索引
+
+    第一次查询时从数据库生成, 本进程通过ORM修改User.tags, 新建和
+        删除用户时在事务提交后更新位图; 批量插入的用户在每次查询前补上.
+        其他进程对标签的修改在TAG_INDEX_TTL秒后重新生成时生效.
+        生成索引时不持有锁, 不阻塞其他线程提交事务
+
+    Attributes:
+        ttl (int): 索引有效秒数
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._indexes = {}
+        # 公众号到正在生成的索引的变化列表的映射, 每个生成中的索引一个列表
+        self._building = {}
+        self._lock = threading.RLock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['TAG_INDEX_TTL']
+
+    def get_index(self, app_id):
+        """获取公众号的索引, 需在应用上下文中调用
+
+        过期的索引在锁外重新生成, 其他线程同时查询时继续使用旧的索引.
+            生成期间提交的变化记录下来, 生成完成后在新索引上重放再替换
+        """
+        with self._lock:
+            index = self._indexes.get(app_id)
+            rebuild = index is None or (
+                index.built_at + self.ttl < time.time() and
+                app_id not in self._building)
+            if rebuild:
+                changes = []
+                self._building.setdefault(app_id, []).append(changes)
+        if not rebuild:
+            self._catch_up(app_id, index)
+            return index
+
+        try:
+            index = self._build(app_id)
+        except Exception:
+            with self._lock:
+                self._end_build(app_id, changes)
+            raise
+        # 停止记录与替换索引在同一次持有锁时完成, 变化不会遗漏
+        with self._lock:
+            self._end_build(app_id, changes)
+            for change in changes:
+                _apply_change(index, change)
+            self._indexes[app_id] = index
+        return index
+
+    def _end_build(self, app_id, changes):
+        building = self._building[app_id]
+        building.remove(changes)
+        if not building:
+            del self._building[app_id]
+
+    def _build(self, app_id):
+        index = AppIndex()
+        index.max_user_id = db.session.query(func.max(User.id)).scalar() or 0
+        index.users = Bitmap.from_ids(
+            user_id for user_id, in db.session.query(User.id).filter(
+                User.app_id == app_id, User.id <= index.max_user_id))
+        rows = db.session.query(tags.c.tag_id, tags.c.user_id) \
+            .join(User, User.id == tags.c.user_id) \
+            .filter(User.app_id == app_id)
+        members = {}
+        for tag_id, user_id in rows.yield_per(10000):
+            members.setdefault(tag_id, []).append(user_id)
+        for tag_id, ids in members.items():
+            index.tags[tag_id] = Bitmap.from_ids(ids)
+        return index
+
+    def _catch_up(self, app_id, index):
+        """把id大于index.max_user_id的用户加入users
+
+        按主键范围查询所有公众号的新用户, 没有新用户时不扫描索引
+        """
+        rows = db.session.query(User.id, User.app_id) \
+            .filter(User.id > index.max_user_id).all()
+        if rows:
+            ids = [user_id for user_id, user_app_id in rows
+                   if user_app_id == app_id]
+            with self._lock:
+                index.users = index.users | Bitmap.from_ids(ids)
+                index.max_user_id = max(index.max_user_id,
+                                        max(user_id for user_id, _ in rows))
+
+    def invalidate(self, app_id):
+        with self._lock:
+            self._indexes.pop(app_id, None)
+
+    def select(self, app_id, expr):
+        """按标签表达式筛选公众号的用户
+
+        Args:
+            app_id (str): 公众号app_id
+            expr (str): 标签表达式, 见parse
+
+        Returns:
+            Bitmap: 符合条件的用户id位图
+        """
+        node = parse(expr)
+        index = self.get_index(app_id)
+        leaves = set()
+        _collect_leaves(node, leaves)
+        tag_ids = _resolve(app_id, leaves)
+        with self._lock:
+            return _evaluate(node, index, tag_ids)
+
+    def count(self, app_id, expr):
+        """符合标签表达式的用户数"""
+        return len(self.select(app_id, expr))
+
+    def openids(self, app_id, expr, limit=None):
+        """符合标签表达式的用户openid列表, 按用户id排序
+
+        Args:
+            app_id (str): 公众号app_id
+            expr (str): 标签表达式, 见parse
+            limit (int, optional): 最多返回的openid数
+
+        Returns:
+            list: openid列表
+        """
+        ids = []
+        for user_id in self.select(app_id, expr):
+            if limit is not None and len(ids) >= limit:
+                break
+            ids.append(user_id)
+        result = []
+        for i in range(0, len(ids), LOOKUP_SIZE):
+            chunk = ids[i:i + LOOKUP_SIZE]
+            rows = dict(db.session.query(User.id, User.openid)
+                        .filter(User.id.in_(chunk)))
+            result.extend(rows[pk] for pk in chunk if rows.get(pk))
+        return result
+
+    def apply(self, changes):
+        """应用已提交的标签变化, 未生成索引的公众号跳过
+
+        正在生成索引的公众号同时记录变化, 生成完成后重放
+        """
+        with self._lock:
+            for change in changes:
+                app_id = change[1]
+                for pending in self._building.get(app_id, ()):
+                    pending.append(change)
+                index = self._indexes.get(app_id)
+                if index is not None:
+                    _apply_change(index, change)
+
+
+tag_index = TagIndex()
+
+
+def _apply_change(index, change):
+    action, app_id, tag_id, user_id = change
+    if action == 'tag':
+        index.tag(tag_id).add(user_id)
+    elif action == 'untag':
+        index.tag(tag_id).discard(user_id)
+    elif action == 'user':
+        index.users.add(user_id)
+    elif action == 'delete':
+        index.users.discard(user_id)
+        for bitmap in index.tags.values():
+            bitmap.discard(user_id)
+
+
+def _collect_leaves(node, leaves):
+    if node[0] in ('tag', 'tagid'):
+        leaves.add(node)
+    else:
+        for child in node[1:]:
+            _collect_leaves(child, leaves)
+
+
+def _resolve(app_id, leaves):
+    """标签节点到公众号中Tag.id集合的映射
+
+    ('tag', 标签名)按名称查找, ('tagid', 微信标签id)按微信的标签id查找,
+        微信的标签id只在同一个公众号内唯一, 都只查找本公众号的标签
+    """
+    result = dict((leaf, set()) for leaf in leaves)
+    names = [value for kind, value in leaves if kind == 'tag']
+    if names:
+        for tag_id, name in db.session.query(Tag.id, Tag.name).filter(
+                Tag.app_id == app_id, Tag.name.in_(names)):
+            result[('tag', name)].add(tag_id)
+    wechat_ids = [value for kind, value in leaves if kind == 'tagid']
+    if wechat_ids:
+        for tag_id, wechat_tag_id in db.session.query(
+                Tag.id, Tag.wechat_tag_id).filter(
+                Tag.app_id == app_id, Tag.wechat_tag_id.in_(wechat_ids)):
+            result[('tagid', wechat_tag_id)].add(tag_id)
+    return result
+
+
+def _evaluate(node, index, tag_ids):
+    kind = node[0]
+    if kind in ('tag', 'tagid'):
+        result = Bitmap()
+        for tag_id in tag_ids[node]:
+            bitmap = index.tags.get(tag_id)
+            if bitmap is not None:
+                result = result | bitmap
+        return result & index.users
+    if kind == 'not':
+        return index.users - _evaluate(node[1], index, tag_ids)
+    left = _evaluate(node[1], index, tag_ids)
+    right = _evaluate(node[2], index, tag_ids)
+    if kind == 'and':
+        return left & right
+    return left | right
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    """记录本次flush中用户标签的变化, 事务提交后再更新索引"""
+    changes = session.info.setdefault('tag_index_changes', [])
+    for obj in session.new | session.dirty:
+        if not isinstance(obj, User):
+            continue
+        if obj in session.new:
+            changes.append(('user', obj.app_id, None, obj.id))
+        history = inspect(obj).attrs.tags.history
+        for tag in history.added or ():
+            changes.append(('tag', obj.app_id, tag.id, obj.id))
+        for tag in history.deleted or ():
+            changes.append(('untag', obj.app_id, tag.id, obj.id))
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changes.append(('delete', obj.app_id, None, obj.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('tag_index_changes', None)
+    if changes:
+        tag_index.apply(changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('tag_index_changes', None)
@@ -0,0 +1,95 @@
+# coding: utf-8
+
+"""后台线程模块
+
+进程内周期执行的后台线程基类, 批量写库等后台任务都基于此实现
+"""
+
+import atexit
+import os
+import threading
+
+
+class Worker(object):
+    """周期执行的后台线程
+
+    每隔interval秒在app_context中调用一次run_once. 线程在第一次
+        start时才创建, 并记录所在进程id, 多进程部署时fork出的子进程
+        再次start会重新创建自己的线程. 进程退出时停止线程并调用on_stop
+
+    Attributes:
+        app: 所属的flask app
+        interval (float): 两次执行之间的间隔秒数
+    """
+
+    interval = 1.0
+
+    def __init__(self, app=None):
+        self.app = app
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def running(self):
+        return self._pid == os.getpid() and \
+            self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """启动后台线程, 当前进程中已在运行则直接返回"""
+        if self.running:
+            return
+        with self._lock:
+            if self.running:
+                return
+            if self._pid != os.getpid():
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+            self._stopped = False
+            self._wakeup = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, name=self.__class__.__name__)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def wakeup(self):
+        """不等间隔结束, 立即执行一次run_once"""
+        self._wakeup.set()
+
+    def stop(self, timeout=10):
+        """停止后台线程, 等待当前任务结束后调用on_stop"""
+        if not self.running:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._call(self.on_stop)
+
+    def run_once(self):
+        """每个周期执行的任务, 由子类实现"""
+        raise NotImplementedError
+
+    def on_stop(self):
+        """线程停止后执行的收尾工作, 默认什么也不做"""
+        pass
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            self._call(self.run_once)
+
+    def _call(self, func):
+        try:
+            with self.app.app_context():
+                func()
+        except Exception:
+            self.app.logger.exception(
+                '%s failed in %s', func.__name__, self.__class__.__name__)
@@ -0,0 +1,334 @@
+# coding: utf-8
+
+"""群发消息模块
+
+群发任务创建后只写入数据库, 由后台线程或manager.py run_broadcasts
+    发送, 不占用web请求. 发送时先把受众拆分为每批2到10000个openid的
+    BroadcastChunk, 再逐批调用群发接口, 每个公众号的调用速度由令牌桶
+    限制. 每批的状态都记录在数据库中, 进程中断后从未完成的批次继续,
+    重发的批次使用相同的clientmsgid, 微信服务器不会重复发送
+"""
+
+import json
+import time
+
+from my_app import db
+from my_app.models import Broadcast, BroadcastChunk
+from .audience import parse, tag_index
+from .background import Worker
+from .client import client
+from .ratelimit import get_bucket
+from .tools import TOKEN_ERRCODES, get_token, refresh_token
+
+
+# 素材类型到群发消息类型的映射
+MSG_TYPES = {
+    'image': 'image',
+    'voice': 'voice',
+    'news': 'mpnews'
+}
+# 群发接口每次调用的最少用户数
+MIN_CHUNK_SIZE = 2
+# 可以重试的错误码: 系统繁忙, 调用频率超限, 相同clientmsgid重试过快
+RETRY_ERRCODES = (-1, 45009, 45066)
+# 相同clientmsgid的消息已经发送过
+DUPLICATE_ERRCODE = 45065
+# 相同clientmsgid重试过快, 需等待1分钟后再重试
+TOO_FAST_ERRCODE = 45066
+TOO_FAST_WAIT = 60
+
+
+def split(openids, size):
+    """把openid列表平均拆分为每批不超过size个, 不少于2个
+
+    Args:
+        openids (list): openid列表
+        size (int): 每批的最大用户数
+
+    Returns:
+        list: 每批的openid列表, 少于2个用户时为空列表
+    """
+    n = len(openids)
+    if n < MIN_CHUNK_SIZE:
+        return []
+    count = -(-n // size)
+    base, extra = divmod(n, count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + base + (1 if i < extra else 0)
+        chunks.append(openids[start:end])
+        start = end
+    return chunks
+
+
+def create_broadcast(app_id, audience_type, audience, content=None,
+                     media=None):
+    """创建群发任务, 由后台发送
+
+    Args:
+        app_id (str): 微信公众号app_id
+        audience_type (str): 受众类型, tag标签表达式, openids用户列表
+        audience (str): 标签表达式或空白分隔的openid列表
+        content (str, optional): 文本消息内容, 没有素材时使用
+        media (Media, optional): 群发的图片, 语音或图文素材
+
+    Returns:
+        Broadcast: 新建的群发任务
+
+    Raises:
+        ValueError: 受众或消息内容有误
+    """
+    if audience_type == 'tag':
+        parse(audience)
+    elif audience_type == 'openids':
+        audience = '\n'.join(audience.split())
+    else:
+        raise ValueError('unknown audience type %s' % audience_type)
+    if media is not None:
+        if media.media_type not in MSG_TYPES:
+            raise ValueError('%s can not be broadcast' % media.media_type)
+        msg_type = MSG_TYPES[media.media_type]
+        content = None
+    elif content:
+        msg_type = 'text'
+    else:
+        raise ValueError('broadcast needs content or media')
+
+    b = Broadcast(app_id=app_id, msg_type=msg_type, content=content,
+                  media=media, audience_type=audience_type,
+                  audience=audience, status='pending', total=0, sent=0,
+                  failed=0, created_at=int(time.time()))
+    db.session.add(b)
+    db.session.commit()
+    if broadcaster.enabled:
+        broadcaster.start()
+        broadcaster.wakeup()
+    return b
+
+
+class Broadcaster(Worker):
+    """群发任务发送线程
+
+    每隔BROADCAST_INTERVAL秒检查一次未完成的任务. 多个进程同时发送时,
+        每批由UPDATE领取, 只有一个进程发送
+
+    Attributes:
+        enabled (bool): 是否由后台线程发送
+        chunk_size (int): 每批最多的用户数
+        rate (float): 每个公众号每秒最多调用群发接口的次数
+        max_attempts (int): 每批最多尝试发送的次数
+        retry_delay (int): 第一次重试前等待的秒数
+        claim_timeout (int): 发送中的批次超过这个秒数视为中断
+        url (str): 群发接口地址
+    """
+
+    def __init__(self, app=None):
+        super(Broadcaster, self).__init__(app)
+        self.enabled = False
+        self.chunk_size = 10000
+        self.rate = 1
+        self.max_attempts = 5
+        self.retry_delay = 30
+        self.claim_timeout = 600
+        self.url = None
+
+    def init_app(self, app):
+        super(Broadcaster, self).init_app(app)
+        self.enabled = app.config['BROADCASTER']
+        self.interval = app.config['BROADCAST_INTERVAL']
+        self.chunk_size = app.config['BROADCAST_CHUNK_SIZE']
+        self.rate = app.config['BROADCAST_RATE']
+        self.max_attempts = app.config['BROADCAST_MAX_ATTEMPTS']
+        self.retry_delay = app.config['BROADCAST_RETRY_DELAY']
+        self.claim_timeout = app.config['BROADCAST_CLAIM_TIMEOUT']
+        self.url = app.config['MASS_SEND_URL']
+        if self.enabled:
+            app.before_first_request(self.start)
+
+    def run_once(self):
+        self.dispatch()
+
+    def dispatch(self):
+        """发送所有未完成的任务中可以发送的批次, 需在应用上下文中调用
+
+        Returns:
+            int: 仍未完成的批次数, 包括等待重试的和其他进程正在发送的
+        """
+        self._recover()
+        waiting = 0
+        ids = [pk for pk, in db.session.query(Broadcast.id).filter(
+            Broadcast.status.in_(('pending', 'running')))
+            .order_by(Broadcast.id)]
+        for pk in ids:
+            if self._stopped:
+                break
+            b = Broadcast.query.get(pk)
+            if b.status == 'pending':
+                self.prepare(b)
+            if b.status == 'running':
+                waiting += self.send(b)
+        return waiting
+
+    def _recover(self):
+        """把中断的发送中批次改回等待发送"""
+        timeout = int(time.time()) - self.claim_timeout
+        BroadcastChunk.query.filter(
+            BroadcastChunk.status == 'sending',
+            BroadcastChunk.claimed_at < timeout
+        ).update({'status': 'pending'}, synchronize_session=False)
+        db.session.commit()
+
+    def prepare(self, b):
+        """确定任务的受众并拆分批次, 批次与任务状态在同一个事务中写入"""
+        try:
+            if b.audience_type == 'tag':
+                openids = tag_index.openids(b.app_id, b.audience)
+            else:
+                openids = b.audience.split()
+        except ValueError as e:
+            self._fail(b, str(e))
+            return
+        openids = list(dict.fromkeys(openids))
+        chunks = split(openids, self.chunk_size)
+        if not chunks:
+            self._fail(b, 'audience has fewer than %d users' %
+                       MIN_CHUNK_SIZE)
+            return
+        # 先确定受众再领取任务, 减少持有写锁的时间; 其他进程已领取时跳过
+        claimed = Broadcast.query.filter_by(
+            id=b.id, status='pending'
+        ).update({'status': 'running'}, synchronize_session=False)
+        if claimed != 1:
+            db.session.rollback()
+            return
+        db.session.bulk_insert_mappings(BroadcastChunk, [{
+            'broadcast_id': b.id,
+            'seq': seq,
+            'openids': '\n'.join(chunk),
+            'size': len(chunk),
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': 0
+        } for seq, chunk in enumerate(chunks)])
+        b.total = len(openids)
+        b.status = 'running'
+        db.session.commit()
+
+    def send(self, b):
+        """依次发送任务中到了发送时间的批次
+
+        Returns:
+            int: 任务中仍未完成的批次数
+        """
+        bucket = get_bucket((b.app_id, 'MASS_SEND_URL'), self.rate)
+        payload = self.payload(b)
+        while not self._stopped:
+            chunk = BroadcastChunk.query.filter(
+                BroadcastChunk.broadcast_id == b.id,
+                BroadcastChunk.status == 'pending',
+                BroadcastChunk.next_attempt_at <= int(time.time())
+            ).order_by(BroadcastChunk.seq).first()
+            if chunk is None:
+                break
+            if not self._claim(chunk):
+                continue
+            bucket.acquire()
+            self._send_chunk(b, chunk, payload)
+            self._update_counts(b)
+
+        waiting = BroadcastChunk.query.filter(
+            BroadcastChunk.broadcast_id == b.id,
+            BroadcastChunk.status.in_(('pending', 'sending'))).count()
+        if not waiting:
+            self._update_counts(b)
+            b.status = 'done' if b.sent else 'failed'
+            if not b.sent:
+                b.error = 'all chunks failed'
+            b.finished_at = int(time.time())
+            db.session.commit()
+        return waiting
+
+    @staticmethod
+    def payload(b):
+        """群发接口的消息内容, 不包括touser和clientmsgid"""
+        if b.msg_type == 'text':
+            return {'msgtype': 'text', 'text': {'content': b.content}}
+        data = {
+            'msgtype': b.msg_type,
+            b.msg_type: {'media_id': b.media.media_id}
+        }
+        if b.msg_type == 'mpnews':
+            data['send_ignore_reprint'] = 0
+        return data
+
+    @staticmethod
+    def _claim(chunk):
+        """领取一个批次, 其他进程已领取时返回False"""
+        claimed = BroadcastChunk.query.filter_by(
+            id=chunk.id, status='pending'
+        ).update({'status': 'sending', 'claimed_at': int(time.time())},
+                 synchronize_session=False)
+        db.session.commit()
+        return claimed == 1
+
+    def _send_chunk(self, b, chunk, payload):
+        data = dict(payload)
+        data['touser'] = chunk.openids.split('\n')
+        data['clientmsgid'] = 'broadcast-%d-%d' % (b.id, chunk.seq)
+        chunk.attempts += 1
+        try:
+            res = client.post(self.url,
+                              params={'access_token': get_token(b.app_id)},
+                              data=json.dumps(data, ensure_ascii=False)
+                              .encode('utf-8'))
+            r = res.json()
+        except Exception as e:
+            # 请求可能已经到达微信服务器, 用相同的clientmsgid重试不会重复发送
+            r = {'errcode': -1, 'errmsg': str(e)}
+
+        errcode = r.get('errcode') or 0
+        if errcode in (0, DUPLICATE_ERRCODE):
+            chunk.status = 'sent'
+            chunk.msg_id = str(r.get('msg_id') or '') or None
+            chunk.msg_data_id = str(r.get('msg_data_id') or '') or None
+            chunk.error = None
+        else:
+            chunk.error = ('%s %s' % (errcode, r.get('errmsg', '')))[:255]
+            if errcode in TOKEN_ERRCODES:
+                # access_token有效期不超过7200秒, 这样总会重新获取
+                try:
+                    refresh_token(b.app_id, min_ttl=7200)
+                except Exception as e:
+                    self.app.logger.warning(
+                        'refresh token of %s failed: %s', b.app_id, e)
+            if errcode in RETRY_ERRCODES + TOKEN_ERRCODES and \
+                    chunk.attempts < self.max_attempts:
+                chunk.status = 'pending'
+                delay = self.retry_delay * 2 ** (chunk.attempts - 1)
+                if errcode == TOO_FAST_ERRCODE:
+                    delay = max(delay, TOO_FAST_WAIT)
+                chunk.next_attempt_at = int(time.time()) + delay
+            else:
+                chunk.status = 'failed'
+        db.session.commit()
+
+    @staticmethod
+    def _update_counts(b):
+        counts = dict(db.session.query(
+            BroadcastChunk.status, db.func.sum(BroadcastChunk.size)
+        ).filter(BroadcastChunk.broadcast_id == b.id)
+            .group_by(BroadcastChunk.status))
+        b.sent = int(counts.get('sent') or 0)
+        b.failed = int(counts.get('failed') or 0)
+        db.session.commit()
+
+    @staticmethod
+    def _fail(b, error):
+        b.status = 'failed'
+        b.error = error[:255]
+        b.finished_at = int(time.time())
+        db.session.commit()
+
+
+broadcaster = Broadcaster()
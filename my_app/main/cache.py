@@ -0,0 +1,202 @@
+# coding: utf-8
+
+"""进程内缓存模块
+
+缓存公众号信息等频繁读取的数据, 减少每条消息的数据库查询
+"""
+
+import collections
+import threading
+import time
+
+from my_app import db
+from my_app.models import Token
+
+
+TokenInfo = collections.namedtuple('TokenInfo', [
+    'id', 'app_id', 'app_secret', 'wechat_id', 'token',
+    'access_token', 'expired_time', 'account_id'])
+
+
+class TokenCache(object):
+    """公众号信息缓存
+
+    按app_id和wechat_id两个索引缓存Token表中的公众号信息, 缓存的是
+        与session无关的TokenInfo快照, 可以跨请求, 跨线程使用.
+        缓存项在TOKEN_CACHE_TTL秒后过期, 其他进程修改的数据最多
+        在这个时间后可见, 本进程修改后应调用invalidate
+
+    Attributes:
+        ttl (int): 缓存有效秒数
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self._entries = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['TOKEN_CACHE_TTL']
+
+    def get(self, app_id=None, wechat_id=None):
+        """获取公众号信息
+
+        Args:
+            app_id (str, optional): 公众号app_id
+            wechat_id (str, optional): 公众号原始id, 未提供app_id时使用
+
+        Returns:
+            TokenInfo: 公众号信息, 不存在时返回None
+        """
+        if app_id is not None:
+            key = ('app_id', app_id)
+        else:
+            key = ('wechat_id', wechat_id)
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        # 只查询列而不加载模型, 避免拿到session中已有的旧对象
+        columns = [getattr(Token, name) for name in TokenInfo._fields]
+        row = db.session.query(*columns).filter_by(
+            **{key[0]: key[1]}).first()
+        if row is None:
+            return None
+
+        info = TokenInfo(*row)
+        expires = now + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, info)
+            self._entries[('app_id', info.app_id)] = (expires, info)
+        return info
+
+    def invalidate(self, app_id=None, wechat_id=None):
+        """使缓存项失效
+
+        同时删除该公众号在另一个索引下的缓存项
+
+        Args:
+            app_id (str, optional): 公众号app_id
+            wechat_id (str, optional): 公众号原始id
+        """
+        with self._lock:
+            for key in (('app_id', app_id), ('wechat_id', wechat_id)):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    info = entry[1]
+                    self._entries.pop(('app_id', info.app_id), None)
+                    self._entries.pop(('wechat_id', info.wechat_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class PendingReply(object):
+    """一条消息的回复, 处理完成前重试的请求在此等待
+
+    Attributes:
+        expires (float): 缓存过期的时间戳
+        value (bytes): 回复消息, 处理完成前为None
+    """
+
+    def __init__(self, expires):
+        self.expires = expires
+        self.value = None
+        self._done = threading.Event()
+
+    def resolve(self, value):
+        self.value = value
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """等待回复完成
+
+        Returns:
+            bytes: 回复消息, 超时或处理失败时返回None
+        """
+        self._done.wait(timeout)
+        return self.value
+
+
+class ReplyCache(object):
+    """回复消息排重缓存
+
+    微信服务器5秒内收不到回复会重试推送同一条消息, 最多三次.
+        以MsgId为键, 事件没有MsgId则以发送者, 创建时间和事件类型为键,
+        缓存回复消息REPLY_CACHE_TTL秒, 最多缓存REPLY_CACHE_SIZE条.
+        只在进程内有效, 多进程部署时重试被其他进程接收仍会重复处理
+
+    Attributes:
+        maxsize (int): 最多缓存的条数, 超出时丢弃最早的
+        ttl (int): 缓存有效秒数
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = 10000
+        self.ttl = 60
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config['REPLY_CACHE_SIZE']
+        self.ttl = app.config['REPLY_CACHE_TTL']
+
+    @staticmethod
+    def key(msg):
+        """接收消息的排重键, 无法解析的消息返回None"""
+        if msg is None:
+            return None
+        if msg.MsgId:
+            return (msg.ToUserName, msg.MsgId)
+        return (msg.ToUserName, msg.FromUserName, msg.CreateTime,
+                getattr(msg, 'Event', None))
+
+    def claim(self, key):
+        """认领一条消息的处理
+
+        Args:
+            key: key方法返回的排重键
+
+        Returns:
+            tuple: (PendingReply, owner), owner为True时由调用者处理并
+                resolve, 否则是重试, 等待已有的回复即可
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                return entry, False
+
+            # 有效期相同, 最早加入的最先过期
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest.expires > now and \
+                        len(self._entries) < self.maxsize:
+                    break
+                self._entries.popitem(last=False)
+
+            entry = PendingReply(now + self.ttl)
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            return entry, True
+
+    def discard(self, key, entry):
+        """处理失败时移除认领, 唤醒等待的重试请求"""
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.resolve(None)
+
+
+reply_cache = ReplyCache()
@@ -0,0 +1,204 @@
+# coding: utf-8
+
+"""微信接口HTTP客户端
+
+所有微信接口请求共用一个带连接池的requests.Session, 保持与
+    api.weixin.qq.com的长连接, 避免每次请求重新建立TLS连接
+"""
+
+import collections
+import mimetypes
+import os
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class EndpointStats(object):
+    """单个接口的请求统计
+
+    Attributes:
+        count (int): 请求次数
+        errors (int): 失败次数, 包括连接失败和超时
+        total (float): 请求总耗时秒数
+        max (float): 最长一次请求的耗时秒数
+    """
+
+    __slots__ = ('count', 'errors', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
+
+
+class WechatClient(object):
+    """微信接口HTTP客户端
+
+    每个进程使用自己的Session, fork后的子进程重新创建, 线程之间共享
+        同一个连接池. 请求按接口统计次数和耗时, 配置中的接口地址以
+        配置项名称统计, 其他地址以去掉参数的url统计
+
+    Attributes:
+        timeout (tuple): (连接超时, 读取超时)秒数
+        pool_connections (int): 连接池缓存的主机数
+        pool_maxsize (int): 每个主机保持的最大连接数
+        max_retries (int): 连接失败时的重试次数
+    """
+
+    def __init__(self, app=None):
+        self.timeout = (3.05, 30)
+        self.pool_connections = 4
+        self.pool_maxsize = 16
+        self.max_retries = 2
+        self._endpoints = {}
+        self._session = None
+        self._pid = None
+        self._stats = collections.defaultdict(EndpointStats)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.timeout = (app.config['HTTP_CONNECT_TIMEOUT'],
+                        app.config['HTTP_READ_TIMEOUT'])
+        self.pool_connections = app.config['HTTP_POOL_CONNECTIONS']
+        self.pool_maxsize = app.config['HTTP_POOL_MAXSIZE']
+        self.max_retries = app.config['HTTP_MAX_RETRIES']
+        for name, value in app.config.items():
+            if name.endswith('_URL') and isinstance(value, str):
+                self._endpoints[value.strip()] = name
+
+    @property
+    def session(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._make_session()
+                    self._stats.clear()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              max_retries=self.max_retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        """发送请求
+
+        参数与requests.request相同, 未指定timeout时使用配置的超时
+
+        Returns:
+            response: Requests库返回的响应对象
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session
+        endpoint = self._endpoints.get(url, url)
+        started = time.time()
+        failed = True
+        try:
+            res = session.request(method, url, **kwargs)
+            failed = False
+            return res
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                stats = self._stats[endpoint]
+                stats.count += 1
+                stats.errors += failed
+                stats.total += elapsed
+                if elapsed > stats.max:
+                    stats.max = elapsed
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """本进程各接口的请求统计
+
+        Returns:
+            dict: 接口名称到统计字典的映射, 统计字典包括count, errors,
+                avg, max
+        """
+        with self._lock:
+            return dict((endpoint, s.as_dict())
+                        for endpoint, s in self._stats.items())
+
+
+client = WechatClient()
+
+
+class MultipartFile(object):
+    """流式的multipart/form-data请求体
+
+    只包含一个文件字段, 作为requests的data参数时边读文件边发送, 不会把
+        整个文件读入内存. 提供len属性, requests据此设置Content-Length
+
+    Args:
+        name (str): 表单字段名
+        filename (str): 文件名
+        path (str): 本地文件路径
+        chunk_size (int, optional): 每次读取文件的最大字节数
+    """
+
+    def __init__(self, name, filename, path, chunk_size=65536):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        mimetype = mimetypes.guess_type(filename)[0] or \
+            'application/octet-stream'
+        head = ('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\nContent-Type: %s\r\n\r\n' % (
+                    self.boundary, name, filename.replace('"', ''),
+                    mimetype)).encode('utf-8')
+        tail = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+        self.len = len(head) + os.path.getsize(path) + len(tail)
+        self._head = head
+        self._tail = tail
+        self._path = path
+        self._file = None
+        self._stage = 0
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        if self._stage == 0:
+            self._stage = 1
+            self._file = open(self._path, 'rb')
+            return self._head
+        if self._stage == 1:
+            chunk = self._file.read(min(size, self.chunk_size))
+            if chunk:
+                return chunk
+            self.close()
+            self._stage = 2
+            return self._tail
+        return b''
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,211 @@
+# coding: utf-8
+
+"""第三方内容缓存模块
+
+菜单点击等回复中用到的第三方内容按键缓存, 缺失的内容并发获取,
+    并由后台线程提前预热, 生成回复时不必等待第三方接口
+"""
+
+import concurrent.futures
+import datetime as dt
+import os
+import threading
+import time
+
+import requests
+
+from .background import Worker
+
+
+FETCH_TIMEOUT = 5
+# 获取失败后多少秒内不再为请求重新获取, 预热不受限制
+ERROR_TTL = 60
+# 午夜前多少秒开始预热明天的每日一句
+DAILY_WARM_AHEAD = 1800
+
+
+class ContentSource(object):
+    """第三方内容源
+
+    按键缓存fetch的结果ttl秒, 同一个键同时只会有一次请求.
+        获取失败的键记录ERROR_TTL秒, 期间get_many不再重新获取
+
+    Args:
+        name (str): 内容源名称, 一般使用对应的EventKey
+        fetch: 获取内容的函数, 参数为键, 返回内容, 失败时抛出异常
+        ttl (int): 缓存有效秒数
+        upcoming: 返回需要预热的键列表的函数, 可选
+    """
+
+    def __init__(self, name, fetch, ttl, upcoming=None):
+        self.name = name
+        self.fetch = fetch
+        self.ttl = ttl
+        self.upcoming = upcoming
+        self._entries = {}
+        self._errors = {}
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, wait=True):
+        return self.get_many([key], wait)[0]
+
+    def get_many(self, keys, wait=True):
+        """获取多个键的内容, 未缓存的键并发获取
+
+        获取失败的键不抛出异常, 使用已过期的缓存, 没有缓存时为None,
+            调用方在生成回复时跳过. 生成回复时使用wait=False, 只返回
+            已缓存的内容, 未缓存的键在后台获取, 不等待网络请求
+
+        Args:
+            keys (list): 键列表
+            wait (bool, optional): 是否等待未缓存的键获取完成
+
+        Returns:
+            list: 与keys一一对应的内容, 未缓存且获取失败或未等待的为None
+        """
+        now = time.time()
+        results = {}
+        futures = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    results[key] = entry[1]
+                    continue
+                results[key] = entry[1] if entry is not None else None
+                if key not in futures and \
+                        self._errors.get(key, 0) <= now:
+                    futures[key] = self._submit(key)
+
+        if wait:
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception:
+                    pass
+        return [results[key] for key in keys]
+
+    def cached(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    def warm(self):
+        """获取upcoming中尚未缓存的键, 失败的下次预热时重试"""
+        if self.upcoming is None:
+            return
+        with self._lock:
+            futures = [self._submit(key) for key in self.upcoming()
+                       if not self.cached(key)]
+        concurrent.futures.wait(futures)
+
+    def _submit(self, key):
+        """提交获取任务, 已有同一个键的任务时复用, 需持有self._lock
+
+        任务可能在add_done_callback之前就已完成, 回调会在当前线程中
+            立即执行, 因此self._lock是可重入锁
+        """
+        future = self._pending.get(key)
+        if future is None:
+            future = _get_executor().submit(self.fetch, key)
+            self._pending[key] = future
+            future.add_done_callback(
+                lambda f, key=key: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            del self._pending[key]
+            if future.exception() is None:
+                self._entries[key] = (time.time() + self.ttl, future.result())
+                self._errors.pop(key, None)
+            else:
+                self._errors[key] = time.time() + ERROR_TTL
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """每个进程使用自己的线程池"""
+    global _executor, _executor_pid
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=8)
+                _executor_pid = os.getpid()
+    return _executor
+
+
+class ContentWarmer(Worker):
+    """第三方内容预热线程
+
+    每隔CONTENT_WARM_INTERVAL秒预热所有内容源
+
+    Attributes:
+        enabled (bool): 是否启用预热
+    """
+
+    def __init__(self, app=None):
+        super(ContentWarmer, self).__init__(app)
+        self.enabled = False
+
+    def init_app(self, app):
+        super(ContentWarmer, self).init_app(app)
+        self.enabled = app.config['CONTENT_WARMER']
+        self.interval = app.config['CONTENT_WARM_INTERVAL']
+        if self.enabled:
+            app.before_first_request(self.start)
+
+    def run_once(self):
+        for source in sources.values():
+            source.warm()
+
+
+content_warmer = ContentWarmer()
+
+
+def fetch_daily_sentence(date):
+    """获取金山词霸每日一句
+
+    Args:
+        date (str): 日期, 如2018-01-01
+
+    Returns:
+        dict: 每日一句的内容, 包括content, dateline, picture等
+    """
+    res = requests.get('http://open.iciba.com/dsapi/',
+                       params={'date': date}, timeout=FETCH_TIMEOUT)
+    result = res.json()
+    # 还未发布的日期会返回其他日期的内容, 不能缓存
+    if result.get('dateline') != date:
+        raise ValueError('daily sentence of %s is not ready' % date)
+    return result
+
+
+def daily_sentence_dates():
+    """最近三天的日期, 临近午夜时加上明天, 新的一天开始时已在缓存中"""
+    now = dt.datetime.now()
+    today = now.date().toordinal()
+    dates = [dt.date.fromordinal(today - i).isoformat() for i in range(3)]
+    midnight = dt.datetime.combine(dt.date.fromordinal(today + 1), dt.time())
+    if (midnight - now).total_seconds() < DAILY_WARM_AHEAD:
+        dates.append(dt.date.fromordinal(today + 1).isoformat())
+    return dates
+
+
+# 内容源, 按名称注册
+sources = {}
+
+
+def register(source):
+    sources[source.name] = source
+    return source
+
+
+daily_sentence = register(ContentSource(
+    'news3', fetch_daily_sentence, ttl=86400,
+    upcoming=daily_sentence_dates))
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+"""限时回复模块
+
+微信服务器5秒内收不到被动回复就会重试推送. 回复生成超过时限时先返回
+    success, 生成完成后再通过客服消息接口发送给用户
+"""
+
+import concurrent.futures
+import functools
+import os
+import threading
+import time
+
+from flask import current_app
+
+from .cache import token_cache
+from .writer import msg_writer
+from . import tools
+
+
+class ReplyRunner(object):
+    """限时生成回复
+
+    REPLY_DEADLINE为空时在请求线程中直接生成回复; 设置后在回复线程池中
+        生成, 请求开始REPLY_DEADLINE秒后仍未完成则放弃等待, 由回复线程
+        在完成后发送客服消息并记录回复
+
+    Attributes:
+        deadline (float): 被动回复的时限秒数
+        workers (int): 回复线程数
+    """
+
+    def __init__(self, app=None):
+        self.deadline = None
+        self.workers = 8
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.deadline = app.config['REPLY_DEADLINE']
+        self.workers = app.config['REPLY_WORKERS']
+
+    def run(self, func, msg, started):
+        """生成回复消息
+
+        Args:
+            func: 生成回复的函数, 参数为接收消息, 返回回复消息对象
+            msg: 接收消息
+            started (float): 开始处理请求的时间戳
+
+        Returns:
+            回复消息对象, 超过时限时返回None
+        """
+        if not self.deadline:
+            return func(msg)
+
+        app = current_app._get_current_object()
+        executor = self._get_executor()
+        future = executor.submit(_call, app, func, msg)
+        timeout = max(self.deadline - (time.time() - started), 0)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            # 回复可能在超时之后, 添加回调之前完成, 这时回调在请求线程中
+            # 立即执行. 发送和记录总是交给回复线程, 请求线程上不再推入
+            # 新的应用上下文, 以免弹出时关闭请求仍在使用的db.session
+            future.add_done_callback(functools.partial(
+                executor.submit, _send_later, app, msg))
+            return None
+
+    def _get_executor(self):
+        """每个进程使用自己的线程池"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers)
+                    self._pid = os.getpid()
+        return self._executor
+
+
+def _call(app, func, msg):
+    with app.app_context():
+        return func(msg)
+
+
+def _send_later(app, msg, future):
+    """超时的回复生成完成后, 通过客服消息发送并记录"""
+    try:
+        reply_msg = future.result()
+    except Exception:
+        app.logger.exception('make reply for %s failed', msg.FromUserName)
+        return
+
+    with app.app_context():
+        try:
+            t = token_cache.get(wechat_id=msg.ToUserName)
+            tools.send_custom_message(t.app_id, reply_msg.to_custom())
+        except Exception:
+            app.logger.exception(
+                'send custom message to %s failed', reply_msg.ToUserName)
+        finally:
+            msg_writer.save(reply_msg.save())
+
+
+reply_runner = ReplyRunner()
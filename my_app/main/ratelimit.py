@@ -0,0 +1,80 @@
+# coding: utf-8
+
+"""接口调用限速
+
+微信接口按公众号限制调用频率和每日次数, 批量任务通过令牌桶控制
+    调用速度, 同一进程内调用同一接口的线程共享一个令牌桶
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """线程安全的令牌桶
+
+    令牌以每秒rate个的速度补充, 最多积累capacity个, 每次调用前取走
+        一个令牌, 没有令牌时等待
+
+    Attributes:
+        rate (float): 每秒补充的令牌数
+        capacity (float): 桶的容量, 即允许的突发调用次数
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1, timeout=None):
+        """取走tokens个令牌, 不足时等待
+
+        Args:
+            tokens (int, optional): 需要的令牌数
+            timeout (float, optional): 最长等待秒数, 为None时一直等待
+
+        Returns:
+            bool: 是否取得令牌, 超时返回False
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key, rate, capacity=None):
+    """获取key对应的令牌桶, 不存在时创建
+
+    Args:
+        key: 令牌桶的键, 如(公众号app_id, 接口名)
+        rate (float): 每秒补充的令牌数
+        capacity (float, optional): 桶的容量, 默认等于rate
+
+    Returns:
+        TokenBucket: 同一key在进程内共享的令牌桶
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate, capacity)
+        return bucket
@@ -5,54 +5,96 @@
 包含各类微信消息时间的模块, 并有解析消息函数, 每个消息类有保存方法
 """
 
+import re
 import time
-import xml.etree.ElementTree as ET
+from xml.parsers import expat
 
 from .. import models
+from .cache import token_cache
 
 
 def parse_xml(data):
     """接收消息方法
 
-    将接收到的微信消息/事件的xml字符串解析成相应的消息类
+    将接收到的微信消息/事件的xml字符串解析成相应的消息类,
+        按(MsgType, Event)在MSG_TYPES中查找对应的消息类
 
     Args:
         data: 微信服务器推送的的原始xml字符串消息
 
     Returns:
-        返回相应的接收消息类
+        返回相应的接收消息类, 不支持的消息类型返回None
     """
     if len(data) == 0:
         return None
-    xmlData = ET.fromstring(data)
-    msg_type = xmlData.find('MsgType').text
-    if msg_type == 'text':
-        return TextMsg(xmlData)
-    elif msg_type == 'image':
-        return ImageMsg(xmlData)
-    elif msg_type == 'voice':
-        return VoiceMsg(xmlData)
-    elif msg_type == 'video' or msg_type == 'shortvideo':
-        return VideoMsg(xmlData)
-    elif msg_type == 'location':
-        return LocationMsg(xmlData)
-    elif msg_type == 'link':
-        return LinkMsg(xmlData)
-    elif msg_type == 'event':
-        event_type = xmlData.find('Event').text
-        if event_type == 'LOCATION':
-            return LocationEvent(xmlData)
-        elif event_type == 'CLICK':
-            return ClickEvent(xmlData)
-        elif event_type == 'VIEW':
-            return ViewEvent(xmlData)
-        elif event_type == 'scan':
-            return ScanEvent(xmlData)
-        elif event_type == 'subscribe' or 'unsubscribe':
-            if xmlData.find('Ticket') is not None:
-                return ScanEvent(xmlData)
-            else:
-                return EventMsg(xmlData)
+    fields = parse_fields(data)
+    msg_type = fields.get('MsgType')
+    cls = MSG_TYPES.get((msg_type, fields.get('Event'))) or \
+        MSG_TYPES.get((msg_type, None))
+    if cls is None:
+        return None
+    # 未关注用户扫描带参数二维码, 关注事件中会带有Ticket
+    if cls is EventMsg and 'Ticket' in fields:
+        cls = ScanEvent
+    return cls(fields)
+
+
+# 微信推送的消息是只有一层子元素的xml, 子元素的文本是CDATA或不含标签的字符,
+# 整个消息符合_FLAT_XML时直接用正则取出各子元素, 否则交给expat解析
+_FLAT_XML = re.compile(
+    r'\s*(?:<\?xml[^>]*\?>\s*)?<xml>\s*'
+    r'(?:<(?P<tag>\w+)>(?:<!\[CDATA\[.*?\]\]>|[^<]*)</(?P=tag)>\s*)*'
+    r'</xml>\s*', re.S)
+_ELEMENT = re.compile(r'<(\w+)>(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))</\1>', re.S)
+
+
+def parse_fields(data):
+    """解析xml字段
+
+    单次遍历xml, 不构建元素树, 直接得到每个子元素的文本
+
+    Args:
+        data: 微信服务器推送的的原始xml字符串消息
+
+    Returns:
+        dict: 子元素标签到文本的字典, 空元素的文本为None
+    """
+    text = data.decode('utf-8') if isinstance(data, bytes) else data
+    if _FLAT_XML.fullmatch(text) is None:
+        return _expat_fields(data)
+
+    fields = {}
+    for tag, cdata, value in _ELEMENT.findall(text):
+        # 分段的CDATA和实体引用需要完整的xml解析
+        if ']]>' in cdata or '&' in value:
+            return _expat_fields(data)
+        fields[tag] = cdata or value or None
+    return fields
+
+
+def _expat_fields(data):
+    fields = {}
+    text = [None]
+
+    def start(tag, attrs):
+        text[0] = None
+
+    def char_data(data):
+        text[0] = data
+
+    def end(tag):
+        fields[tag] = text[0]
+        text[0] = None
+
+    # 缓冲区不小于整个消息, 每段文本只会回调一次char_data
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = max(len(data), 1)
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = char_data
+    parser.EndElementHandler = end
+    parser.Parse(data, True)
+    return fields
 
 
 class Msg(object):
@@ -68,20 +110,22 @@ class Msg(object):
         ToUserName (str): 开发者微信号(这里是公众号的原始id)
     """
 
-    def __init__(self, xmlData):
+    __slots__ = ('ToUserName', 'FromUserName', 'CreateTime', 'MsgType',
+                 'MsgId')
+
+    def __init__(self, fields):
         """接收消息类初始化
 
         初始化接收消息类, 保存共有属性
 
         Args:
-            xmlData: 经过解析的微信消息
+            fields (dict): parse_fields解析出的微信消息字段
         """
-        self.ToUserName = xmlData.find('ToUserName').text
-        self.FromUserName = xmlData.find('FromUserName').text
-        self.CreateTime = xmlData.find('CreateTime').text
-        self.MsgType = xmlData.find('MsgType').text
-        msg_id = xmlData.find('MsgId')
-        self.MsgId = msg_id.text if msg_id is not None else ''
+        self.ToUserName = fields.get('ToUserName')
+        self.FromUserName = fields.get('FromUserName')
+        self.CreateTime = fields.get('CreateTime')
+        self.MsgType = fields.get('MsgType')
+        self.MsgId = fields.get('MsgId', '')
 
     def save(self):
         """保存消息方法
@@ -108,9 +152,11 @@ class TextMsg(Msg):
         Content (str): 文本类消息的内容
     """
 
-    def __init__(self, xmlData):
-        super(TextMsg, self).__init__(xmlData)
-        self.Content = xmlData.find('Content').text
+    __slots__ = ('Content', )
+
+    def __init__(self, fields):
+        super(TextMsg, self).__init__(fields)
+        self.Content = fields.get('Content')
 
     def save(self):
         msg = super(TextMsg, self).save()
@@ -129,16 +175,18 @@ class ImageMsg(Msg):
         PicUrl (str): 图片链接(由微信系统生成)
     """
 
-    def __init__(self, xmlData):
-        super(ImageMsg, self).__init__(xmlData)
-        self.PicUrl = xmlData.find('PicUrl').text
-        self.MediaId = xmlData.find('MediaId').text
+    __slots__ = ('PicUrl', 'MediaId')
+
+    def __init__(self, fields):
+        super(ImageMsg, self).__init__(fields)
+        self.PicUrl = fields.get('PicUrl')
+        self.MediaId = fields.get('MediaId')
 
     def save(self):
         msg = super(ImageMsg, self).save()
         media = models.Media()
-        t = models.Token.query.filter_by(wechat_id=self.ToUserName).first()
-        media.app = t
+        t = token_cache.get(wechat_id=self.ToUserName)
+        media.app_id = t.app_id if t is not None else None
         media.locale_url = ''
         media.media_type = 'image'
         media.created_at = int(time.time())
@@ -160,18 +208,19 @@ class VoiceMsg(Msg):
         Recognition (str): 语音识别结果
     """
 
-    def __init__(self, xmlData):
-        super(VoiceMsg, self).__init__(xmlData)
-        self.MediaId = xmlData.find('MediaId').text
-        self.Format = xmlData.find('Format').text
-        recognition = xmlData.find('Recognition')
-        self.Recognition = recognition.text if recognition is not None else ''
+    __slots__ = ('MediaId', 'Format', 'Recognition')
+
+    def __init__(self, fields):
+        super(VoiceMsg, self).__init__(fields)
+        self.MediaId = fields.get('MediaId')
+        self.Format = fields.get('Format')
+        self.Recognition = fields.get('Recognition', '')
 
     def save(self):
         msg = super(VoiceMsg, self).save()
         media = models.Media()
-        t = models.Token.query.filter_by(wechat_id=self.ToUserName).first()
-        media.app = t
+        t = token_cache.get(wechat_id=self.ToUserName)
+        media.app_id = t.app_id if t is not None else None
         media.locale_url = ''
         media.media_type = 'voice'
         media.created_at = int(time.time())
@@ -193,16 +242,18 @@ class VideoMsg(Msg):
         ThumbMediaId (str): 视频消息缩略图媒体id
     """
 
-    def __init__(self, xmlData):
-        super(VideoMsg, self).__init__(xmlData)
-        self.MediaId = xmlData.find('MediaId').text
-        self.ThumbMediaId = xmlData.find('ThumbMediaId').text
+    __slots__ = ('MediaId', 'ThumbMediaId')
+
+    def __init__(self, fields):
+        super(VideoMsg, self).__init__(fields)
+        self.MediaId = fields.get('MediaId')
+        self.ThumbMediaId = fields.get('ThumbMediaId')
 
     def save(self):
         msg = super(VideoMsg, self).save()
         media = models.Media()
-        t = models.Token.query.filter_by(wechat_id=self.ToUserName).first()
-        media.app = t
+        t = token_cache.get(wechat_id=self.ToUserName)
+        media.app_id = t.app_id if t is not None else None
         media.locale_url = ''
         media.media_type = 'video'
         media.created_at = int(time.time())
@@ -225,12 +276,14 @@ class LocationMsg(Msg):
         Scale (float): 地图缩放大小
     """
 
-    def __init__(self, xmlData):
-        super(LocationMsg, self).__init__(xmlData)
-        self.Location_X = xmlData.find('Location_X').text
-        self.Location_Y = xmlData.find('Location_Y').text
-        self.Scale = xmlData.find('Scale').text
-        self.Label = xmlData.find('Label').text
+    __slots__ = ('Location_X', 'Location_Y', 'Scale', 'Label')
+
+    def __init__(self, fields):
+        super(LocationMsg, self).__init__(fields)
+        self.Location_X = fields.get('Location_X')
+        self.Location_Y = fields.get('Location_Y')
+        self.Scale = fields.get('Scale')
+        self.Label = fields.get('Label')
 
     def save(self):
         msg = super(LocationMsg, self).save()
@@ -255,17 +308,19 @@ class LinkMsg(Msg):
         Url (str): 消息链接
     """
 
-    def __init__(self, xmlData):
-        super(LinkMsg, self).__init__(xmlData)
-        self.Title = xmlData.find('Title').text
-        self.Description = xmlData.find('Description').text
-        self.Url = xmlData.find('Url').text
+    __slots__ = ('Title', 'Description', 'Url')
+
+    def __init__(self, fields):
+        super(LinkMsg, self).__init__(fields)
+        self.Title = fields.get('Title')
+        self.Description = fields.get('Description')
+        self.Url = fields.get('Url')
 
     def save(self):
         msg = super(LinkMsg, self).save()
         media = models.Media()
-        t = models.Token.query.filter_by(wechat_id=self.ToUserName).first()
-        media.app = t
+        t = token_cache.get(wechat_id=self.ToUserName)
+        media.app_id = t.app_id if t is not None else None
         media.locale_url = ''
         media.media_type = 'link'
         media.created_at = int(time.time())
@@ -291,9 +346,11 @@ class EventMsg(Msg):
         ToUserName (str): 开发者微信号
     """
 
-    def __init__(self, xmlData):
-        super(EventMsg, self).__init__(xmlData)
-        self.Event = xmlData.find('Event').text
+    __slots__ = ('Event', )
+
+    def __init__(self, fields):
+        super(EventMsg, self).__init__(fields)
+        self.Event = fields.get('Event')
 
     def save(self):
         msg = super(EventMsg, self).save()
@@ -314,10 +371,12 @@ class ScanEvent(EventMsg):
         Ticket (str): 二维码的ticket
     """
 
-    def __init__(self, xmlData):
-        super(ScanEvent, self).__init__(xmlData)
-        self.EventKey = xmlData.find('EventKey').text
-        self.Ticket = xmlData.find('Ticket').text
+    __slots__ = ('EventKey', 'Ticket')
+
+    def __init__(self, fields):
+        super(ScanEvent, self).__init__(fields)
+        self.EventKey = fields.get('EventKey')
+        self.Ticket = fields.get('Ticket')
 
     def save(self):
         msg = super(ScanEvent, self).save()
@@ -338,11 +397,13 @@ class LocationEvent(EventMsg):
         Precision (float): 地理位置精度
     """
 
-    def __init__(self, xmlData):
-        super(LocationEvent, self).__init__(xmlData)
-        self.Latitude = xmlData.find('Latitude').text
-        self.Longitude = xmlData.find('Longitude').text
-        self.Precision = xmlData.find('Precision').text
+    __slots__ = ('Latitude', 'Longitude', 'Precision')
+
+    def __init__(self, fields):
+        super(LocationEvent, self).__init__(fields)
+        self.Latitude = fields.get('Latitude')
+        self.Longitude = fields.get('Longitude')
+        self.Precision = fields.get('Precision')
 
     def save(self):
         msg = super(LocationEvent, self).save()
@@ -362,9 +423,11 @@ class ClickEvent(EventMsg):
         EventKey (str): 事件key值
     """
 
-    def __init__(self, xmlData):
-        super(ClickEvent, self).__init__(xmlData)
-        self.EventKey = xmlData.find('EventKey').text
+    __slots__ = ('EventKey', )
+
+    def __init__(self, fields):
+        super(ClickEvent, self).__init__(fields)
+        self.EventKey = fields.get('EventKey')
 
     def save(self):
         msg = super(ClickEvent, self).save()
@@ -382,12 +445,34 @@ class ViewEvent(EventMsg):
         EventKey (str): 设置跳转的url
     """
 
-    def __init__(self, xmlData):
-        super(ViewEvent, self).__init__(xmlData)
-        self.EventKey = xmlData.find('EventKey').text
+    __slots__ = ('EventKey', )
+
+    def __init__(self, fields):
+        super(ViewEvent, self).__init__(fields)
+        self.EventKey = fields.get('EventKey')
 
     def save(self):
         msg = super(ViewEvent, self).save()
         e = msg.event
         e.event_key = self.EventKey
         return msg
+
+
+# (MsgType, Event)到接收消息类的分发表, 普通消息的Event为None,
+# 未列出的事件使用('event', None)对应的事件基类
+MSG_TYPES = {
+    ('text', None): TextMsg,
+    ('image', None): ImageMsg,
+    ('voice', None): VoiceMsg,
+    ('video', None): VideoMsg,
+    ('shortvideo', None): VideoMsg,
+    ('location', None): LocationMsg,
+    ('link', None): LinkMsg,
+    ('event', None): EventMsg,
+    ('event', 'subscribe'): EventMsg,
+    ('event', 'unsubscribe'): EventMsg,
+    ('event', 'SCAN'): ScanEvent,
+    ('event', 'LOCATION'): LocationEvent,
+    ('event', 'CLICK'): ClickEvent,
+    ('event', 'VIEW'): ViewEvent,
+}
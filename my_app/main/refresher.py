@@ -0,0 +1,71 @@
+# coding: utf-8
+
+"""access_token后台刷新模块
+
+在access_token过期之前提前刷新, 使请求中的get_token不必等待微信服务器
+"""
+
+import random
+import time
+
+from my_app import db
+from my_app.models import Token
+from .background import Worker
+from . import tools
+
+
+class TokenRefresher(Worker):
+    """access_token后台刷新线程
+
+    每隔TOKEN_REFRESH_INTERVAL秒检查所有绑定的公众号, 对剩余有效期
+        不足TOKEN_REFRESH_AHEAD秒的access_token提前刷新. 每个公众号
+        每个有效期内另加一个不超过TOKEN_REFRESH_JITTER秒的随机提前量,
+        使各公众号, 各进程的刷新时间错开
+
+    Attributes:
+        ahead (int): 提前刷新的秒数
+        enabled (bool): 是否启用后台刷新
+        jitter (int): 随机提前量的上限秒数
+    """
+
+    def __init__(self, app=None):
+        super(TokenRefresher, self).__init__(app)
+        self.enabled = False
+        self.ahead = 600
+        self.jitter = 120
+        self._jitters = {}
+
+    def init_app(self, app):
+        super(TokenRefresher, self).init_app(app)
+        self.enabled = app.config['TOKEN_REFRESHER']
+        self.ahead = app.config['TOKEN_REFRESH_AHEAD']
+        self.jitter = app.config['TOKEN_REFRESH_JITTER']
+        self.interval = app.config['TOKEN_REFRESH_INTERVAL']
+        if self.enabled:
+            app.before_first_request(self.start)
+
+    def run_once(self):
+        now = int(time.time())
+        tokens = db.session.query(
+            Token.app_id, Token.access_token, Token.expired_time).all()
+        for app_id, access_token, expired_time in tokens:
+            ahead = self.ahead + self._jitter(app_id, expired_time)
+            if access_token is not None and \
+                    int(expired_time) - now > ahead:
+                continue
+            try:
+                tools.refresh_token(app_id, min_ttl=ahead)
+            except Exception:
+                self.app.logger.exception(
+                    'refresh access_token of %s failed', app_id)
+
+    def _jitter(self, app_id, expired_time):
+        """同一个有效期内使用同一个随机提前量"""
+        jitter = self._jitters.get(app_id)
+        if jitter is None or jitter[0] != expired_time:
+            jitter = (expired_time, random.uniform(0, self.jitter))
+            self._jitters[app_id] = jitter
+        return jitter[1]
+
+
+token_refresher = TokenRefresher()
@@ -5,12 +5,95 @@
 回复消息模块, 包含各种类型的回复
 """
 
-import xml.etree.ElementTree as et
+import operator
 import time
 
 from .. import models as models
 
 
+CDATA = 'cdata'
+TEXT = 'text'
+
+
+def escape_cdata(value):
+    """转换为CDATA中的文本, 文本中的]]>拆到两个CDATA段中"""
+    if value is None:
+        return ''
+    return str(value).replace(']]>', ']]]]><![CDATA[>')
+
+
+def to_text(value):
+    """转换为普通元素文本, 用于时间戳和数量等数字"""
+    if value is None:
+        return ''
+    return str(value)
+
+
+class Template(object):
+    """回复消息模板
+
+    按微信文档规定的元素顺序预先生成格式化字符串和取值函数,
+        渲染时一次取出全部属性, 转义后填入格式化字符串
+
+    Args:
+        fields (list): (属性名, 类型)列表, 类型为CDATA, TEXT,
+            子元素的(属性名, 类型)列表, 或者列表中每一项的Template
+        root (str, optional): 根元素名, 默认为xml
+    """
+
+    def __init__(self, fields, root='xml'):
+        self.root = root
+        paths = []
+        converters = []
+        self.format = '<%s>%s</%s>' % (
+            root, self._compile(fields, '', paths, converters), root)
+        self.getter = operator.attrgetter(*paths)
+        self.converters = converters
+        self.single = len(paths) == 1
+
+    def _compile(self, fields, prefix, paths, converters):
+        parts = []
+        for name, kind in fields:
+            if isinstance(kind, list):
+                parts.append('<%s>%s</%s>' % (name, self._compile(
+                    kind, prefix + name + '.', paths, converters), name))
+                continue
+
+            index = len(paths)
+            paths.append(prefix + name)
+            if kind == CDATA:
+                converters.append(escape_cdata)
+                parts.append('<%s><![CDATA[{%d}]]></%s>' % (name, index, name))
+            elif kind == TEXT:
+                converters.append(to_text)
+                parts.append('<%s>{%d}</%s>' % (name, index, name))
+            else:
+                converters.append(kind.render_all)
+                parts.append('<%s>{%d}</%s>' % (name, index, name))
+        return ''.join(parts)
+
+    def render(self, obj):
+        """将回复消息对象渲染成xml字符串"""
+        values = self.getter(obj)
+        if self.single:
+            values = (values, )
+        return self.format.format(*[
+            convert(value)
+            for convert, value in zip(self.converters, values)])
+
+    def render_all(self, objs):
+        """渲染列表中的每一项并拼接"""
+        return ''.join([self.render(obj) for obj in objs])
+
+
+HEAD_FIELDS = [
+    ('ToUserName', CDATA),
+    ('FromUserName', CDATA),
+    ('CreateTime', TEXT),
+    ('MsgType', CDATA),
+]
+
+
 class Msg(object):
     """回复消息基类
 
@@ -28,20 +111,40 @@ class Msg(object):
         self.FromUserName = FromUserName
         self.CreateTime = str(int(time.time()))
 
+    template = None
+
     def send(self):
         """回复消息的发送
 
-        发送方法, 将具体的回复消息类转换成xml字符串
+        发送方法, 用具体回复消息类的模板将其转换成xml字符串
 
         Returns:
-            str: 返回符合微信公众平台要求的xml字符串
+            bytes: 返回符合微信公众平台要求的utf-8编码xml字符串
         """
         try:
-            result = et.tostring(to_element(self), encoding='utf-8')
+            result = self.template.render(self).encode('utf-8')
         except Exception as e:
             result = 'success'
         return result
 
+    def to_custom(self):
+        """转换成客服消息
+
+        被动回复超时后, 改用客服消息接口发送同样的内容
+
+        Returns:
+            dict: 客服消息接口要求的json数据
+        """
+        return {
+            'touser': self.ToUserName,
+            'msgtype': self.MsgType,
+            self.MsgType: self.custom_content()
+        }
+
+    def custom_content(self):
+        """客服消息中对应消息类型的内容, 由具体回复消息类实现"""
+        raise NotImplementedError
+
     def save(self):
         """回复消息保存
 
@@ -68,11 +171,16 @@ class TextMsg(Msg):
         MsgType (str): 消息类型, text
     """
 
+    template = Template(HEAD_FIELDS + [('Content', CDATA)])
+
     def __init__(self, Content=None, **kwarg):
         super(TextMsg, self).__init__(**kwarg)
         self.Content = Content
         self.MsgType = 'text'
 
+    def custom_content(self):
+        return {'content': self.Content}
+
     def save(self):
         msg = super(TextMsg, self).save()
         msg.content = self.Content
@@ -89,11 +197,17 @@ class ImageMsg(Msg):
         MsgType (str): 消息类型, image
     """
 
+    template = Template(HEAD_FIELDS + [
+        ('Image', [('MediaId', CDATA)])])
+
     def __init__(self, Image=None, **kwarg):
         super(ImageMsg, self).__init__(**kwarg)
         self.Image = Image
         self.MsgType = 'image'
 
+    def custom_content(self):
+        return {'media_id': self.Image.MediaId}
+
     def save(self):
         msg = super(ImageMsg, self).save()
         media = models.Media.query.filter_by(
@@ -130,11 +244,17 @@ class VoiceMsg(Msg):
         Voice (Voice): Description
     """
 
+    template = Template(HEAD_FIELDS + [
+        ('Voice', [('MediaId', CDATA)])])
+
     def __init__(self, Voice=None, **kwarg):
         super(VoiceMsg, self).__init__(**kwarg)
         self.Voice = Voice
         self.MsgType = 'voice'
 
+    def custom_content(self):
+        return {'media_id': self.Voice.MediaId}
+
     def save(self):
         msg = super(VoiceMsg, self).save()
         media = models.Media.query.filter_by(
@@ -171,15 +291,27 @@ class VideoMsg(Msg):
         Video (Video): Description
     """
 
+    template = Template(HEAD_FIELDS + [
+        ('Video', [('MediaId', CDATA), ('Title', CDATA),
+                   ('Description', CDATA)])])
+
     def __init__(self, Video=None, **kwarg):
         super(VideoMsg, self).__init__(**kwarg)
         self.Video = Video
         self.MsgType = 'video'
 
+    def custom_content(self):
+        return {
+            'media_id': self.Video.MediaId,
+            'thumb_media_id': self.Video.ThumbMediaId,
+            'title': self.Video.Title,
+            'description': self.Video.Description
+        }
+
     def save(self):
         msg = super(VideoMsg, self).save()
         media = models.Media.query.filter_by(
-            media_id=self.Voice.MediaId).first()
+            media_id=self.Video.MediaId).first()
         if media is None:
             media = models.Media()
             media.media_type = 'video'
@@ -187,6 +319,8 @@ class VideoMsg(Msg):
             media.media_id = self.Video.MediaId
         media.title = self.Video.Title
         media.description = self.Video.Description
+        if self.Video.ThumbMediaId:
+            media.thumb_media_id = self.Video.ThumbMediaId
         msg.media = media
         return msg
 
@@ -199,13 +333,17 @@ class Video(object):
     Attributes:
         Description (str): 视频描述, 非必须项
         MediaId (str): 视频媒体id, 必须公众号上传的
+        ThumbMediaId (str): 缩略图的媒体id, 被动回复中不使用,
+            改用客服消息发送时必须
         Title (str): 视频标题, 非必须项
     """
 
-    def __init__(self, MediaId=None, Title='', Description=''):
+    def __init__(self, MediaId=None, Title='', Description='',
+                 ThumbMediaId=''):
         self.MediaId = MediaId
         self.Title = Title
         self.Description = Description
+        self.ThumbMediaId = ThumbMediaId
 
 
 class MusicMsg(Msg):
@@ -218,11 +356,25 @@ class MusicMsg(Msg):
         Music (Music): 音乐消息类
     """
 
+    template = Template(HEAD_FIELDS + [
+        ('Music', [('Title', CDATA), ('Description', CDATA),
+                   ('MusicUrl', CDATA), ('HQMusicUrl', CDATA),
+                   ('ThumbMediaId', CDATA)])])
+
     def __init__(self, Music=None, **kwarg):
         super(MusicMsg, self).__init__(**kwarg)
         self.Music = Music
         self.MsgType = 'music'
 
+    def custom_content(self):
+        return {
+            'title': self.Music.Title,
+            'description': self.Music.Description,
+            'musicurl': self.Music.MusicUrl,
+            'hqmusicurl': self.Music.HQMusicUrl,
+            'thumb_media_id': self.Music.ThumbMediaId
+        }
+
     def save(self):
         msg = super(MusicMsg, self).save()
         media = models.Media.query.filter_by(
@@ -273,12 +425,28 @@ class NewsMsg(Msg):
         MsgType (str): 图文消息类型, 默认为news
     """
 
+    template = Template(HEAD_FIELDS + [
+        ('ArticleCount', TEXT),
+        ('Articles', Template([('Title', CDATA), ('Description', CDATA),
+                               ('PicUrl', CDATA), ('Url', CDATA)],
+                              root='item'))])
+
     def __init__(self, Articles=[], **kwarg):
         super(NewsMsg, self).__init__(**kwarg)
         self.ArticleCount = len(Articles)
         self.Articles = Articles
         self.MsgType = 'news'
 
+    def custom_content(self):
+        return {
+            'articles': [{
+                'title': i.Title,
+                'description': i.Description,
+                'url': i.Url,
+                'picurl': i.PicUrl
+            } for i in self.Articles]
+        }
+
     def save(self):
         msg = super(NewsMsg, self).save()
 
@@ -316,33 +484,3 @@ class item(object):
         self.Description = Description
         self.PicUrl = PicUrl
         self.Url = Url
-
-
-def to_element(obj, root='xml'):
-    """消息格式转换函数
-
-    将相应的回复消息类转换成Element对象
-
-    Args:
-        obj (msg): 具体的回复消息类
-        root (str, optional): 可选的参数, 默认转换成的根元素为xml
-
-    Returns:
-        te.Element: 返回Element对象
-    """
-    e = et.Element(root)
-    for k in obj.__dict__:
-        if isinstance(getattr(obj, k), (str, unicode, int)):
-            if getattr(obj, k) != '':
-                sub_e = et.Element(k)
-                sub_e.text = unicode(getattr(obj, k))
-                e.append(sub_e)
-        elif isinstance(getattr(obj, k), type([])):
-            e_l = et.Element(k)
-            list_obj = getattr(obj, k)
-            for i in list_obj:
-                e_l.append(to_element(i, i.__class__.__name__))
-            e.append(e_l)
-        else:
-            e.append(to_element(getattr(obj, k), k))
-    return e
@@ -0,0 +1,190 @@
+# coding: utf-8
+
+"""消息数汇总模块
+
+接收消息时在内存中按公众号, 类型和小时计数, 后台线程定期把计数累加到
+    MsgRollup表, 按小时统计消息数时只需读取汇总表
+"""
+
+import collections
+import threading
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from my_app import db
+from my_app.models import Msg, Event, MsgRollup, Token
+from .background import Worker
+
+
+HOUR = 3600
+
+
+class RollupCounter(Worker):
+    """接收消息计数
+
+    record只在内存中计数, 后台线程每隔ROLLUP_FLUSH_INTERVAL秒把计数
+        累加到数据库, 进程退出时写入剩余的计数. 写入失败的计数留到
+        下次再写
+
+    Attributes:
+        enabled (bool): 是否启用计数
+    """
+
+    def __init__(self, app=None):
+        super(RollupCounter, self).__init__(app)
+        self.enabled = False
+        self._counts = collections.Counter()
+        self._counts_lock = threading.Lock()
+
+    def init_app(self, app):
+        super(RollupCounter, self).init_app(app)
+        self.enabled = app.config['MSG_ROLLUP']
+        self.interval = app.config['ROLLUP_FLUSH_INTERVAL']
+
+    def record(self, app_id, msg_type, event_type, create_time):
+        """记录一条接收消息
+
+        Args:
+            app_id (str): 公众号app_id
+            msg_type (str): 消息类型
+            event_type (str): 事件类型, 非事件消息为None
+            create_time (int): 消息创建时间戳
+        """
+        if not self.enabled:
+            return
+        hour = int(create_time) // HOUR * HOUR
+        with self._counts_lock:
+            self._counts[(app_id, hour, msg_type, event_type or '')] += 1
+        self.start()
+
+    def flush(self):
+        """把内存计数累加到数据库, 需要在app_context中调用"""
+        with self._counts_lock:
+            counts, self._counts = self._counts, collections.Counter()
+        if not counts:
+            return
+
+        # 其他进程同时插入同一个键时违反唯一约束, 回滚后重试即可更新
+        for attempt in range(3):
+            try:
+                for key, count in counts.items():
+                    self._add(key, count)
+                db.session.commit()
+                return
+            except IntegrityError:
+                db.session.rollback()
+            except Exception:
+                db.session.rollback()
+                break
+
+        with self._counts_lock:
+            self._counts.update(counts)
+        self.app.logger.error('rollup flush failed, %d keys kept',
+                              len(counts))
+
+    @staticmethod
+    def _add(key, count):
+        app_id, hour, msg_type, event_type = key
+        updated = MsgRollup.query.filter_by(
+            app_id=app_id, hour=hour, msg_type=msg_type,
+            event_type=event_type
+        ).update({'count': MsgRollup.count + count},
+                 synchronize_session=False)
+        if not updated:
+            db.session.add(MsgRollup(app_id=app_id, hour=hour,
+                                     msg_type=msg_type,
+                                     event_type=event_type, count=count))
+            db.session.flush()
+
+    def run_once(self):
+        self.flush()
+
+    def on_stop(self):
+        self.flush()
+
+
+msg_rollup = RollupCounter()
+
+
+def hourly_counts(app_id, start, end):
+    """按小时统计公众号的接收消息数
+
+    Args:
+        app_id (str): 公众号app_id
+        start (int): 开始时间戳
+        end (int): 结束时间戳, 不包括
+
+    Returns:
+        list: [start, end)内每个小时的(小时开始时间戳, 消息数)列表,
+            没有消息的小时为0
+    """
+    first = start // HOUR * HOUR
+    rows = db.session.query(MsgRollup.hour, func.sum(MsgRollup.count)) \
+        .filter(MsgRollup.app_id == app_id,
+                MsgRollup.hour >= first, MsgRollup.hour < end) \
+        .group_by(MsgRollup.hour)
+    counts = dict((hour, int(count)) for hour, count in rows)
+    return [(hour, counts.get(hour, 0)) for hour in range(first, end, HOUR)]
+
+
+def type_counts(app_id, start, end):
+    """按消息类型和事件类型统计公众号的接收消息数
+
+    Returns:
+        list: (消息类型, 事件类型, 消息数)列表, 按消息数从多到少排列
+    """
+    total = func.sum(MsgRollup.count)
+    rows = db.session.query(MsgRollup.msg_type, MsgRollup.event_type,
+                            total) \
+        .filter(MsgRollup.app_id == app_id,
+                MsgRollup.hour >= start // HOUR * HOUR,
+                MsgRollup.hour < end) \
+        .group_by(MsgRollup.msg_type, MsgRollup.event_type) \
+        .order_by(total.desc())
+    return [(msg_type, event_type, int(count))
+            for msg_type, event_type, count in rows]
+
+
+def rebuild(app_id):
+    """从消息记录重新生成公众号的汇总
+
+    已归档的消息不在数据库中, 只重新生成最早的未归档消息所在小时之后
+        的汇总, 之前的汇总保留. 最早的未归档消息所在的小时可能包含已
+        归档的消息, 也保留不变
+
+    Args:
+        app_id (str): 公众号app_id
+
+    Returns:
+        int: 生成的汇总行数
+
+    Raises:
+        ValueError: 公众号不存在
+    """
+    wechat_id = db.session.query(Token.wechat_id) \
+        .filter_by(app_id=app_id).scalar()
+    if wechat_id is None:
+        raise ValueError('unknown app_id %s' % app_id)
+    oldest = db.session.query(func.min(Msg.create_time)) \
+        .filter(Msg.to_username == wechat_id).scalar()
+    if oldest is None:
+        return 0
+    start = -(-oldest // HOUR) * HOUR
+
+    hour = Msg.create_time - Msg.create_time % HOUR
+    event_type = func.coalesce(Event.event_type, '')
+    rows = db.session.query(hour, Msg.msg_type, event_type,
+                            func.count(Msg.id)) \
+        .outerjoin(Event, Msg.event_id == Event.id) \
+        .filter(Msg.to_username == wechat_id, Msg.create_time >= start) \
+        .group_by(hour, Msg.msg_type, event_type).all()
+
+    MsgRollup.query.filter(MsgRollup.app_id == app_id,
+                           MsgRollup.hour >= start) \
+        .delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(MsgRollup, [
+        {'app_id': app_id, 'hour': h, 'msg_type': t, 'event_type': e,
+         'count': c} for h, t, e, c in rows])
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,172 @@
+# coding: utf-8
+
+"""关键词自动回复模块
+
+把公众号的自动回复规则编译成匹配器, 匹配耗时只与消息长度有关,
+    与规则数量无关
+"""
+
+import threading
+import time
+
+from my_app import db
+from my_app.models import Rule
+
+
+class KeywordMatcher(object):
+    """编译后的关键词匹配器
+
+    全文匹配使用字典, 前缀匹配使用trie树, 包含匹配使用Aho-Corasick自动机.
+        优先级为全文匹配, 前缀匹配, 包含匹配; 同一种匹配方式中关键词
+        越长越优先, 长度相同时先添加的规则优先. 匹配不区分英文大小写
+
+    Args:
+        rules (list): (id, match_type, keyword, content)列表
+    """
+
+    def __init__(self, rules):
+        self.exact = {}
+        # trie树和自动机的节点都以列表下标表示, 0为根节点
+        self.prefix_goto = [{}]
+        self.prefix_out = [None]
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]
+
+        for rule_id, match_type, keyword, content in sorted(rules):
+            keyword = (keyword or '').strip().lower()
+            if not keyword:
+                continue
+            if match_type == 'exact':
+                self.exact.setdefault(keyword, content)
+            elif match_type == 'prefix':
+                node = self._insert(self.prefix_goto, self.prefix_out,
+                                    None, keyword)
+                if self.prefix_out[node] is None:
+                    self.prefix_out[node] = content
+            elif match_type == 'contains':
+                node = self._insert(self.goto, self.out, self.fail, keyword)
+                if self.out[node] is None:
+                    self.out[node] = (len(keyword), -rule_id, content)
+        self._build_fail()
+
+    @staticmethod
+    def _insert(goto, out, fail, keyword):
+        node = 0
+        for ch in keyword:
+            child = goto[node].get(ch)
+            if child is None:
+                child = len(goto)
+                goto.append({})
+                out.append(None)
+                if fail is not None:
+                    fail.append(0)
+                goto[node][ch] = child
+            node = child
+        return node
+
+    def _build_fail(self):
+        """按广度优先计算失配指针, 并把失配节点的最优输出合并到本节点"""
+        goto, fail, out = self.goto, self.fail, self.out
+        queue = list(goto[0].values())
+        for node in queue:
+            for ch, child in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0) if node else 0
+                inherited = out[fail[child]]
+                if inherited is not None and \
+                        (out[child] is None or inherited > out[child]):
+                    out[child] = inherited
+                queue.append(child)
+
+    def match(self, text):
+        """匹配文本
+
+        Args:
+            text (str): 文本消息内容
+
+        Returns:
+            str: 匹配到的规则的回复内容, 没有匹配时返回None
+        """
+        text = (text or '').strip().lower()
+        content = self.exact.get(text)
+        if content is not None:
+            return content
+
+        node = 0
+        for ch in text:
+            node = self.prefix_goto[node].get(ch)
+            if node is None:
+                break
+            if self.prefix_out[node] is not None:
+                content = self.prefix_out[node]
+        if content is not None:
+            return content
+
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        best = None
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] is not None and (best is None or out[node] > best):
+                best = out[node]
+        return best[2] if best is not None else None
+
+
+class RuleEngine(object):
+    """自动回复规则引擎
+
+    按公众号缓存编译后的匹配器, 本进程修改规则后调用invalidate重新编译,
+        其他进程的修改在RULE_CACHE_TTL秒后生效
+
+    Attributes:
+        ttl (int): 匹配器缓存有效秒数
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 60
+        self._matchers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['RULE_CACHE_TTL']
+
+    def match(self, app_id, text):
+        """用公众号的规则匹配文本消息
+
+        Args:
+            app_id (str): 公众号app_id
+            text (str): 文本消息内容
+
+        Returns:
+            str: 回复内容, 没有匹配的规则时返回None
+        """
+        return self.get_matcher(app_id).match(text)
+
+    def get_matcher(self, app_id):
+        now = time.time()
+        with self._lock:
+            entry = self._matchers.get(app_id)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        rules = db.session.query(
+            Rule.id, Rule.match_type, Rule.keyword, Rule.content).filter_by(
+            app_id=app_id).all()
+        matcher = KeywordMatcher(rules)
+        with self._lock:
+            self._matchers[app_id] = (now + self.ttl, matcher)
+        return matcher
+
+    def invalidate(self, app_id):
+        with self._lock:
+            self._matchers.pop(app_id, None)
+
+
+rule_engine = RuleEngine()
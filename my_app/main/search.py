@@ -0,0 +1,219 @@
+# coding: utf-8
+
+"""消息全文搜索模块
+
+文本消息内容和语音识别结果在保存消息时同步写入全文索引, 按公众号
+    搜索, 结果按相关度排序并分页. SQLite使用FTS5的trigram分词,
+    MySQL使用ngram分词的FULLTEXT索引. 索引中保存了发送者, 接收者和
+    时间, 消息归档后仍可以搜索到
+"""
+
+from flask import current_app
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload
+
+from my_app import db
+from my_app.models import Msg
+from .cache import token_cache
+
+
+class SqliteBackend(object):
+    """SQLite FTS5索引, trigram分词支持中文任意子串搜索"""
+
+    def create(self, conn):
+        conn.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS msg_search USING fts5('
+            'body, to_username UNINDEXED, from_username UNINDEXED, '
+            'create_time UNINDEXED, tokenize=\'trigram\')'))
+
+    def insert(self, conn, rows):
+        conn.execute(text(
+            'INSERT OR REPLACE INTO msg_search (rowid, body, to_username, '
+            'from_username, create_time) VALUES (:msg_id, :body, '
+            ':to_username, :from_username, :create_time)'), rows)
+
+    def search(self, conn, account, terms, limit, offset):
+        # trigram索引只能匹配不少于3个字符的词, 更短的词逐行查找
+        long_terms = [t for t in terms if len(t) >= 3]
+        short_terms = [t for t in terms if len(t) < 3]
+        where = ['(to_username = :account OR from_username = :account)']
+        params = {'account': account, 'limit': limit, 'offset': offset}
+        if long_terms:
+            where.append('msg_search MATCH :match')
+            params['match'] = ' AND '.join(
+                '"%s"' % t.replace('"', '""') for t in long_terms)
+        for i, term in enumerate(short_terms):
+            where.append('instr(body, :term%d) > 0' % i)
+            params['term%d' % i] = term
+        order = 'rank, ' if long_terms else ''
+        return conn.execute(text(
+            'SELECT rowid AS msg_id, to_username, from_username, '
+            'create_time, body FROM msg_search WHERE ' +
+            ' AND '.join(where) +
+            ' ORDER BY ' + order + 'create_time DESC '
+            'LIMIT :limit OFFSET :offset'), **params).fetchall()
+
+
+class MysqlBackend(object):
+    """MySQL FULLTEXT索引, ngram分词支持中文搜索"""
+
+    def create(self, conn):
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS msg_search ('
+            'msg_id INTEGER PRIMARY KEY, body TEXT, '
+            'to_username VARCHAR(255), from_username VARCHAR(255), '
+            'create_time INTEGER, '
+            'KEY ix_msg_search_to_username (to_username), '
+            'KEY ix_msg_search_from_username (from_username), '
+            'FULLTEXT KEY ft_msg_search_body (body) WITH PARSER ngram'
+            ') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4'))
+
+    def insert(self, conn, rows):
+        conn.execute(text(
+            'REPLACE INTO msg_search (msg_id, body, to_username, '
+            'from_username, create_time) VALUES (:msg_id, :body, '
+            ':to_username, :from_username, :create_time)'), rows)
+
+    def search(self, conn, account, terms, limit, offset):
+        match = ' '.join('+"%s"' % t.replace('"', ' ') for t in terms)
+        return conn.execute(text(
+            'SELECT msg_id, to_username, from_username, create_time, body '
+            'FROM msg_search WHERE MATCH (body) AGAINST (:match IN BOOLEAN '
+            'MODE) AND (to_username = :account OR from_username = :account) '
+            'ORDER BY MATCH (body) AGAINST (:match IN BOOLEAN MODE) DESC, '
+            'create_time DESC LIMIT :limit OFFSET :offset'),
+            match=match, account=account, limit=limit,
+            offset=offset).fetchall()
+
+
+BACKENDS = {
+    'sqlite': SqliteBackend,
+    'mysql': MysqlBackend
+}
+
+
+class SearchIndex(object):
+    """消息全文索引
+
+    init_app后按数据库类型选择索引实现并创建索引表, 不支持的数据库或
+        不能创建索引表时(如SQLite没有FTS5或trigram分词, MySQL没有ngram
+        分词)不启用搜索, 保存消息时也不写索引
+
+    Attributes:
+        backend: 索引实现, 未启用时为None
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """创建索引表, 需在应用上下文中调用"""
+        backend = BACKENDS.get(db.engine.dialect.name)
+        if backend is None:
+            app.logger.warning('full text search is not supported on %s',
+                               db.engine.dialect.name)
+            self.backend = None
+            return
+        try:
+            with db.engine.begin() as conn:
+                backend().create(conn)
+        except SQLAlchemyError as e:
+            app.logger.warning('full text search is disabled, can not '
+                               'create index table: %s', e)
+            self.backend = None
+            return
+        self.backend = backend()
+
+    def index(self, conn, msgs):
+        """把消息写入索引, 没有文本的消息跳过
+
+        索引写在保存点中, 写入失败只回滚保存点并记录日志, 不影响同一
+            事务中保存的消息
+
+        Args:
+            conn: 数据库连接, 与保存消息使用同一个事务
+            msgs (list): Msg对象列表
+        """
+        if self.backend is None:
+            return
+        rows = []
+        for m in msgs:
+            body = m.content
+            # 只使用已加载的素材, 避免在flush过程中查询数据库
+            media = m.__dict__.get('media')
+            if not body and media is not None:
+                body = media.voice_recognition
+            if body:
+                rows.append({
+                    'msg_id': m.id,
+                    'body': body,
+                    'to_username': m.to_username,
+                    'from_username': m.from_username,
+                    'create_time': m.create_time
+                })
+        if not rows:
+            return
+        try:
+            with conn.begin_nested():
+                self.backend.insert(conn, rows)
+        except SQLAlchemyError as e:
+            current_app.logger.warning('index messages failed: %s', e)
+
+    def search(self, app_id, query, page=1, per_page=20):
+        """搜索公众号收发的消息
+
+        Args:
+            app_id (str): 公众号app_id
+            query (str): 搜索词, 空格分隔的多个词需同时出现
+            page (int, optional): 页码, 从1开始
+            per_page (int, optional): 每页结果数
+
+        Returns:
+            tuple: (结果列表, 是否有下一页), 结果包括msg_id, from_username,
+                to_username, create_time, body, 按相关度排序
+        """
+        terms = (query or '').split()
+        t = token_cache.get(app_id=app_id)
+        if self.backend is None or not terms or t is None:
+            return [], False
+        rows = self.backend.search(db.session.connection(), t.wechat_id,
+                                   terms, per_page + 1,
+                                   (page - 1) * per_page)
+        return rows[:per_page], len(rows) > per_page
+
+    def rebuild(self, batch_size=5000):
+        """用数据库中的消息重新写入索引
+
+        已有的索引行被替换, 已归档消息的索引行保留
+
+        Returns:
+            int: 处理的消息数
+        """
+        if self.backend is None:
+            return 0
+        conn = db.session.connection()
+        count = 0
+        last_id = 0
+        while True:
+            msgs = Msg.query.options(joinedload(Msg.media)) \
+                .filter(Msg.id > last_id).order_by(Msg.id) \
+                .limit(batch_size).all()
+            if not msgs:
+                break
+            self.index(conn, msgs)
+            count += len(msgs)
+            last_id = msgs[-1].id
+            db.session.expunge_all()
+        db.session.commit()
+        return count
+
+
+search_index = SearchIndex()
+
+
+@event.listens_for(Msg, 'after_insert')
+def index_msg(mapper, connection, target):
+    search_index.index(connection, [target])
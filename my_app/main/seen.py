@@ -0,0 +1,249 @@
+# coding: utf-8
+
+"""新用户发现模块
+
+每个公众号一个布隆过滤器, 记录已在User表中的openid. 接收消息时只在
+    内存中检查发送者的openid, 已知用户不读数据库; 过滤器中没有的openid
+    进入队列, 由后台线程批量创建用户并获取资料. 布隆过滤器有很小的
+    误判率, 被误判为已知的新用户由订阅用户同步补上
+"""
+
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+
+from my_app import db
+from my_app.models import Token, User
+from .background import Worker
+from . import users
+
+
+class BloomFilter(object):
+    """布隆过滤器
+
+    只有一个线程调用add时, 其他线程可以同时检查
+
+    Args:
+        capacity (int): 预计的元素数
+        error_rate (float): 元素数不超过capacity时的误判率
+
+    Attributes:
+        capacity (int): 预计的元素数
+        count (int): 已添加的次数, 重复添加的元素也计数
+        max_user_id (int): 已添加的User的最大id, 加载后从这里补充新用户
+    """
+
+    HEADER = struct.Struct('>4sQIQQQ')
+    MAGIC = b'BLM1'
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / capacity * math.log(2))))
+        self.count = 0
+        self.max_user_id = 0
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('>QQ', digest)
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        """原子地写入文件"""
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.capacity,
+                                     self.num_hashes, self.num_bits,
+                                     self.count, self.max_user_id))
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """从文件读取, 文件不存在或损坏时返回None"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(cls.HEADER.size)
+                bits = bytearray(f.read())
+        except (IOError, OSError):
+            return None
+        if len(header) != cls.HEADER.size:
+            return None
+        magic, capacity, num_hashes, num_bits, count, max_user_id = \
+            cls.HEADER.unpack(header)
+        if magic != cls.MAGIC or len(bits) != (num_bits + 7) // 8:
+            return None
+        bf = cls.__new__(cls)
+        bf.capacity = capacity
+        bf.num_hashes = num_hashes
+        bf.num_bits = num_bits
+        bf.count = count
+        bf.max_user_id = max_user_id
+        bf.bits = bits
+        return bf
+
+
+class SeenUsers(Worker):
+    """按公众号记录已知的openid, 发现新用户
+
+    后台线程启动后先为所有公众号加载过滤器, 文件中没有的从User表
+        重新生成, 之后每隔SEEN_INTERVAL秒处理新openid队列, 每隔
+        SEEN_SAVE_INTERVAL秒保存有变化的过滤器. 过滤器加载完成前
+        收到的openid都进入队列, 由后台线程查询数据库后再确定是否为新用户
+
+    Attributes:
+        enabled (bool): 是否启用新用户发现
+        folder (str): 过滤器文件目录
+        error_rate (float): 过滤器的误判率
+        min_capacity (int): 每个过滤器的最小容量
+        batch_size (int): 队列中超过这个数量时立即处理
+        save_interval (float): 保存过滤器的间隔秒数
+    """
+
+    def __init__(self, app=None):
+        super(SeenUsers, self).__init__(app)
+        self.enabled = False
+        self.folder = None
+        self.error_rate = 0.001
+        self.min_capacity = 100000
+        self.batch_size = 500
+        self.save_interval = 300
+        self._filters = {}
+        self._dirty = set()
+        self._saved_at = time.time()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def init_app(self, app):
+        super(SeenUsers, self).init_app(app)
+        self.enabled = app.config['SEEN_USERS']
+        self.folder = app.config['SEEN_FOLDER']
+        self.error_rate = app.config['SEEN_ERROR_RATE']
+        self.min_capacity = app.config['SEEN_MIN_CAPACITY']
+        self.interval = app.config['SEEN_INTERVAL']
+        self.batch_size = app.config['SEEN_BATCH_SIZE']
+        self.save_interval = app.config['SEEN_SAVE_INTERVAL']
+        if self.enabled:
+            app.before_first_request(self.start)
+
+    def check(self, app_id, openid):
+        """检查openid是否为新用户, 新用户进入队列
+
+        只读内存, 不访问数据库
+
+        Args:
+            app_id (str): 公众号app_id
+            openid (str): 用户openid
+
+        Returns:
+            bool: openid是否可能为新用户
+        """
+        if not self.enabled:
+            return False
+        bf = self._filters.get(app_id)
+        if bf is not None and openid in bf:
+            return False
+        with self._pending_lock:
+            self._pending[(app_id, openid)] = None
+            full = len(self._pending) >= self.batch_size
+        self.start()
+        if full:
+            self.wakeup()
+        return True
+
+    def path(self, app_id):
+        return os.path.join(self.folder, app_id + '.bloom')
+
+    def load(self, app_id):
+        """加载公众号的过滤器并补上文件保存后新增的用户, 没有文件时重新生成"""
+        bf = BloomFilter.load(self.path(app_id))
+        if bf is None or not self._fill(app_id, bf):
+            bf = self.build(app_id)
+        self._filters[app_id] = bf
+        self._dirty.add(app_id)
+        return bf
+
+    def build(self, app_id):
+        """从User表生成公众号的过滤器, 容量为现有用户数的两倍"""
+        count = User.query.filter_by(app_id=app_id).count()
+        bf = BloomFilter(max(self.min_capacity, count * 2), self.error_rate)
+        self._fill(app_id, bf)
+        return bf
+
+    @staticmethod
+    def _fill(app_id, bf):
+        """把id大于bf.max_user_id的用户加入过滤器, 超出容量时返回False"""
+        rows = db.session.query(User.id, User.openid) \
+            .filter(User.app_id == app_id, User.id > bf.max_user_id) \
+            .order_by(User.id)
+        for pk, openid in rows.yield_per(10000):
+            if openid:
+                bf.add(openid)
+            bf.max_user_id = pk
+        return bf.count <= bf.capacity
+
+    def save(self):
+        """保存有变化的过滤器"""
+        if not self._dirty:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        dirty, self._dirty = self._dirty, set()
+        for app_id in dirty:
+            self._filters[app_id].save(self.path(app_id))
+        self._saved_at = time.time()
+
+    def drain(self):
+        """为队列中的新openid创建用户, 并加入过滤器"""
+        with self._pending_lock:
+            pending = list(self._pending)
+        if not pending:
+            return
+        by_app = {}
+        for app_id, openid in pending:
+            by_app.setdefault(app_id, []).append(openid)
+        for app_id, openids in by_app.items():
+            bf = self._filters.get(app_id) or self.load(app_id)
+            users.enrich_users(app_id, openids)
+            for openid in openids:
+                bf.add(openid)
+            if bf.count > bf.capacity:
+                # 超出容量后误判率上升, 按现在的用户数重新生成
+                self._filters[app_id] = self.build(app_id)
+            self._dirty.add(app_id)
+            with self._pending_lock:
+                for openid in openids:
+                    self._pending.pop((app_id, openid), None)
+
+    def run_once(self):
+        for app_id, in db.session.query(Token.app_id):
+            if app_id not in self._filters:
+                self.load(app_id)
+        self.drain()
+        if time.time() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def on_stop(self):
+        self.drain()
+        self.save()
+
+
+seen_users = SeenUsers()
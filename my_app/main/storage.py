@@ -0,0 +1,132 @@
+# coding: utf-8
+
+"""素材文件存储
+
+素材文件按内容的sha256命名, 分两级子目录保存在UPLOAD_FOLDER下,
+    如uploads/ab/cd/abcd....jpg. 内容相同的素材无论属于哪个公众号
+    都只保存一份, Media.locale_url指向同一个文件. UPLOAD_FOLDER需在
+    static目录中, locale_url为相对于static目录的路径; 写入中的临时
+    文件在static目录之外的MEDIA_TMP_FOLDER中
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+
+
+class MediaStore(object):
+    """内容寻址的素材存储
+
+    不依赖应用上下文, 可以在线程池中使用
+
+    Attributes:
+        root (str): 存储根目录, 即UPLOAD_FOLDER
+        static_root (str): static目录, locale_url相对于这个目录
+        prefix (str): locale_url的前缀, 即root相对于static目录的路径
+        tmp_root (str): 临时文件目录, 即MEDIA_TMP_FOLDER
+        chunk_size (int): 读写文件的分块字节数
+    """
+
+    def __init__(self, app=None):
+        self.root = None
+        self.static_root = None
+        self.prefix = 'uploads/'
+        self.tmp_root = None
+        self.chunk_size = 65536
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config['UPLOAD_FOLDER']
+        self.static_root = app.static_folder
+        self.prefix = os.path.relpath(self.root, self.static_root) \
+            .replace(os.sep, '/') + '/'
+        self.tmp_root = app.config['MEDIA_TMP_FOLDER']
+        self.chunk_size = app.config['MEDIA_CHUNK_SIZE']
+
+    @property
+    def tmp_dir(self):
+        """写入中的临时文件目录, 在static目录之外, 不会被公开访问"""
+        path = self.tmp_root
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    def tmp_path(self, name=None):
+        """临时文件路径, 未指定name时生成一个不重复的名称"""
+        return os.path.join(self.tmp_dir, name or uuid.uuid4().hex)
+
+    def path(self, locale_url):
+        """locale_url对应的本地文件路径"""
+        return os.path.join(self.static_root, locale_url)
+
+    def exists(self, locale_url):
+        return bool(locale_url) and os.path.exists(self.path(locale_url))
+
+    def put_file(self, src, ext, digest=None):
+        """把临时文件移入存储
+
+        已有相同内容的文件时删除src, 否则原子地重命名到分片目录
+
+        Args:
+            src (str): 临时文件路径, 应在tmp_dir中
+            ext (str): 扩展名, 如.jpg
+            digest (str, optional): 已计算好的sha256十六进制摘要
+
+        Returns:
+            str: 文件的locale_url
+        """
+        if digest is None:
+            digest = self.hash_file(src)
+        relative = '/'.join((digest[:2], digest[2:4], digest + ext.lower()))
+        dest = os.path.join(self.root, relative)
+        if os.path.exists(dest):
+            os.remove(src)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                os.replace(src, dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # 临时目录在其他文件系统时先复制到目标目录, 再原子地重命名
+                tmp = '%s.%s.tmp' % (dest, uuid.uuid4().hex)
+                shutil.copyfile(src, tmp)
+                os.replace(tmp, dest)
+                os.remove(src)
+        return self.prefix + relative
+
+    def put_stream(self, stream, ext):
+        """分块读取类文件对象写入存储, 内存占用与文件大小无关
+
+        Args:
+            stream (file-like): 可读的类文件对象
+            ext (str): 扩展名, 如.jpg
+
+        Returns:
+            str: 文件的locale_url
+        """
+        sha = hashlib.sha256()
+        tmp = self.tmp_path()
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                    sha.update(chunk)
+                    f.write(chunk)
+            return self.put_file(tmp, ext, sha.hexdigest())
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def hash_file(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+
+media_store = MediaStore()
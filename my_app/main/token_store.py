@@ -0,0 +1,106 @@
+# coding: utf-8
+
+"""多进程共享的access_token存储
+
+多个worker进程各自刷新access_token时, 后刷新的会使之前的失效.
+    这里用一个sqlite文件保存最新的access_token, 并用文件锁保证
+    同一个app_id同时只有一个进程刷新
+"""
+
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:  # windows下没有fcntl, 只能做到进程内互斥
+    fcntl = None
+
+
+class TokenStore(object):
+    """共享access_token存储
+
+    TOKEN_STORE_PATH为空时不启用, get总是返回None, set和lock不做任何事
+
+    Attributes:
+        path (str): sqlite文件路径, 锁文件放在同名的.locks目录下
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['TOKEN_STORE_PATH']
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def get(self, app_id):
+        """读取共享的access_token
+
+        Args:
+            app_id (str): 公众号app_id
+
+        Returns:
+            tuple: (access_token, expired_time), 没有记录时返回None
+        """
+        if not self.enabled:
+            return None
+        return self._connect().execute(
+            'SELECT access_token, expired_time FROM token WHERE app_id = ?',
+            (app_id, )).fetchone()
+
+    def set(self, app_id, access_token, expired_time):
+        """保存刷新后的access_token"""
+        if not self.enabled:
+            return
+        self._connect().execute(
+            'INSERT OR REPLACE INTO token (app_id, access_token, '
+            'expired_time) VALUES (?, ?, ?)',
+            (app_id, access_token, int(expired_time)))
+
+    @contextlib.contextmanager
+    def lock(self, app_id):
+        """持有app_id对应的文件锁, 其他进程在此期间阻塞等待"""
+        if not self.enabled or fcntl is None:
+            yield
+            return
+
+        lock_dir = self.path + '.locks'
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:
+                if not os.path.isdir(lock_dir):
+                    raise
+        name = hashlib.md5(app_id.encode('utf-8')).hexdigest()
+        with open(os.path.join(lock_dir, name + '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _connect(self):
+        """每个线程使用自己的连接, fork后的子进程重新连接"""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS token ('
+                         'app_id TEXT PRIMARY KEY, access_token TEXT, '
+                         'expired_time INTEGER)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+
+token_store = TokenStore()
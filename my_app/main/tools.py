@@ -1,17 +1,33 @@
 # coding: utf-8
 
+import concurrent.futures
 import hashlib
-import urllib
 import json
+import mimetypes
 import time
 import os
+import threading
+import weakref
 
-from flask import current_app, make_response, send_file
+from flask import current_app, abort, send_file
+from sqlalchemy import func
 
 import requests
 
 from my_app.models import Token, Media
 from my_app import db
+from .cache import token_cache
+from .token_store import token_store
+from .client import client, MultipartFile
+from .storage import media_store
+
+
+# 临时素材有效秒数
+MEDIA_EXPIRES = 259200
+# 临时素材类型
+MEDIA_TYPES = ('image', 'voice', 'video', 'thumb')
+# access_token无效或过期, 刷新后重试
+TOKEN_ERRCODES = (40001, 40014, 42001)
 
 
 def check_signature(signature, timestamp, nonce, token):
@@ -60,16 +76,15 @@ def get_fresh_token(app_id, app_secret):
         'secret': app_secret
     }
 
-    res = urllib.request.urlopen(
-        current_app.config['ACCESS_TOKEN_URL'], urllib.parse.urlencode(data))
-    result = json.loads(res.read())
+    res = client.post(current_app.config['ACCESS_TOKEN_URL'], data=data)
+    result = res.json()
     return result
 
 
 def get_token(app_id):
     """本地获取access_token
 
-    通过app_id在数据库中查找对应的access_token
+    优先读取多进程共享的access_token, 没有时在数据库中查找, 已过期时刷新
 
     Args:
         app_id: 要获取access_token的app_id, 字符串
@@ -78,139 +93,481 @@ def get_token(app_id):
         返回可用的access_token值
         str
     """
-    at = Token.query.filter_by(app_id=app_id).first()
     current_time = int(time.time())
+    stored = token_store.get(app_id)
+    if stored is not None and current_time <= stored[1]:
+        return stored[0]
 
+    at = token_cache.get(app_id=app_id)
     if at.access_token is None or current_time > int(at.expired_time):
-        app_secret = at.app_secret
-        result = get_fresh_token(app_id, app_secret)
-        access_token = result['access_token']
-        expires_in = result['expires_in']
-        at.access_token = access_token
-        at.expired_time = current_time + int(expires_in)
-        db.session.commit()
-        return access_token
+        return refresh_token(app_id)
     else:
         return at.access_token
 
 
-def upload_media(app_id, files, media_type):
-    """上传临时素材函数
+class _Flight(object):
+    """一次进行中的access_token刷新, 供等待的线程获取结果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def refresh_token(app_id, min_ttl=0):
+    """刷新access_token
+
+    同一进程中同一app_id同时只有一个线程向微信服务器请求,
+        其他同时调用的线程等待它的结果; 多个进程之间由共享存储的
+        文件锁保证只有一个进程请求, 其余进程读取它保存的结果
+
+    Args:
+        app_id (str): 公众号app_id
+        min_ttl (int, optional): 现有access_token剩余有效秒数
+            超过min_ttl时不再刷新, 直接返回现有的值
+
+    Returns:
+        str: 可用的access_token
+    """
+    with _flights_lock:
+        flight = _flights.get(app_id)
+        leader = flight is None
+        if leader:
+            flight = _flights[app_id] = _Flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _refresh_token(app_id, min_ttl)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[app_id]
+        flight.done.set()
+    return flight.result
+
+
+def _refresh_token(app_id, min_ttl):
+    with token_store.lock(app_id):
+        # 发现过期后到这里之间可能已被其他线程或进程刷新, 重新读取后再判断
+        token_cache.invalidate(app_id=app_id)
+        at = token_cache.get(app_id=app_id)
+        access_token, expired_time = at.access_token, at.expired_time
+        stored = token_store.get(app_id)
+        if stored is not None and \
+                (expired_time is None or stored[1] > int(expired_time)):
+            access_token, expired_time = stored
+
+        current_time = int(time.time())
+        if access_token is not None and \
+                int(expired_time) - current_time > min_ttl:
+            if stored is None or stored[0] != access_token:
+                token_store.set(app_id, access_token, expired_time)
+            return access_token
+
+        result = get_fresh_token(app_id, at.app_secret)
+        access_token = result['access_token']
+        expired_time = current_time + int(result['expires_in'])
+        token_store.set(app_id, access_token, expired_time)
+
+    Token.query.filter_by(app_id=app_id).update({
+        'access_token': access_token,
+        'expired_time': expired_time
+    })
+    db.session.commit()
+    token_cache.invalidate(app_id=app_id)
+    return access_token
+
+
+def send_custom_message(app_id, data):
+    """发送客服消息
 
     Args:
         app_id (str): 微信公众号app_id
-        files (file-like): 需要上传的类文件对象
-        media_type (str): 临时素材的类型, image, voice, video, thumb
+        data (dict): 客服消息接口要求的json数据, 见reply.Msg.to_custom
 
     Returns:
-        response: Requests库返回的响应对象
+        dict: 微信服务器返回的结果
+
+    Raises:
+        ValueError: 微信服务器返回错误, access_token失效时刷新后重试一次
     """
+    url = current_app.config['CUSTOM_SEND_URL']
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
     token = get_token(app_id)
-    data = {
-        'access_token': token,
-        'type': media_type
+    for retry in (True, False):
+        res = client.post(url, params={'access_token': token}, data=body)
+        r = res.json()
+        if not r.get('errcode'):
+            return r
+        if not retry or r['errcode'] not in TOKEN_ERRCODES:
+            raise ValueError(res.text)
+        # access_token有效期不超过7200秒, 这样总会重新获取
+        token = refresh_token(app_id, min_ttl=7200)
+
+
+def upload_media(app_id, files, media_type, progress=None):
+    """批量上传临时素材
+
+    每个文件分块写入素材存储后, 再从存储中流式上传到微信服务器, 不会把
+        整个文件读入内存. 上传在有限大小的线程池中并发进行, 成功的
+        素材记录在最后一个事务中一次性写入
+
+    Args:
+        app_id (str): 微信公众号app_id
+        files (list): (文件名, 类文件对象或本地文件路径)列表
+        media_type (str): 临时素材的类型, image, voice, video, thumb
+        progress (optional): 进度回调函数, 每完成一个上传调用一次,
+            参数为已完成数和总数
+
+    Returns:
+        dict: 上传结果, 包括uploaded成功的(文件名, media_id)列表,
+            failed失败的(文件名, 错误信息)列表
+    """
+    config = current_app.config
+    access_token = get_token(app_id)
+    url = config['ADD_MEDIA_URL']
+    result = {
+        'uploaded': [],
+        'failed': []
     }
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=config['MEDIA_UPLOAD_WORKERS']) as executor:
+        futures = dict(
+            (executor.submit(_upload_one, url, access_token, media_type,
+                             filename, source, config['MEDIA_CHUNK_SIZE']),
+             filename)
+            for filename, source in files)
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            done += 1
+            try:
+                row = future.result()
+            except Exception as e:
+                result['failed'].append((filename, str(e)))
+                current_app.logger.warning(
+                    'upload media %s failed: %s', filename, e)
+            else:
+                row['app_id'] = app_id
+                rows.append(row)
+                result['uploaded'].append((filename, row['media_id']))
+            if progress is not None:
+                progress(done, len(futures))
+
+    if rows:
+        db.session.bulk_insert_mappings(Media, rows)
+        db.session.commit()
+    return result
+
+
+def _upload_one(url, access_token, media_type, filename, source,
+                chunk_size):
+    """保存并上传一个素材文件, 不使用应用上下文, 可以在线程池中执行
+
+    Returns:
+        dict: Media的字段值
+    """
+    ext = os.path.splitext(filename)[1]
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            locale_url = media_store.put_stream(f, ext)
+    else:
+        locale_url = media_store.put_stream(source, ext)
 
-    media_file = {
-        'files': (files.filename, files.read())
+    body = MultipartFile('media', filename, media_store.path(locale_url),
+                         chunk_size)
+    params = {
+        'access_token': access_token,
+        'type': media_type
     }
-    url = current_app.config['ADD_MEDIA_URL']
-    res = requests.post(url, files=media_file, data=data)
+    try:
+        res = client.post(url, params=params, data=body,
+                          headers={'Content-Type': body.content_type})
+    finally:
+        body.close()
     r = res.json()
 
-    media_id = ''
     if media_type == 'thumb':
-        media_id = r['thumb_media_id']
+        media_id = r.get('thumb_media_id')
     else:
-        media_id = r['media_id']
-    created_at = r['created_at']
-
-    filename = media_id + os.path.splitext(files.filename)[1]
-    save_path = os.path.join(
-        current_app.config['UPLOAD_FOLDER'], filename
-    ).replace('\\', '/')
-    files.seek(0, 0)
-    files.save(save_path)
-
-    t = Token.query.filter_by(app_id=app_id).first()
-
-    media = Media()
-    media.media_id = media_id
-    media.media_type = media_type
-    media.created_at = int(created_at)
-    media.locale_url = 'uploads/' + filename
-    media.app = t
-
-    db.session.add(media)
-    db.session.commit()
+        media_id = r.get('media_id')
+    if not media_id:
+        raise ValueError(res.text)
+
+    return {
+        'media_id': media_id,
+        'media_type': media_type,
+        'created_at': int(r['created_at']),
+        'locale_url': locale_url
+    }
+
+
+def media_page(app_id, cursors, per_page):
+    """分类型分页获取素材
 
-    return res
+    一次分组查询得到各类型的素材数, 再用一个UNION ALL查询取出各类型
+        id大于游标的下一页, 最多只加载每种类型per_page个素材对象
+
+    Args:
+        app_id (str): 微信公众号app_id
+        cursors (dict): 素材类型到游标的映射, 游标为上一页最后一个素材的id
+        per_page (int): 每种类型每页的素材数
+
+    Returns:
+        dict: 素材类型到分页结果的映射, 分页结果包括count素材总数,
+            items本页素材列表, next下一页的游标, 没有下一页时为None
+    """
+    counts = dict(db.session.query(Media.media_type, func.count(Media.id))
+                  .filter(Media.app_id == app_id)
+                  .group_by(Media.media_type))
+
+    # 每种类型的子查询各自排序和限制行数, 外面套一层派生表, 才能用在
+    # UNION ALL及IN子查询中
+    pages = []
+    for media_type in MEDIA_TYPES:
+        sub = db.session.query(Media.id).filter(
+            Media.app_id == app_id,
+            Media.media_type == media_type,
+            Media.id > cursors.get(media_type, 0)
+        ).order_by(Media.id).limit(per_page + 1).subquery()
+        pages.append(db.session.query(sub.c.id))
+    ids = pages[0].union_all(*pages[1:])
+    medias = Media.query.filter(Media.id.in_(ids)) \
+        .order_by(Media.media_type, Media.id).all()
+
+    result = {}
+    for media_type in MEDIA_TYPES:
+        items = [m for m in medias if m.media_type == media_type]
+        result[media_type] = {
+            'count': counts.get(media_type, 0),
+            'items': items[:per_page],
+            'next': items[per_page - 1].id if len(items) > per_page
+            else None
+        }
+    return result
 
 
-def update_media(app_id):
+def update_media(app_id, progress=None):
     """更新所有未到期的临时素材
 
-    通过app_id查找数据库中存在记录的素材, 下载本地不存在素材
-    并在数据库中标记素材地址
+    根据数据库记录和本地文件判断缺失的素材, 只下载缺失的素材,
+        下载在有限大小的线程池中并发进行, 最后一次性提交所有素材地址
 
     Args:
         app_id (str): 所需要更新素材的公众号app_id
-    """
-    access_token = get_token(app_id)
-    t = Token.query.filter_by(app_id=app_id).first()
-    medias = t.medias
-    url = current_app.config['GET_MEDIA_URL']
-    for m in medias:
-        params = {
-            'access_token': access_token,
-            'media_id': m.media_id
-        }
-        now = int(time.time())
-        if now - m.created_at < 259200:
-            res = requests.get(url, params=params)
-            filename = res.headers.get('Content-disposition').split('"')[1]
-            save_path = os.path.join(
-                current_app.config['UPLOAD_FOLDER'], filename
-            )
+        progress (optional): 进度回调函数, 每完成一个下载调用一次,
+            参数为已完成数和需下载总数
 
-            if not os.path.exists(save_path):
-                with open(save_path, 'wb+') as f:
-                    f.write(res.content)
+    Returns:
+        dict: 更新结果, 包括total未到期素材数, skipped本地已有数,
+            downloaded下载数, failed下载失败的(media_id, 错误信息)列表
+    """
+    config = current_app.config
+    expired = int(time.time()) - MEDIA_EXPIRES
+    rows = db.session.query(Media.id, Media.media_id, Media.locale_url) \
+        .filter(Media.app_id == app_id, Media.created_at > expired).all()
+
+    missing = [(row.id, row.media_id) for row in rows
+               if not media_store.exists(row.locale_url)]
+    result = {
+        'total': len(rows),
+        'skipped': len(rows) - len(missing),
+        'downloaded': 0,
+        'failed': []
+    }
+    if not missing:
+        return result
 
-            m.locale_url = 'uploads/' + filename
-            db.session.add(m)
+    access_token = get_token(app_id)
+    url = config['GET_MEDIA_URL']
+    updates = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=config['MEDIA_SYNC_WORKERS']) as executor:
+        futures = dict(
+            (executor.submit(fetch_media, url, access_token, media_id,
+                             config['MEDIA_CHUNK_SIZE'],
+                             config['MEDIA_DOWNLOAD_RETRIES']),
+             (pk, media_id))
+            for pk, media_id in missing)
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            pk, media_id = futures[future]
+            done += 1
+            try:
+                locale_url = future.result()
+            except Exception as e:
+                result['failed'].append((media_id, str(e)))
+                current_app.logger.warning(
+                    'update media %s failed: %s', media_id, e)
+            else:
+                updates.append({'id': pk, 'locale_url': locale_url})
+            if progress is not None:
+                progress(done, len(missing))
+
+    if updates:
+        db.session.bulk_update_mappings(Media, updates)
+        db.session.commit()
+    result['downloaded'] = len(updates)
+    return result
 
-    db.session.commit()
 
+def fetch_media(url, access_token, media_id, chunk_size=65536, retries=2):
+    """从微信服务器下载一个临时素材到素材存储
 
-def download_media(app_id, media_id):
-    token = get_token(app_id)
-    m = Media.query.filter_by(media_id=media_id).first()
+    按chunk_size分块写入media_id.part临时文件, 完成后移入素材存储,
+        内存占用与素材大小无关. 传输中断时用Range请求从临时文件末尾
+        继续下载, 最多重试retries次, 仍失败时保留临时文件供下次继续.
+        不使用应用上下文, 可以在线程池中执行
 
-    url = current_app.config['GET_MEDIA_URL']
+    Returns:
+        str: 素材的locale_url
+    """
     params = {
-        'access_token': token,
+        'access_token': access_token,
         'media_id': media_id
     }
+    part_path = media_store.tmp_path(media_id + '.part')
+    with _media_lock(part_path):
+        for attempt in range(retries + 1):
+            try:
+                return _fetch_part(url, params, part_path, chunk_size)
+            except (IOError, requests.RequestException):
+                # IOError包括连接中断, 重试时从已下载的部分继续
+                if attempt == retries:
+                    raise
+
+
+def _fetch_part(url, params, part_path, chunk_size):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    res = client.get(url, params=params, headers=headers, stream=True)
+    try:
+        if res.status_code == 416 and offset:
+            # 临时文件已下载完整但移入存储失败, 响应中没有文件名, 从头下载
+            os.remove(part_path)
+            return _fetch_part(url, params, part_path, chunk_size)
+
+        disposition = res.headers.get('Content-disposition')
+        if disposition is None:
+            # 出错时微信返回json格式的错误信息
+            raise ValueError(res.text)
+        filename = disposition.split('"')[1]
+
+        # 服务器不支持Range或返回的范围不对时从头下载
+        content_range = res.headers.get('Content-Range', '')
+        resumed = res.status_code == 206 and \
+            content_range.startswith('bytes %d-' % offset)
+        if resumed:
+            total = content_range.rpartition('/')[2]
+        elif 'Content-Encoding' not in res.headers:
+            total = res.headers.get('Content-Length', '')
+        else:
+            total = ''
+        with open(part_path, 'ab' if resumed else 'wb') as f:
+            for chunk in res.iter_content(chunk_size):
+                f.write(chunk)
+    finally:
+        res.close()
+
+    # 连接提前关闭时不一定抛出异常, 未下载完整的抛出IOError, 重试时继续
+    size = os.path.getsize(part_path)
+    if total.isdigit() and size != int(total):
+        raise IOError('incomplete download, %d of %s bytes' % (size, total))
+    return media_store.put_file(part_path, os.path.splitext(filename)[1])
+
+
+_media_locks = weakref.WeakValueDictionary()
+_media_locks_lock = threading.Lock()
+
+
+def _media_lock(path):
+    """同一个临时文件同时只有一个线程下载"""
+    with _media_locks_lock:
+        lock = _media_locks.get(path)
+        if lock is None:
+            lock = _media_locks[path] = threading.Lock()
+    return lock
+
+
+def download_media(app_id, media_id, as_attachment=True):
+    """获取临时素材
+
+    优先使用本地已保存的文件, 本地没有时才从微信服务器下载并记录地址
 
-    res = requests.get(url, params=params)
-
-    filename = res.headers.get('Content-disposition').split('"')[1]
+    Args:
+        app_id (str): 微信公众号app_id
+        media_id (str): 素材的media_id
+        as_attachment (bool, optional): 是否作为附件下载, 否则可在
+            页面中直接播放
 
-    save_path = os.path.join(
-        current_app.config['UPLOAD_FOLDER'], filename)
+    Returns:
+        response: 素材文件的响应, 支持条件请求及Range请求
+    """
+    m = Media.query.filter_by(media_id=media_id).first()
+    if m is None:
+        abort(404)
 
-    if not os.path.exists(save_path):
-        with open(save_path, 'wb+') as f:
-            f.write(res.content)
+    if media_store.exists(m.locale_url):
+        return send_media(m, as_attachment)
 
-    m.locale_url = 'uploads/' + filename
+    token = get_token(app_id)
+    config = current_app.config
+    m.locale_url = fetch_media(config['GET_MEDIA_URL'], token, media_id,
+                               config['MEDIA_CHUNK_SIZE'],
+                               config['MEDIA_DOWNLOAD_RETRIES'])
 
     db.session.add(m)
     db.session.commit()
 
-    response = make_response(send_file(save_path))
-    response.headers['Content-disposition'] = \
-        res.headers['Content-disposition']
+    return send_media(m, as_attachment)
+
+
+def send_media(m, as_attachment=True):
+    """发送素材的本地文件
+
+    MEDIA_SERVE_MODE为sendfile时返回X-Sendfile头, 为accel时返回nginx的
+        X-Accel-Redirect头, 由web服务器发送文件; 否则由应用发送,
+        带有ETag和Last-Modified, 支持304及Range请求
 
+    Args:
+        m (Media): 本地文件已存在的素材, 作为附件下载时以media_id命名
+        as_attachment (bool, optional): 是否作为附件下载
+
+    Returns:
+        response: 文件响应
+    """
+    config = current_app.config
+    mode = config['MEDIA_SERVE_MODE']
+    path = media_store.path(m.locale_url)
+    filename = m.media_id + os.path.splitext(path)[1]
+    if mode not in ('sendfile', 'accel'):
+        return send_file(path, as_attachment=as_attachment,
+                         attachment_filename=filename, conditional=True,
+                         cache_timeout=config['MEDIA_CACHE_TIMEOUT'])
+
+    response = current_app.response_class(
+        mimetype=mimetypes.guess_type(filename)[0] or
+        'application/octet-stream')
+    if mode == 'sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        relative = os.path.relpath(path, config['UPLOAD_FOLDER'])
+        response.headers['X-Accel-Redirect'] = \
+            config['MEDIA_ACCEL_PREFIX'] + relative.replace('\\', '/')
+    if as_attachment:
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % filename
+    response.cache_control.max_age = config['MEDIA_CACHE_TIMEOUT']
     return response
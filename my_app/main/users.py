@@ -0,0 +1,327 @@
+# coding: utf-8
+
+"""订阅用户同步模块
+
+按next_openid逐页拉取公众号的关注者列表, 每页最多10000个openid,
+    其中新增的和资料已过期的用户按每批100个批量获取资料, 多批在线程池
+    中并发请求, 由令牌桶限制调用速度. 每页的用户资料及用户标签在一个
+    事务中批量写入, 并记录同步进度, 中断后再次同步从中断的页继续.
+    同步开始时先同步公众号的标签
+"""
+
+import concurrent.futures
+import json
+import time
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from my_app import db
+from my_app.models import Tag, User, UserSync, tags
+from .audience import tag_index
+from .client import client
+from .ratelimit import get_bucket
+from .tools import get_token
+
+
+# 批量获取用户资料接口每次最多的openid数
+BATCHGET_SIZE = 100
+# 按openid查找已有用户时每次查询的openid数
+LOOKUP_SIZE = 500
+
+# 接口返回的用户资料字段到User字段的映射
+USER_FIELDS = (
+    ('nickname', 'nickname'),
+    ('sex', 'sex'),
+    ('language', 'language'),
+    ('city', 'city'),
+    ('province', 'province'),
+    ('country', 'country'),
+    ('headimgurl', 'headimageurl'),
+    ('subscribe_time', 'subscribe_time'),
+    ('unionid', 'unionid'),
+    ('remark', 'remark')
+)
+
+
+def sync_users(app_id, full=False, progress=None):
+    """同步公众号的订阅用户
+
+    上一轮同步已完成时开始新的一轮, 否则从记录的next_openid继续.
+        已有用户的资料在USER_SYNC_STALE_DAYS天内获取过的不再重复获取
+
+    Args:
+        app_id (str): 微信公众号app_id
+        full (bool, optional): 重新开始一轮同步, 并重新获取本轮开始前
+            获取的所有用户资料
+        progress (optional): 进度回调函数, 每处理完一页调用一次,
+            参数为UserSync同步进度
+
+    Returns:
+        UserSync: 本轮同步的进度
+    """
+    config = current_app.config
+    state = UserSync.query.filter_by(app_id=app_id).first()
+    if state is None:
+        state = UserSync(app_id=app_id)
+        db.session.add(state)
+    if full or state.started_at is None or state.finished_at is not None:
+        state.next_openid = ''
+        state.listed = 0
+        state.fetched = 0
+        state.started_at = int(time.time())
+        state.finished_at = None
+        db.session.commit()
+
+    if full:
+        stale_before = state.started_at
+    else:
+        stale_before = int(time.time()) - \
+            config['USER_SYNC_STALE_DAYS'] * 86400
+    bucket = get_bucket((app_id, 'USER_BATCHGET_URL'),
+                        config['USER_SYNC_RATE'])
+    tag_ids = sync_tags(app_id)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=config['USER_SYNC_WORKERS']) as executor:
+        while state.finished_at is None:
+            access_token = get_token(app_id)
+            page = _get_page(config['USER_GET_URL'], access_token,
+                             state.next_openid)
+            openids = page.get('data', {}).get('openid', []) \
+                if page.get('count') else []
+            if openids:
+                known = _known_users(app_id, openids)
+                stale = [o for o in openids if o not in known or
+                         (known[o][1] or 0) < stale_before]
+                batches = [stale[i:i + BATCHGET_SIZE]
+                           for i in range(0, len(stale), BATCHGET_SIZE)]
+                # 任一批失败时整页不写入, 也不推进进度, 下次重新同步这一页
+                infos = executor.map(
+                    lambda batch: _batchget(config['USER_BATCHGET_URL'],
+                                            access_token, batch, bucket),
+                    batches)
+                state.fetched += len(_save_users(app_id, known, infos,
+                                                 tag_ids))
+                state.listed += len(openids)
+
+            state.total = page.get('total', state.total)
+            if openids and page.get('next_openid'):
+                state.next_openid = page['next_openid']
+            else:
+                state.next_openid = None
+                state.finished_at = int(time.time())
+            db.session.commit()
+            if progress is not None:
+                progress(state)
+    # 批量写入的标签不经过ORM事件, 重新生成本进程的标签索引
+    tag_index.invalidate(app_id)
+    return state
+
+
+def sync_tags(app_id):
+    """同步公众号的标签, 微信中已删除的标签连同用户的标签一起删除
+
+    Args:
+        app_id (str): 微信公众号app_id
+
+    Returns:
+        dict: 微信标签id到Tag.id的映射
+    """
+    res = client.get(current_app.config['TAG_GET_URL'],
+                     params={'access_token': get_token(app_id)})
+    r = res.json()
+    if r.get('errcode'):
+        raise ValueError(res.text)
+
+    existing = dict((tag.wechat_tag_id, tag) for tag in
+                    Tag.query.filter_by(app_id=app_id))
+    for info in r.get('tags', []):
+        tag = existing.pop(info['id'], None)
+        if tag is None:
+            tag = Tag(app_id=app_id, wechat_tag_id=info['id'])
+            db.session.add(tag)
+        tag.name = info.get('name')
+        tag.count = info.get('count')
+    removed = [tag.id for tag in existing.values()]
+    if removed:
+        db.session.execute(tags.delete().where(tags.c.tag_id.in_(removed)))
+        Tag.query.filter(Tag.id.in_(removed)) \
+            .delete(synchronize_session=False)
+    db.session.commit()
+    return _tag_ids(app_id)
+
+
+def enrich_users(app_id, openids):
+    """为新出现的openid创建用户并获取资料
+
+    已有的用户跳过. 获取资料失败时只记录openid, synced_at为空,
+        下次同步订阅用户时再获取资料
+
+    Args:
+        app_id (str): 微信公众号app_id
+        openids (list): openid列表
+
+    Returns:
+        int: 新建的用户数
+    """
+    config = current_app.config
+    known = _known_users(app_id, openids)
+    new = [o for o in dict.fromkeys(openids) if o not in known]
+    if not new:
+        return 0
+
+    bucket = get_bucket((app_id, 'USER_BATCHGET_URL'),
+                        config['USER_SYNC_RATE'])
+    infos = []
+    try:
+        access_token = get_token(app_id)
+        for i in range(0, len(new), BATCHGET_SIZE):
+            infos.append(_batchget(config['USER_BATCHGET_URL'], access_token,
+                                   new[i:i + BATCHGET_SIZE], bucket))
+    except Exception as e:
+        current_app.logger.warning('get user info of %s failed: %s',
+                                   app_id, e)
+    saved = set(_save_users(app_id, {}, infos, _tag_ids(app_id)))
+    _insert_users([{'app_id': app_id, 'openid': o} for o in new
+                   if o not in saved])
+    db.session.commit()
+    return len(new)
+
+
+def _get_page(url, access_token, next_openid):
+    res = client.get(url, params={
+        'access_token': access_token,
+        'next_openid': next_openid or ''
+    })
+    r = res.json()
+    if r.get('errcode'):
+        raise ValueError(res.text)
+    return r
+
+
+def _known_users(app_id, openids):
+    """已有用户的openid到(id, synced_at)的映射"""
+    known = {}
+    for i in range(0, len(openids), LOOKUP_SIZE):
+        rows = db.session.query(User.openid, User.id, User.synced_at) \
+            .filter(User.app_id == app_id,
+                    User.openid.in_(openids[i:i + LOOKUP_SIZE]))
+        for openid, pk, synced_at in rows:
+            known[openid] = (pk, synced_at)
+    return known
+
+
+def _tag_ids(app_id):
+    """公众号已同步的标签, 微信标签id到Tag.id的映射"""
+    return dict(db.session.query(Tag.wechat_tag_id, Tag.id)
+                .filter(Tag.app_id == app_id))
+
+
+def _batchget(url, access_token, openids, bucket):
+    """批量获取用户资料, 不使用应用上下文, 可以在线程池中执行
+
+    Returns:
+        list: 接口返回的用户资料字典列表
+    """
+    bucket.acquire()
+    data = {
+        'user_list': [{'openid': openid, 'lang': 'zh_CN'}
+                      for openid in openids]
+    }
+    res = client.post(url, params={'access_token': access_token},
+                      data=json.dumps(data).encode('utf-8'))
+    r = res.json()
+    if r.get('errcode'):
+        raise ValueError(res.text)
+    return r.get('user_info_list', [])
+
+
+def _save_users(app_id, known, infos, tag_ids):
+    """批量写入用户资料及用户标签, 返回写入的openid列表
+
+    Args:
+        app_id (str): 微信公众号app_id
+        known (dict): 已有用户的openid到(id, synced_at)的映射
+        infos: 每批用户资料字典列表的序列
+        tag_ids (dict): 微信标签id到Tag.id的映射, 未同步的标签跳过
+    """
+    now = int(time.time())
+    inserts = []
+    updates = []
+    user_tags = {}
+    for info_list in infos:
+        for info in info_list:
+            # 拉取列表后取消关注的用户只返回openid, 不更新
+            if not info.get('subscribe'):
+                continue
+            row = dict((column, info.get(key)) for key, column in USER_FIELDS)
+            if row['sex'] is not None:
+                row['sex'] = str(row['sex'])
+            row['synced_at'] = now
+            user_tags[info['openid']] = [
+                tag_ids[t] for t in info.get('tagid_list') or ()
+                if t in tag_ids]
+            if info['openid'] in known:
+                row['id'] = known[info['openid']][0]
+                updates.append(row)
+            else:
+                row['app_id'] = app_id
+                row['openid'] = info['openid']
+                inserts.append(row)
+    _insert_users(inserts)
+    if updates:
+        db.session.bulk_update_mappings(User, updates)
+    _save_user_tags(app_id, known, user_tags)
+    return list(user_tags)
+
+
+def _insert_users(rows):
+    """批量插入用户, 其他进程已插入的用户改为更新
+
+    (app_id, openid)有唯一索引, 整批插入冲突时回滚到保存点, 再逐个插入,
+        冲突的用户按(app_id, openid)更新其余字段
+    """
+    if not rows:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.bulk_insert_mappings(User, rows)
+        return
+    except IntegrityError:
+        pass
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.bulk_insert_mappings(User, [row])
+        except IntegrityError:
+            values = dict((k, v) for k, v in row.items()
+                          if k not in ('app_id', 'openid'))
+            if values:
+                User.query.filter_by(
+                    app_id=row['app_id'], openid=row['openid']
+                ).update(values, synchronize_session=False)
+
+
+def _save_user_tags(app_id, known, user_tags):
+    """用接口返回的标签替换用户的全部标签
+
+    Args:
+        app_id (str): 微信公众号app_id
+        known (dict): 已有用户的openid到(id, synced_at)的映射
+        user_tags (dict): openid到Tag.id列表的映射
+    """
+    ids = dict((openid, known[openid][0]) for openid in user_tags
+               if openid in known)
+    new = [openid for openid in user_tags if openid not in known]
+    ids.update((openid, pk) for openid, (pk, _) in
+               _known_users(app_id, new).items())
+    user_ids = list(ids.values())
+    for i in range(0, len(user_ids), LOOKUP_SIZE):
+        db.session.execute(tags.delete().where(
+            tags.c.user_id.in_(user_ids[i:i + LOOKUP_SIZE])))
+    rows = [{'tag_id': tag_id, 'user_id': ids[openid]}
+            for openid, tag_list in user_tags.items() if openid in ids
+            for tag_id in tag_list]
+    if rows:
+        db.session.execute(tags.insert(), rows)
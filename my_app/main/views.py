@@ -1,15 +1,19 @@
 # coding: utf-8
 
 import datetime as dt
+import time
 
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app
 from flask.views import MethodView
 
-import requests
-
 from .tools import check_signature
-from my_app.models import Token
-from my_app import db
+from .cache import token_cache, reply_cache
+from .writer import msg_writer
+from .rollup import msg_rollup
+from .seen import seen_users
+from .deadline import reply_runner
+from .content import daily_sentence
+from .rules import rule_engine
 from . import receive
 from . import reply
 
@@ -39,7 +43,7 @@ class MainView(MethodView):
         nonce = request.args.get('nonce')
         echostr = request.args.get('echostr')
 
-        t = Token.query.filter_by(app_id=app_id).first()
+        t = token_cache.get(app_id=app_id)
 
         if t is not None:
             token = t.token
@@ -56,90 +60,157 @@ class MainView(MethodView):
         Returns:
             返回回复消息字符串, 微信公众平台文档中规定的精简版xml字符串消息
         """
+        started = time.time()
         data = request.data
 
         msg = receive.parse_xml(data)
+        key = reply_cache.key(msg)
+        if key is None:
+            return self.handle(msg, started)
+
+        entry, owner = reply_cache.claim(key)
+        if not owner:
+            # 微信的重试推送, 返回同一个回复, 不再重复处理和记录
+            result = entry.wait(current_app.config['REPLY_WAIT_TIMEOUT'])
+            return result if result is not None else 'success'
+
+        try:
+            result = self.handle(msg, started)
+        except Exception:
+            reply_cache.discard(key, entry)
+            raise
+        entry.resolve(result)
+        return result
+
+    def handle(self, msg, started):
+        """处理一条消息
+
+        记录接收消息并计数, 发现新用户, 生成并记录回复消息
+
+        Args:
+            msg: parse_xml解析出的接收消息
+            started (float): 开始处理请求的时间戳
+
+        Returns:
+            返回回复消息字符串
+        """
         try:
-            m = msg.save()
-            db.session.add(m)
-            db.session.commit()
+            msg_writer.save(msg.save())
         except Exception as e:
             print(str(e))
 
-        reply_msg = reply.TextMsg()
-        if isinstance(msg, receive.EventMsg):
-            if msg.Event == 'subscribe':
-                reply_msg.Content = '欢迎订阅'
-            elif msg.Event == 'CLICK':
-                if msg.EventKey == 'news1':
-                    item = reply.item()
-                    item.Title = '系统安装配置'
-                    item.Description = '系统安装与配置, windows, linux'
-                    item.PicUrl = 'https://img3.doubanio.com/' \
-                        'view/photo/l/public/p2497391244.webp'
-                    item.Url = 'http://wangmiao.site'
+        try:
+            t = token_cache.get(wechat_id=msg.ToUserName)
+            if t is not None:
+                msg_rollup.record(t.app_id, msg.MsgType,
+                                  getattr(msg, 'Event', None),
+                                  msg.CreateTime)
+                seen_users.check(t.app_id, msg.FromUserName)
+        except Exception as e:
+            print(str(e))
 
-                    articles = [item]
-                    reply_msg = reply.NewsMsg(articles)
-                if msg.EventKey == 'news3':
-                    articles = []
-                    today = dt.date.today().toordinal()
-                    for i in range(3):
-                        params = {
-                            'date': dt.date.fromordinal(today - i).isoformat()
-                        }
-                        res = requests.get('http://open.iciba.com/dsapi/',
-                                           params=params)
-
-                        res = res.json()
-
-                        item = reply.item()
-                        item.Title = res['content'] + res['dateline']
-                        item.Description = res['content']
-                        item.PicUrl = res['picture']
-                        item.Url = 'http://news.iciba.com/views/dailysentence/daily.html#!/detail/title/' + res['dateline']
-                        articles.append(item)
-                    reply_msg = reply.NewsMsg(articles)
-                if msg.EventKey == 'music':
-                    music = reply.Music()
-                    music.ThumbMediaId = '6QHtH_ihEVEblVDXdtDJZmG_C_dwqlXWGpvZMMqQu65TL2Tn_cmh-DDTW1RIfTz6'
-                    music.Title = 'Nothing on yo'
-                    music.Description = 'Beautiful girls all over the world'
-                    music.MusicUrl = 'http://other.web.ra01.sycdn.kuwo.cn/resource/n1/2011/06/14/2055048587.mp3'
-                    music.HQMusicUrl = 'http://other.web.rc01.sycdn.kuwo.cn/resource/n3/4/6/2041343348.mp3'
-                    reply_msg = reply.MusicMsg()
-                    reply_msg.Music = music
-            else:
-                reply_msg.Content = '这是一条' + msg.Event + '事件'
-        else:
-            if msg.MsgType == 'image':
-                reply_msg = reply.ImageMsg()
-                image = reply.Image(msg.MediaId)
-                reply_msg.Image = image
-            elif msg.MsgType == 'voice':
-                reply_msg = reply.VoiceMsg()
-                voice = reply.Voice(msg.MediaId)
-                reply_msg.Voice = voice
-            elif msg.MsgType == 'video':
-                reply_msg = reply.VideoMsg()
-                video = reply.Video()
-                video.MediaId = msg.MediaId
-                video.Title = 'test'
-                video.Description = 'just test'
-                reply_msg.Video = video
-            else:
-                reply_msg.Content = '这是一条' + msg.MsgType + '消息'
-        reply_msg.FromUserName = msg.ToUserName
-        reply_msg.ToUserName = msg.FromUserName
+        reply_msg = reply_runner.run(make_reply, msg, started)
+        if reply_msg is None:
+            # 超过回复时限, 回复由客服消息接口稍后发送
+            return 'success'
 
         try:
             return reply_msg.send()
         except Exception as e:
             print(str(e))
         finally:
-            m = reply_msg.save()
-            db.session.add(m)
-            db.session.commit()
+            msg_writer.save(reply_msg.save())
+
+
+def make_reply(msg):
+    """生成回复消息
+
+    根据接收消息的类型及内容生成对应的回复消息,
+        可能在请求线程之外的回复线程中执行
+
+    Args:
+        msg: parse_xml解析出的接收消息
+
+    Returns:
+        回复消息对象
+    """
+    reply_msg = reply.TextMsg()
+    if isinstance(msg, receive.EventMsg):
+        if msg.Event == 'subscribe':
+            reply_msg.Content = '欢迎订阅'
+        elif msg.Event == 'CLICK':
+            if msg.EventKey == 'news1':
+                item = reply.item()
+                item.Title = '系统安装配置'
+                item.Description = '系统安装与配置, windows, linux'
+                item.PicUrl = 'https://img3.doubanio.com/' \
+                    'view/photo/l/public/p2497391244.webp'
+                item.Url = 'http://wangmiao.site'
+
+                articles = [item]
+                reply_msg = reply.NewsMsg(articles)
+            if msg.EventKey == 'news3':
+                articles = []
+                today = dt.date.today().toordinal()
+                dates = [dt.date.fromordinal(today - i).isoformat()
+                         for i in range(3)]
+                # 只使用已缓存的内容, 未缓存的在后台获取, 不等待网络请求
+                for res in daily_sentence.get_many(dates, wait=False):
+                    # 今天的还未发布或获取失败时只回复其他日期的
+                    if res is None:
+                        continue
+                    item = reply.item()
+                    item.Title = res['content'] + res['dateline']
+                    item.Description = res['content']
+                    item.PicUrl = res['picture']
+                    item.Url = 'http://news.iciba.com/views/dailysentence/daily.html#!/detail/title/' + res['dateline']
+                    articles.append(item)
+                if articles:
+                    reply_msg = reply.NewsMsg(articles)
+                else:
+                    reply_msg.Content = '每日一句暂时无法获取, 请稍后再试'
+            if msg.EventKey == 'music':
+                music = reply.Music()
+                music.ThumbMediaId = '6QHtH_ihEVEblVDXdtDJZmG_C_dwqlXWGpvZMMqQu65TL2Tn_cmh-DDTW1RIfTz6'
+                music.Title = 'Nothing on yo'
+                music.Description = 'Beautiful girls all over the world'
+                music.MusicUrl = 'http://other.web.ra01.sycdn.kuwo.cn/resource/n1/2011/06/14/2055048587.mp3'
+                music.HQMusicUrl = 'http://other.web.rc01.sycdn.kuwo.cn/resource/n3/4/6/2041343348.mp3'
+                reply_msg = reply.MusicMsg()
+                reply_msg.Music = music
+        else:
+            reply_msg.Content = '这是一条' + msg.Event + '事件'
+    else:
+        if msg.MsgType == 'image':
+            reply_msg = reply.ImageMsg()
+            image = reply.Image(msg.MediaId)
+            reply_msg.Image = image
+        elif msg.MsgType == 'voice':
+            reply_msg = reply.VoiceMsg()
+            voice = reply.Voice(msg.MediaId)
+            reply_msg.Voice = voice
+        elif msg.MsgType == 'video':
+            reply_msg = reply.VideoMsg()
+            video = reply.Video()
+            video.MediaId = msg.MediaId
+            video.ThumbMediaId = msg.ThumbMediaId
+            video.Title = 'test'
+            video.Description = 'just test'
+            reply_msg.Video = video
+        elif msg.MsgType == 'text':
+            t = token_cache.get(wechat_id=msg.ToUserName)
+            content = None
+            if t is not None:
+                content = rule_engine.match(t.app_id, msg.Content)
+            if content is None:
+                content = '这是一条' + msg.MsgType + '消息'
+            reply_msg.Content = content
+        else:
+            reply_msg.Content = '这是一条' + msg.MsgType + '消息'
+    reply_msg.FromUserName = msg.ToUserName
+    reply_msg.ToUserName = msg.FromUserName
+
+    return reply_msg
 
 
 main_view = MainView.as_view('main_view')
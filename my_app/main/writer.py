@@ -0,0 +1,95 @@
+# coding: utf-8
+
+"""消息记录写库模块
+
+接收消息与回复消息的数据库模型统一通过msg_writer保存
+"""
+
+import threading
+
+from my_app import db
+from .background import Worker
+
+
+class MsgWriter(Worker):
+    """消息记录写库类
+
+    MSG_WRITE_BEHIND关闭时, save直接提交到数据库, 与请求同步;
+        打开时消息模型先放入进程内缓冲, 由后台线程在缓冲达到
+        MSG_BATCH_SIZE条或每隔MSG_FLUSH_INTERVAL秒批量写入,
+        进程退出时写入剩余的消息. 缓冲中尚未写入的消息对数据库查询不可见
+
+    Attributes:
+        batch_size (int): 每批写入的消息条数
+        enabled (bool): 是否启用批量写入
+    """
+
+    def __init__(self, app=None):
+        super(MsgWriter, self).__init__(app)
+        self.enabled = False
+        self.batch_size = 200
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+
+    def init_app(self, app):
+        super(MsgWriter, self).init_app(app)
+        self.enabled = app.config['MSG_WRITE_BEHIND']
+        self.batch_size = app.config['MSG_BATCH_SIZE']
+        self.interval = app.config['MSG_FLUSH_INTERVAL']
+
+    def save(self, m):
+        """保存消息模型
+
+        Args:
+            m (models.Msg): 接收消息或回复消息save方法返回的消息模型
+        """
+        if not self.enabled:
+            db.session.add(m)
+            db.session.commit()
+            return
+
+        self._detach(m)
+        with self._buffer_lock:
+            self._buffer.append(m)
+            size = len(self._buffer)
+        self.start()
+        if size >= self.batch_size:
+            self.wakeup()
+
+    def flush(self):
+        """将缓冲中的消息全部写入数据库, 需要在app_context中调用"""
+        while True:
+            with self._buffer_lock:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+            if not batch:
+                return
+
+            try:
+                for m in batch:
+                    db.session.merge(m)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception(
+                    'drop %d buffered msgs', len(batch))
+
+    def run_once(self):
+        self.flush()
+
+    def on_stop(self):
+        self.flush()
+
+    @staticmethod
+    def _detach(m):
+        """将消息及其子模型移出请求的session
+
+        回复消息会关联数据库中已有的素材, 经backref级联进入请求的session,
+            移出后请求结束时不会再写入, 统一由后台线程merge后写入
+        """
+        for obj in (m, m.media, m.event, m.location):
+            if obj is not None and obj in db.session:
+                db.session.expunge(obj)
+
+
+msg_writer = MsgWriter()
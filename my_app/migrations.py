@@ -0,0 +1,247 @@
+# coding: utf-8
+
+"""数据库结构版本迁移
+
+create_all只会创建不存在的表, 已有的表不会增加新的索引和字段.
+    这里按版本号记录对已有数据库的修改, 当前版本保存在schema_version
+    表中, create_app时依次执行未执行过的版本. 新建的数据库已由
+    create_all按模型创建了全部结构, 各版本需跳过已存在的索引和字段.
+    多个worker进程同时启动时, 建表和迁移由upgrade_lock串行执行
+"""
+
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:  # windows下没有fcntl, 不能防止多个进程同时迁移
+    fcntl = None
+
+from sqlalchemy import and_, inspect, select, text
+
+from my_app import models
+
+
+# 已注册的迁移, (版本号, 函数)列表, 函数的参数为数据库连接
+migrations = []
+# MySQL中用于串行执行迁移的GET_LOCK锁名及等待秒数
+LOCK_NAME = 'my_app_schema_upgrade'
+LOCK_TIMEOUT = 600
+
+
+def migration(version):
+    """注册一个版本的迁移函数, 版本号需递增"""
+    def decorator(func):
+        migrations.append((version, func))
+        return func
+    return decorator
+
+
+def current_version(conn):
+    row = conn.execute(text('SELECT MAX(version) FROM schema_version')) \
+        .fetchone()
+    return row[0] or 0
+
+
+@contextlib.contextmanager
+def upgrade_lock(engine, path):
+    """持有迁移锁, 其他进程在此期间阻塞等待
+
+    MySQL使用GET_LOCK, 多台服务器之间也能互斥; 其他数据库使用path
+        文件锁, 只在同一台服务器的进程之间互斥
+
+    Args:
+        engine: 数据库引擎
+        path (str): 文件锁路径
+
+    Raises:
+        RuntimeError: 等待MySQL锁超时
+    """
+    if engine.dialect.name == 'mysql':
+        with engine.connect() as conn:
+            locked = conn.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                                  name=LOCK_NAME,
+                                  timeout=LOCK_TIMEOUT).scalar()
+            if locked != 1:
+                raise RuntimeError('wait for %s timed out' % LOCK_NAME)
+            try:
+                yield
+            finally:
+                conn.execute(text('SELECT RELEASE_LOCK(:name)'),
+                             name=LOCK_NAME)
+        return
+
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def upgrade(engine):
+    """执行所有未执行的迁移, 需持有upgrade_lock
+
+    Args:
+        engine: 数据库引擎
+
+    Returns:
+        int: 迁移后的版本号
+    """
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version '
+                          '(version INTEGER NOT NULL PRIMARY KEY)'))
+        _unique_versions(conn)
+        version = current_version(conn)
+
+    for v, func in sorted(migrations, key=lambda m: m[0]):
+        if v <= version:
+            continue
+        with engine.begin() as conn:
+            func(conn)
+            conn.execute(text('INSERT INTO schema_version (version) '
+                              'VALUES (:version)'), version=v)
+        version = v
+    return version
+
+
+def _unique_versions(conn):
+    """旧的schema_version表没有主键, 去掉重复的版本后增加唯一索引"""
+    name = 'ix_schema_version_version'
+    table = inspect(conn)
+    if table.get_pk_constraint('schema_version')['constrained_columns'] or \
+            name in [i['name'] for i in table.get_indexes('schema_version')]:
+        return
+    versions = [v for v, in conn.execute(
+        text('SELECT DISTINCT version FROM schema_version'))]
+    conn.execute(text('DELETE FROM schema_version'))
+    for v in versions:
+        conn.execute(text('INSERT INTO schema_version (version) '
+                          'VALUES (:version)'), version=v)
+    conn.execute(text('CREATE UNIQUE INDEX %s ON schema_version (version)'
+                      % name))
+
+
+def create_index(conn, table, name):
+    """按模型中的定义创建索引, 已存在时跳过
+
+    Args:
+        conn: 数据库连接
+        table: 模型对应的Table
+        name (str): 索引名
+    """
+    if name in [i['name'] for i in inspect(conn).get_indexes(table.name)]:
+        return
+    for index in table.indexes:
+        if index.name == name:
+            index.create(conn)
+            return
+    raise KeyError(name)
+
+
+def drop_index(conn, table, name):
+    """删除模型中定义的索引, 不存在时跳过
+
+    Args:
+        conn: 数据库连接
+        table: 模型对应的Table
+        name (str): 索引名
+    """
+    if name not in [i['name'] for i in inspect(conn).get_indexes(table.name)]:
+        return
+    for index in table.indexes:
+        if index.name == name:
+            index.drop(conn)
+            return
+    raise KeyError(name)
+
+
+def add_column(conn, table, name):
+    """按模型中的定义增加字段, 已存在时跳过
+
+    Args:
+        conn: 数据库连接
+        table: 模型对应的Table
+        name (str): 字段名
+    """
+    if name in [c['name'] for c in inspect(conn).get_columns(table.name)]:
+        return
+    column = table.columns[name]
+    conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+        table.name, column.name, column.type.compile(conn.dialect))))
+
+
+@migration(1)
+def add_lookup_indexes(conn):
+    """为各个高频查询增加索引
+
+    收到媒体消息时按wechat_id查找公众号, 记录回复时按media_id查找素材,
+        素材页按公众号和类型列出素材, 消息历史按用户和时间查询
+    """
+    create_index(conn, models.Token.__table__, 'ix_token_wechat_id')
+    create_index(conn, models.Media.__table__, 'ix_media_media_id')
+    create_index(conn, models.Media.__table__, 'ix_media_app_id_media_type')
+    create_index(conn, models.Media.__table__, 'ix_media_app_id_created_at')
+    create_index(conn, models.Msg.__table__,
+                 'ix_msg_from_username_create_time')
+    create_index(conn, models.Msg.__table__,
+                 'ix_msg_to_username_create_time')
+    create_index(conn, models.Rule.__table__, 'ix_rule_app_id')
+
+
+@migration(2)
+def add_msg_create_time_index(conn):
+    """归档时按创建时间查找过期的消息"""
+    create_index(conn, models.Msg.__table__, 'ix_msg_create_time')
+
+
+def delete_duplicate_users(conn):
+    """每个公众号的每个openid只保留id最小的用户, 删除其余的用户及其标签"""
+    user = models.User.__table__
+    kept = user.alias()
+    duplicates = [pk for pk, in conn.execute(
+        select([user.c.id]).distinct().select_from(user.join(kept, and_(
+            kept.c.app_id == user.c.app_id,
+            kept.c.openid == user.c.openid,
+            kept.c.id < user.c.id))))]
+    for i in range(0, len(duplicates), 500):
+        ids = duplicates[i:i + 500]
+        conn.execute(models.tags.delete().where(
+            models.tags.c.user_id.in_(ids)))
+        conn.execute(user.delete().where(user.c.id.in_(ids)))
+
+
+@migration(3)
+def add_user_sync_columns(conn):
+    """同步订阅用户时按openid查找用户, 并记录用户资料的获取时间
+
+    (app_id, openid)为唯一索引, 创建前先删除重复的用户
+    """
+    add_column(conn, models.User.__table__, 'synced_at')
+    delete_duplicate_users(conn)
+    create_index(conn, models.User.__table__, 'ix_user_app_id_openid')
+
+
+@migration(4)
+def add_unique_user_and_tag_indexes(conn):
+    """同步订阅用户的标签, 并保证每个公众号的每个openid只有一个用户
+
+    标签增加公众号和微信的标签id. 迁移3曾创建非唯一的(app_id, openid)
+        索引, 这样的数据库先删除重复的用户, 再把索引改为唯一索引
+    """
+    add_column(conn, models.Tag.__table__, 'app_id')
+    add_column(conn, models.Tag.__table__, 'wechat_tag_id')
+    create_index(conn, models.Tag.__table__, 'ix_tag_app_id_wechat_tag_id')
+
+    user = models.User.__table__
+    indexes = dict((i['name'], i) for i in
+                   inspect(conn).get_indexes(user.name))
+    if indexes.get('ix_user_app_id_openid', {}).get('unique'):
+        return
+    delete_duplicate_users(conn)
+    drop_index(conn, user, 'ix_user_app_id_openid')
+    create_index(conn, user, 'ix_user_app_id_openid')
@@ -62,7 +62,7 @@ class Token(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     app_id = db.Column(db.String(255), unique=True)
     app_secret = db.Column(db.String(255))
-    wechat_id = db.Column(db.String(255))
+    wechat_id = db.Column(db.String(255), index=True)
     token = db.Column(db.String(255))
     access_token = db.Column(db.String(255))
     expired_time = db.Column(db.Integer)
@@ -80,11 +80,20 @@ class Tag(db.Model):
     """用户标签类
 
     Attributes:
+        app_id (str): 公众号的app_id
         count (str): 该标签下的用户数
         id (int): 自增键
         name (str): 标签名
+        wechat_tag_id (int): 微信的标签id, 只在同一个公众号内唯一
     """
+    __table_args__ = (
+        db.Index('ix_tag_app_id_wechat_tag_id', 'app_id', 'wechat_tag_id',
+                 unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    app_id = db.Column(db.String(255))
+    wechat_tag_id = db.Column(db.Integer)
     name = db.Column(db.String(255))
     count = db.Column(db.Integer)
 
@@ -107,9 +116,15 @@ class User(db.Model):
         remark (str): 公众号对订阅用户的备注
         sex (str): 订阅用户性别
         subscribe_time (str): 用户订阅时间
+        synced_at (int): 最后一次从微信服务器获取用户资料的时间戳
         tags (str): 用户标签
         unionid (str): 只有在用户将公众号绑定到微信开放平台帐号后，才会出现该字段。
     """
+    __table_args__ = (
+        # 同步用户时按公众号和openid查找, 同一个用户只有一行
+        db.Index('ix_user_app_id_openid', 'app_id', 'openid', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     app_id = db.Column(db.String(255))
     openid = db.Column(db.String(255))
@@ -123,6 +138,7 @@ class User(db.Model):
     subscribe_time = db.Column(db.Integer)
     unionid = db.Column(db.String(255))
     remark = db.Column(db.String(255))
+    synced_at = db.Column(db.Integer)
     tags = db.relationship('Tag', secondary=tags,
                            backref=db.backref('users', lazy='dynamic'))
 
@@ -147,6 +163,16 @@ class Msg(db.Model):
             shortvideo, location, link, event
         to_username (str): 消息接收者
     """
+    __table_args__ = (
+        # 按用户查询消息历史
+        db.Index('ix_msg_from_username_create_time',
+                 'from_username', 'create_time'),
+        db.Index('ix_msg_to_username_create_time',
+                 'to_username', 'create_time'),
+        # 按时间归档
+        db.Index('ix_msg_create_time', 'create_time'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     from_username = db.Column(db.String(255))
     to_username = db.Column(db.String(255))
@@ -189,8 +215,15 @@ class Media(db.Model):
         voice_format (str): 语音消息格式
         voice_recognition (str): 语音识别结果
     """
+    __table_args__ = (
+        # 按类型分页显示素材
+        db.Index('ix_media_app_id_media_type', 'app_id', 'media_type', 'id'),
+        # 查找未过期的素材
+        db.Index('ix_media_app_id_created_at', 'app_id', 'created_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    media_id = db.Column(db.String(255))
+    media_id = db.Column(db.String(255), index=True)
     thumb_media_id = db.Column(db.String(255))
     media_type = db.Column(db.String(255))
     created_at = db.Column(db.Integer)
@@ -255,3 +288,171 @@ class Item(db.Model):
     article_id = db.Column(db.Integer, db.ForeignKey('media.id'))
     article = db.relationship('Media',
                               backref=db.backref('items', lazy='dynamic'))
+
+
+class Rule(db.Model):
+    """自动回复规则
+
+    公众号收到文本消息时, 按关键词匹配的自动回复规则
+
+    Attributes:
+        app (str): 规则所属的公众号
+        app_id (str): 规则所属公众号外键app_id
+        content (str): 匹配后回复的文本内容
+        id (int): 自增键, 同等条件下先添加的规则优先
+        keyword (str): 关键词
+        match_type (str): 匹配方式, exact全文匹配, prefix前缀匹配,
+            contains包含匹配
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    keyword = db.Column(db.String(255))
+    match_type = db.Column(db.String(255))
+    content = db.Column(db.String(255))
+
+    app_id = db.Column(db.String(255), db.ForeignKey('token.app_id'),
+                       index=True)
+    app = db.relationship('Token',
+                          backref=db.backref('rules', lazy='dynamic'))
+
+
+class MsgRollup(db.Model):
+    """消息数按小时汇总
+
+    按公众号, 消息类型, 事件类型和小时汇总的接收消息数, 由接收消息时
+        的内存计数定期累加, 统计时不必扫描消息记录
+
+    Attributes:
+        app_id (str): 公众号app_id
+        count (int): 消息数
+        event_type (str): 事件类型, 非事件消息为空字符串
+        hour (int): 小时开始的时间戳
+        id (int): 自增键
+        msg_type (str): 消息类型
+    """
+    __table_args__ = (
+        db.UniqueConstraint('app_id', 'hour', 'msg_type', 'event_type',
+                            name='uq_msg_rollup_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    app_id = db.Column(db.String(255))
+    hour = db.Column(db.Integer)
+    msg_type = db.Column(db.String(255))
+    event_type = db.Column(db.String(255))
+    count = db.Column(db.Integer)
+
+
+class UserSync(db.Model):
+    """订阅用户同步进度
+
+    每个公众号一条记录, 同步中断后从next_openid继续拉取用户列表
+
+    Attributes:
+        app_id (str): 公众号app_id
+        fetched (int): 本轮已获取资料的用户数
+        finished_at (int): 本轮完成的时间戳, 进行中为空
+        id (int): 自增键
+        listed (int): 本轮已拉取的openid数
+        next_openid (str): 下一次拉取用户列表的起始openid
+        started_at (int): 本轮开始的时间戳
+        total (int): 公众号的关注者总数
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    app_id = db.Column(db.String(255), unique=True)
+    next_openid = db.Column(db.String(255))
+    total = db.Column(db.Integer)
+    listed = db.Column(db.Integer)
+    fetched = db.Column(db.Integer)
+    started_at = db.Column(db.Integer)
+    finished_at = db.Column(db.Integer)
+
+
+class Broadcast(db.Model):
+    """群发任务
+
+    按标签表达式或openid列表群发一条消息, 受众在后台拆分为多个
+        BroadcastChunk分批发送
+
+    Attributes:
+        app (str): 任务所属的公众号
+        app_id (str): 任务所属公众号外键app_id
+        audience (str): 受众, 标签表达式或换行分隔的openid列表
+        audience_type (str): 受众类型, tag标签表达式, openids用户列表
+        content (str): 文本消息内容, 只有text消息不为空
+        created_at (int): 创建时间戳
+        error (str): 任务失败的原因
+        failed (int): 发送失败的用户数
+        finished_at (int): 完成时间戳
+        id (int): 自增键
+        media (str): 图片, 语音及图文消息的素材
+        media_id (int): 素材外键id
+        msg_type (str): 群发消息类型, text, image, voice, mpnews
+        sent (int): 已发送的用户数
+        status (str): 任务状态, pending等待拆分, running发送中,
+            done已完成, failed失败
+        total (int): 受众用户数
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    msg_type = db.Column(db.String(255))
+    content = db.Column(db.Text)
+    audience_type = db.Column(db.String(255))
+    audience = db.Column(db.Text)
+    status = db.Column(db.String(255), index=True)
+    total = db.Column(db.Integer)
+    sent = db.Column(db.Integer)
+    failed = db.Column(db.Integer)
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.Integer)
+    finished_at = db.Column(db.Integer)
+
+    media_id = db.Column(db.Integer, db.ForeignKey('media.id'))
+    media = db.relationship('Media')
+
+    app_id = db.Column(db.String(255), db.ForeignKey('token.app_id'),
+                       index=True)
+    app = db.relationship('Token',
+                          backref=db.backref('broadcasts', lazy='dynamic'))
+
+
+class BroadcastChunk(db.Model):
+    """群发任务的一批用户
+
+    一次群发接口调用发送的用户, 以clientmsgid防止重复发送
+
+    Attributes:
+        attempts (int): 已尝试发送的次数
+        broadcast (str): 所属的群发任务
+        broadcast_id (int): 群发任务外键id
+        claimed_at (int): 开始发送的时间戳, 超时未完成视为发送中断
+        error (str): 最后一次失败的原因
+        id (int): 自增键
+        msg_data_id (str): 图文消息的数据id
+        msg_id (str): 微信服务器返回的群发消息id
+        next_attempt_at (int): 失败后下次重试的时间戳
+        openids (str): 换行分隔的openid列表
+        seq (int): 在任务中的序号
+        size (int): 用户数
+        status (str): 状态, pending等待发送, sending发送中,
+            sent已发送, failed失败
+    """
+    __table_args__ = (
+        # 按任务查找待发送的批次
+        db.Index('ix_broadcast_chunk_broadcast_id_status',
+                 'broadcast_id', 'status'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.Integer)
+    openids = db.Column(db.Text)
+    size = db.Column(db.Integer)
+    status = db.Column(db.String(255))
+    attempts = db.Column(db.Integer)
+    next_attempt_at = db.Column(db.Integer)
+    claimed_at = db.Column(db.Integer)
+    msg_id = db.Column(db.String(255))
+    msg_data_id = db.Column(db.String(255))
+    error = db.Column(db.String(255))
+
+    broadcast_id = db.Column(db.Integer, db.ForeignKey('broadcast.id'))
+    broadcast = db.relationship('Broadcast',
+                                backref=db.backref('chunks', lazy='dynamic'))